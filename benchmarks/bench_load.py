@@ -0,0 +1,371 @@
+"""端到端压测：模拟支付网关 + 模拟 Discord 服务器
+
+在本进程内启动易支付 mapi.php / Epusdt create-transaction 的模拟网关，并用内存中的
+服务器/成员/身份组替代 Discord，驱动机器人的真实代码路径：
+
+1. 下单：大量用户并发调用 send_checkout（准入控制 -> 写订单 -> 网关下单）
+2. 回调：按真实签名向 webhook 服务器发送支付成功回调，混入重复回调与错误签名
+3. 发放：回调收件箱 -> 发放队列 -> 身份组工作池 -> 写入订阅，统计回调到发放完成的耗时
+4. 到期：把全部订阅改为已过期，调用 process_expired_subscriptions 移除身份组
+
+输出各阶段吞吐量与延迟分位数，并校验每个已支付订单恰好发放一次、到期后身份组已全部移除。
+
+用法: python benchmarks/bench_load.py [--users 2000] [--platform yipay|epusdt]
+      [--gateway-latency-ms 50] [--role-latency-ms 20] [--duplicate-rate 0.2] [--bad-sign-rate 0.05]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+from aiohttp import ClientSession, TCPConnector, web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+GUILD_ID = 1
+ROLE_ID = 100
+PLAN_NAME = "压测套餐"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples):
+    """返回 (p50, p90, p99, max)，单位毫秒"""
+    if not samples:
+        return 0.0, 0.0, 0.0, 0.0
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return pick(0.5), pick(0.9), pick(0.99), ordered[-1] * 1000
+
+
+def report(label, count, elapsed, samples=None):
+    rate = count / elapsed if elapsed else 0.0
+    line = f"{label:<6} {count:>7} 次  {elapsed:>7.2f}s  {rate:>9,.0f} 次/秒"
+    if samples:
+        p50, p90, p99, worst = percentiles(samples)
+        line += f"  p50 {p50:>7.1f}ms  p90 {p90:>7.1f}ms  p99 {p99:>7.1f}ms  max {worst:>7.1f}ms"
+    print(line)
+
+
+# ================= 模拟支付网关 =================
+class MockGateway:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.created = 0
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    async def yipay_create(self, request: web.Request):
+        form = await request.post()
+        await self._delay()
+        self.created += 1
+        return web.json_response({"code": 1, "trade_no": uuid.uuid4().hex,
+                                  "payurl": f"https://pay.example/{form['out_trade_no']}"})
+
+    async def epusdt_create(self, request: web.Request):
+        body = await request.json()
+        await self._delay()
+        self.created += 1
+        return web.json_response({"status_code": 200, "data": {
+            "trade_id": uuid.uuid4().hex, "order_id": body["order_id"],
+            "payment_url": f"https://pay.example/{body['order_id']}"}})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/mapi.php", self.yipay_create)
+        app.router.add_post("/api/v1/order/create-transaction", self.epusdt_create)
+        return app
+
+
+# ================= 模拟 Discord =================
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+        self.mention = f"<@&{role_id}>"
+
+
+class FakeMember:
+    def __init__(self, user_id, latency):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.roles = set()
+        self._latency = latency
+
+    async def add_roles(self, *roles, **kwargs):
+        await asyncio.sleep(self._latency)
+        self.roles.update(r.id for r in roles)
+
+    async def remove_roles(self, *roles, **kwargs):
+        await asyncio.sleep(self._latency)
+        self.roles.difference_update(r.id for r in roles)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = {}
+        self.roles = {}
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append((content, kwargs))
+
+
+class FakeInteraction:
+    def __init__(self, guild_id, user_id):
+        self.guild_id = guild_id
+        self.user = FakeUser(user_id)
+        self.followup = FakeFollowup()
+
+
+def install_fake_discord(bot, guild):
+    """只替换本实例的服务器查询与按 ID 增删身份组的 HTTP 接口，不连接 Discord"""
+    bot.get_guild = lambda guild_id: guild if guild_id == guild.id else None
+
+    async def add_role(guild_id, user_id, role_id, reason=None):
+        await guild.members[user_id].add_roles(guild.roles[role_id])
+
+    async def remove_role(guild_id, user_id, role_id, reason=None):
+        await guild.members[user_id].remove_roles(guild.roles[role_id])
+
+    bot.http.add_role = add_role
+    bot.http.remove_role = remove_role
+    bot.__class__ = type("BenchBot", (bot.__class__,), {"guilds": property(lambda self: [guild])})
+
+
+# ================= 压测流程 =================
+def write_config(workdir, args, gateway_port, webhook_port) -> str:
+    gateway_url = f"http://127.0.0.1:{gateway_port}/"
+    config = {
+        "token": "bench",
+        "guild_id": GUILD_ID,
+        "payment_platform": args.platform,
+        "yipay_url": gateway_url,
+        "yipay_pid": "1000",
+        "yipay_key": "bench-key",
+        "epusdt_url": gateway_url,
+        "epusdt_token": "bench-token",
+        "payment_methods": {"支付宝": "alipay", "USDT": "usdt"},
+        "default_currency": "CNY",
+        "notify_url": f"http://127.0.0.1:{webhook_port}/notify",
+        "notify_port": webhook_port,
+        "database": os.path.join(workdir, "bench.db"),
+        "inbox_poll_interval": 1,
+        "role_workers": {"workers": args.role_workers, "rate": args.role_rate, "burst": args.role_rate},
+        "fulfillment": {"concurrency": args.fulfillment_concurrency},
+        "checkout_admission": {"user_rate": 1, "user_burst": 5,
+                               "max_inflight": args.gateway_inflight, "max_queue": args.users,
+                               "queue_timeout": 60},
+        "logging": {"level": "WARNING", "file": os.path.join(workdir, "bench.log")},
+    }
+    path = os.path.join(workdir, "config.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False)
+    return path
+
+
+def build_callback(bot_main, trade_no, platform, bad_sign=False):
+    """返回 (method, kwargs) 形式的回调请求"""
+    if platform == "yipay":
+        params = {"pid": bot_main.YIPAY_PID, "trade_no": uuid.uuid4().hex, "out_trade_no": trade_no,
+                  "type": "alipay", "name": f"Plan-{PLAN_NAME}", "money": "10.00",
+                  "trade_status": "TRADE_SUCCESS", "sign_type": "MD5"}
+        params["sign"] = bot_main.YiPay.generate_sign_yipay(params, bot_main.YIPAY_KEY)
+        if bad_sign:
+            params["sign"] = "0" * 32
+        return "GET", {"params": params}
+    body = {"trade_id": uuid.uuid4().hex, "order_id": trade_no, "amount": 10, "actual_amount": 1.39,
+            "token": "TXbench", "block_transaction_id": uuid.uuid4().hex, "status": 2}
+    body["signature"] = bot_main.YiPay.generate_sign_epusdt(body, bot_main.EPUSDT_TOKEN)
+    if bad_sign:
+        body["signature"] = "0" * 32
+    return "POST", {"json": body}
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    gateway = MockGateway(args.gateway_latency_ms / 1000)
+    gateway_runner = web.AppRunner(gateway.app(), access_log=None)
+    await gateway_runner.setup()
+    gateway_port = _free_port()
+    await web.TCPSite(gateway_runner, "127.0.0.1", gateway_port).start()
+    webhook_port = _free_port()
+
+    os.environ["BOT_CONFIG_PATH"] = write_config(workdir, args, gateway_port, webhook_port)
+    import main as bot_main
+
+    guild = FakeGuild(GUILD_ID)
+    guild.roles[ROLE_ID] = FakeRole(ROLE_ID)
+    role_latency = args.role_latency_ms / 1000
+    user_ids = [10_000 + i for i in range(args.users)]
+    for user_id in user_ids:
+        guild.members[user_id] = FakeMember(user_id, role_latency)
+    install_fake_discord(bot_main.bot, guild)
+
+    await bot_main.db.execute(
+        "INSERT INTO plans (guild_id, name, price, currency, role_id, duration_months) VALUES (?, ?, ?, ?, ?, ?)",
+        (GUILD_ID, PLAN_NAME, 10.0, "CNY", ROLE_ID, 1))
+    plan = (await bot_main.plan_catalog.reload(GUILD_ID)).find(PLAN_NAME)
+    type_code = "alipay" if args.platform == "yipay" else "usdt"
+
+    await bot_main.gateway_client.start()
+    await bot_main.start_web_server()
+    bot_main.role_workers.start()
+    bot_main.fulfillment_queue.start()
+    bot_main.webhook_inbox.start()
+
+    print(f"平台 {args.platform}，{args.users} 个用户，网关延迟 ~{args.gateway_latency_ms}ms，"
+          f"身份组操作延迟 {args.role_latency_ms}ms，数据库 {workdir}")
+
+    # 1. 下单
+    interactions = [FakeInteraction(GUILD_ID, user_id) for user_id in user_ids]
+    checkout_latency = []
+    limiter = asyncio.Semaphore(args.concurrency)
+
+    async def checkout(interaction):
+        async with limiter:
+            started = time.perf_counter()
+            await bot_main.send_checkout(interaction, plan, "支付宝", type_code)
+            checkout_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(checkout(i) for i in interactions))
+    report("下单", len(interactions), time.perf_counter() - started, checkout_latency)
+    rejected = sum(1 for i in interactions if i.followup.messages and i.followup.messages[-1][0])
+    rows = await bot_main.db.fetchall("SELECT order_id FROM orders WHERE status = 'pending'")
+    trade_nos = [row[0] for row in rows]
+    print(f"       订单 {len(trade_nos)} 个，网关下单 {gateway.created} 次，被准入控制拒绝 {rejected} 次，"
+          f"峰值网关并发 {bot_main.checkout_admission.peak_inflight}")
+
+    # 2. 回调（含重复与错误签名）
+    callbacks = []
+    for trade_no in trade_nos:
+        callbacks.append((trade_no, False))
+        if random.random() < args.duplicate_rate:
+            callbacks.append((trade_no, False))
+        if random.random() < args.bad_sign_rate:
+            callbacks.append((trade_no, True))
+    random.shuffle(callbacks)
+
+    finished = {}
+    first_callback = {}
+    all_done = asyncio.Event()
+    track_finished = bot_main.fulfillment_queue.on_finished
+
+    def on_finished(order_id, state):
+        track_finished(order_id, state)
+        finished[order_id] = (state, time.perf_counter())
+        if len(finished) >= len(trade_nos):
+            all_done.set()
+
+    bot_main.fulfillment_queue.on_finished = on_finished
+
+    notify_url = bot_main.NOTIFY_URL
+    callback_latency = []
+    statuses = {}
+    limiter = asyncio.Semaphore(args.concurrency)
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as session:
+        async def send(trade_no, bad_sign):
+            method, kwargs = build_callback(bot_main, trade_no, args.platform, bad_sign)
+            async with limiter:
+                started = time.perf_counter()
+                async with session.request(method, notify_url, **kwargs) as response:
+                    await response.read()
+                callback_latency.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            if not bad_sign:
+                first_callback.setdefault(trade_no, time.perf_counter())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(trade_no, bad) for trade_no, bad in callbacks))
+        report("回调", len(callbacks), time.perf_counter() - started, callback_latency)
+    print(f"       状态码 {dict(sorted(statuses.items()))}")
+
+    # 3. 发放
+    try:
+        await asyncio.wait_for(all_done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"       发放超时：{len(finished)}/{len(trade_nos)} 个订单在 {args.timeout}s 内完成")
+    fulfill_latency = [done - first_callback[order_id] for order_id, (_, done) in finished.items()
+                       if order_id in first_callback]
+    elapsed = max((done for _, done in finished.values()), default=started) - started
+    report("发放", len(finished), elapsed, fulfill_latency)
+    failed = sum(1 for state, _ in finished.values() if state != "fulfilled")
+    subscriptions = (await bot_main.db.fetchone("SELECT COUNT(*) FROM subscriptions"))[0]
+    granted = sum(1 for member in guild.members.values() if ROLE_ID in member.roles)
+    print(f"       订阅 {subscriptions} 条，持有身份组 {granted} 人，失败 {failed} 个")
+    assert subscriptions == len(trade_nos) - failed, "重复回调产生了重复订阅"
+
+    # 4. 到期
+    await bot_main.db.execute("UPDATE subscriptions SET expire_date = ?", (int(time.time()) - 1,))
+    started = time.perf_counter()
+    await bot_main.process_expired_subscriptions()
+    elapsed = time.perf_counter() - started
+    report("到期", subscriptions, elapsed)
+    remaining = sum(1 for member in guild.members.values() if ROLE_ID in member.roles)
+    left = (await bot_main.db.fetchone("SELECT COUNT(*) FROM subscriptions"))[0]
+    print(f"       剩余身份组 {remaining} 人，剩余订阅 {left} 条")
+    assert remaining == 0 and left == 0, "到期处理后仍有身份组或订阅残留"
+
+    commits = bot_main.db_commit_latency.count()
+    print(f"数据库批量提交 {commits} 次；完整指标见 {os.path.join(workdir, 'metrics.txt')}")
+    with open(os.path.join(workdir, "metrics.txt"), "w", encoding="utf-8") as f:
+        f.write(bot_main.metrics.render())
+
+    await bot_main.shutdown_resources()
+    await gateway_runner.cleanup()
+    bot_main.db.close()
+    bot_main.log_listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--platform", choices=("yipay", "epusdt"), default="yipay")
+    parser.add_argument("--concurrency", type=int, default=200, help="客户端并发（下单与回调）")
+    parser.add_argument("--gateway-latency-ms", type=float, default=50)
+    parser.add_argument("--gateway-inflight", type=int, default=16, help="checkout_admission.max_inflight")
+    parser.add_argument("--role-latency-ms", type=float, default=20)
+    parser.add_argument("--role-workers", type=int, default=8)
+    parser.add_argument("--role-rate", type=float, default=500, help="每个服务器每秒身份组操作数")
+    parser.add_argument("--fulfillment-concurrency", type=int, default=32)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--bad-sign-rate", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""结账链接复用缓存
+
+同一用户对同一套餐、同一支付方式重复下单时，在有效期内直接复用尚未支付的
+订单与支付链接；并发的相同请求只会真正创建一次（single-flight），
+其余请求等待同一个结果。这样可以避免反复切换支付方式时产生大量孤儿订单
+与网关调用。创建请求被取消时不会牵连等待者，它们改为自行创建。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, NamedTuple, Optional, Tuple
+
+
+class CheckoutLink(NamedTuple):
+    trade_no: str
+    pay_url: str
+    payment_amount: float
+    display_currency: str
+    created_at: float
+
+
+class _CreatorCancelled(RuntimeError):
+    """发起创建的请求被取消，等待者需要自行重新创建"""
+
+
+class CheckoutCache:
+    def __init__(self, ttl: float = 300, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CheckoutLink]" = OrderedDict()
+        self._by_trade_no: Dict[str, Hashable] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    def _get(self, key: Hashable) -> Optional[CheckoutLink]:
+        link = self._entries.get(key)
+        if link is None:
+            return None
+        if time.monotonic() - link.created_at >= self.ttl:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return link
+
+    def _put(self, key: Hashable, link: CheckoutLink):
+        self._drop(key)
+        self._entries[key] = link
+        self._by_trade_no[link.trade_no] = key
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: Hashable):
+        link = self._entries.pop(key, None)
+        if link is not None:
+            self._by_trade_no.pop(link.trade_no, None)
+
+    def invalidate_orders(self, trade_nos: Iterable[str]):
+        """订单已支付或失效后移除对应的缓存链接"""
+        for trade_no in trade_nos:
+            key = self._by_trade_no.get(trade_no)
+            if key is not None:
+                self._drop(key)
+
+    async def get_or_create(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[CheckoutLink]],
+        validate: Optional[Callable[[CheckoutLink], Awaitable[bool]]] = None,
+    ) -> Tuple[CheckoutLink, bool]:
+        """返回 (链接, 是否复用)；validate 返回 False 时丢弃缓存并重新创建"""
+        link = self._get(key)
+        if link is not None:
+            if validate is None or await validate(link):
+                self.hits += 1
+                return link, True
+            self._drop(key)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight), True
+            except _CreatorCancelled:
+                return await self.get_or_create(key, factory, validate)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            link = await factory()
+        except asyncio.CancelledError:
+            # 取消只属于发起创建的请求，不传递给合并等待的其他用户
+            future.set_exception(_CreatorCancelled(f"结账链接创建被取消: {key}"))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            self._put(key, link)
+            future.set_result(link)
+            return link, False
+        finally:
+            self._inflight.pop(key, None)
@@ -0,0 +1,180 @@
+"""订阅到期调度器
+
+用最小堆保存即将到期的订阅，协程精确睡眠到下一个到期时间点，
+到期后立即回收身份组。堆中只保存一个时间窗口内的订阅，窗口耗尽时
+再通过 expire_date 索引加载下一个窗口，不再需要周期性全表扫描。
+新增的订阅若早于当前堆顶，会立即唤醒调度器重新计算睡眠时间。
+回收失败而保留的订阅以 (重试时间, ...) 重新放入堆中，retry_delay 秒后重试；
+在此之前加载窗口时跳过它们，避免反复重试占满窗口、挤掉后续到期的订阅。
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sharding import ShardScope
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# (user_id, role_id, sub_id, guild_id)，与 process_expired_subscriptions 的行格式一致
+ExpiredRow = Tuple[int, int, int, int]
+
+
+class ExpiryScheduler:
+    def __init__(
+        self,
+        storage: Storage,
+        on_expired: Callable[[List[ExpiredRow]], Awaitable[Optional[Iterable[int]]]],
+        window_seconds: int = 3600,
+        window_size: int = 1000,
+        batch_size: int = 500,
+        max_sleep: float = 600,
+        retry_delay: float = 600,
+        scope: Optional[ShardScope] = None,
+    ):
+        self._storage = storage
+        self._on_expired = on_expired
+        self.window_seconds = window_seconds
+        self.window_size = window_size
+        self.batch_size = batch_size
+        # 单次睡眠上限，用于容忍系统时钟跳变
+        self.max_sleep = max_sleep
+        self.retry_delay = retry_delay
+        # 只调度本进程分片内服务器的订阅
+        self.scope = scope or ShardScope()
+        # 堆元素: (expire_date, sub_id, user_id, role_id)
+        self._heap: List[Tuple[int, int, int, int]] = []
+        # 堆中已包含 expire_date <= _horizon 的全部订阅
+        self._horizon = 0
+        # 回收失败的订阅 sub_id -> (重试时间, user_id, role_id)；on_expired 返回未能回收的 sub_id
+        self._deferred: Dict[int, Tuple[int, int, int]] = {}
+        # 加载窗口期间登记的订阅，加载完成后并入新堆，避免与查询结果错过
+        self._refilling = False
+        self._pending: List[Tuple[int, int, int, int]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, sub_id: int, user_id: int, role_id: int, expire_date: int):
+        """登记新写入或续期后的订阅；永久订阅与窗口外的订阅由后续加载处理"""
+        if expire_date == -1:
+            return
+        if self._refilling:
+            self._pending.append((expire_date, sub_id, user_id, role_id))
+            return
+        if expire_date > self._horizon:
+            return
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (expire_date, sub_id, user_id, role_id))
+        if self._wake is not None and (earliest is None or expire_date < earliest):
+            self._wake.set()
+
+    async def _refill(self):
+        """通过 expire_date 索引加载下一个时间窗口内的订阅"""
+        now = time.time()
+        horizon = int(now) + self.window_seconds
+        scope, scope_params = self.scope.sql()
+        self._deferred = {sub_id: entry for sub_id, entry in self._deferred.items() if entry[0] > now}
+        rows = []
+        last = (-1, -1)
+        self._refilling = True
+        try:
+            # 按 (expire_date, id) 键集分页，跳过等待重试（仍处于过期状态）的订阅，直到凑满一个窗口
+            while True:
+                page = await self._storage.fetchall(
+                    f"SELECT id, user_id, role_id, expire_date FROM subscriptions "
+                    f"WHERE expire_date BETWEEN 0 AND ? AND (expire_date, id) > (?, ?) AND {scope} "
+                    f"ORDER BY expire_date, id LIMIT ?",
+                    (horizon, *last, *scope_params, self.window_size),
+                )
+                rows.extend(row for row in page if row[3] > now or row[0] not in self._deferred)
+                if len(page) < self.window_size:
+                    break
+                last = (page[-1][3], page[-1][0])
+                if len(rows) >= self.window_size:
+                    # 窗口被截断，只能保证最后一条的到期时间之前是完整的
+                    horizon = last[0]
+                    break
+        finally:
+            self._refilling = False
+            pending, self._pending = self._pending, []
+        heap = [(expire_date, sub_id, user_id, role_id) for sub_id, user_id, role_id, expire_date in rows]
+        # 重复的条目无害：到期时会先以数据库为准确认
+        heap.extend(entry for entry in pending if entry[0] <= horizon)
+        # 窗口内到达重试时间的失败订阅按重试时间入堆
+        heap.extend((retry_at, sub_id, user_id, role_id)
+                    for sub_id, (retry_at, user_id, role_id) in self._deferred.items() if retry_at <= horizon)
+        heapq.heapify(heap)
+        self._heap = heap
+        self._horizon = horizon
+
+    async def _sleep_until(self, deadline: float):
+        delay = min(deadline - time.time(), self.max_sleep)
+        if delay <= 0:
+            return
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self, due: List[Tuple[int, int, int, int]], now: int):
+        # 堆中的记录可能已被续期或删除，以数据库为准再确认一次
+        sub_ids = [entry[1] for entry in due]
+        placeholders = ",".join("?" * len(sub_ids))
+        rows = await self._storage.fetchall(
+            f"SELECT user_id, role_id, id, guild_id FROM subscriptions "
+            f"WHERE id IN ({placeholders}) AND expire_date BETWEEN 0 AND ?",
+            (*sub_ids, now),
+        )
+        for sub_id in sub_ids:
+            self._deferred.pop(sub_id, None)
+        if rows:
+            failed = set(await self._on_expired(rows) or ())
+            retry_at = int(time.time() + self.retry_delay)
+            for user_id, role_id, sub_id, _ in rows:
+                if sub_id in failed:
+                    self._deferred[sub_id] = (retry_at, user_id, role_id)
+                    if retry_at <= self._horizon:
+                        heapq.heappush(self._heap, (retry_at, sub_id, user_id, role_id))
+
+    async def _run(self):
+        # _horizon 初始为 0，首轮循环即会加载第一个窗口
+        while True:
+            try:
+                now = time.time()
+                if not self._heap:
+                    if now < self._horizon:
+                        await self._sleep_until(self._horizon)
+                    if time.time() >= self._horizon:
+                        await self._refill()
+                    continue
+                next_due = self._heap[0][0]
+                if next_due > now:
+                    await self._sleep_until(next_due)
+                    continue
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                    due.append(heapq.heappop(self._heap))
+                await self._dispatch(due, int(now))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"处理到期订阅失败: {e}")
+                await asyncio.sleep(5)
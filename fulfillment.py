@@ -0,0 +1,249 @@
+"""持久化的会员发放任务队列
+
+订单支付成功后在同一个事务里把订单标记为 paid 并写入 fulfillment_jobs，
+之后由队列负责发放。任务状态：
+
+    paid（待发放）→ fulfilling（发放中）→ fulfilled（已完成）/ failed（放弃）
+
+- 以 order_id 为主键去重，网关重复回调只会产生一个任务
+- 失败的任务按指数退避重新排队，超过最大次数后标记为 failed
+- 进程崩溃时停留在 fulfilling 的任务会在启动时恢复为 paid 重新执行
+- 订阅写入与任务完成在同一事务中提交，重试不会重复写入订阅
+- 任务记录订单所属服务器，多进程分片部署时每个进程只领取本分片服务器的任务
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Optional, Set
+
+from sharding import ShardScope
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+JOB_PAID = "paid"
+JOB_FULFILLING = "fulfilling"
+JOB_FULFILLED = "fulfilled"
+JOB_FAILED = "failed"
+
+
+class PermanentFulfillmentError(Exception):
+    """无法通过重试解决的发放错误（订单或套餐不存在等），任务直接标记为 failed"""
+
+
+def enqueue_paid_order(conn: sqlite3.Connection, order_id: str, now: int) -> bool:
+    """在写事务中将待支付订单标记为已支付并创建发放任务；重复回调或未知订单返回 False
+
+    已被生命周期任务标记为 expired 的订单仍然接受支付，避免用户付款后拿不到身份组。
+    """
+    updated = conn.execute("UPDATE orders SET status = 'paid' WHERE order_id = ? AND status IN ('pending', 'expired')",
+                           (order_id,)).rowcount
+    if not updated:
+        return False
+    conn.execute("INSERT OR IGNORE INTO fulfillment_jobs (order_id, guild_id, state, attempts, next_run_at, created_at, updated_at) "
+                 "SELECT order_id, guild_id, ?, 0, ?, ?, ? FROM orders WHERE order_id = ?",
+                 (JOB_PAID, now, now, now, order_id))
+    return True
+
+
+class FulfillmentQueue:
+    def __init__(
+        self,
+        storage: Storage,
+        handler: Callable[[str], Awaitable[Any]],
+        concurrency: int = 8,
+        max_attempts: int = 8,
+        base_backoff: float = 10,
+        max_backoff: float = 3600,
+        poll_interval: float = 30,
+        scope: Optional[ShardScope] = None,
+    ):
+        self._storage = storage
+        self._handler = handler
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # 没有唤醒信号时的最长等待时间（兜底轮询）
+        self.poll_interval = poll_interval
+        self.scope = scope or ShardScope()
+        self._inflight: Set[str] = set()
+        # 执行中的发放任务，stop() 时等待或取消，避免释放租约后仍在写入
+        self._jobs: Set[asyncio.Task] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # 任务进入终态时回调 (订单号, JOB_FULFILLED 或 JOB_FAILED)
+        self.on_finished: Optional[Callable[[str, str], None]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """停止调度并等待执行中的任务；超时仍未完成的任务被取消，保持 fulfilling 状态，由下次 recover() 恢复"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._jobs:
+            _, pending = await asyncio.wait(list(self._jobs), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def recover(self) -> int:
+        """把上次进程退出时仍处于 fulfilling 的任务恢复为待发放"""
+        now = int(time.time())
+        scope, scope_params = self.scope.sql()
+        return await self._storage.execute(
+            f"UPDATE fulfillment_jobs SET state = ?, next_run_at = ?, updated_at = ? WHERE state = ? AND {scope}",
+            (JOB_PAID, now, now, JOB_FULFILLING, *scope_params))
+
+    async def enqueue(self, order_id: str) -> bool:
+        """标记订单已支付并创建发放任务（提交后返回）；重复回调返回 False"""
+        created = await self._storage.transaction(lambda conn: enqueue_paid_order(conn, order_id, int(time.time())))
+        if created:
+            self.notify()
+        return created
+
+    async def complete(self, order_id: str, apply: Optional[Callable[[sqlite3.Connection], Any]] = None) -> Any:
+        """在同一事务中把任务标记为 fulfilled 并执行 apply(conn)
+
+        任务不处于 fulfilling 状态（已被其他流程完成）时不执行 apply，返回 None。
+        """
+        def txn(conn):
+            updated = conn.execute(
+                "UPDATE fulfillment_jobs SET state = ?, last_error = NULL, updated_at = ? WHERE order_id = ? AND state = ?",
+                (JOB_FULFILLED, int(time.time()), order_id, JOB_FULFILLING)).rowcount
+            if not updated:
+                return None
+            return apply(conn) if apply else True
+        result = await self._storage.transaction(txn)
+        if result is not None and self.on_finished:
+            self.on_finished(order_id, JOB_FULFILLED)
+        return result
+
+    async def process(self, order_id: str) -> Optional[str]:
+        """立即执行指定订单的发放任务（管理员补单用，failed 任务也会重试），返回最终状态"""
+        # 本进程仍在执行（包括 _fail 已写回 paid、尚未退出的任务）时不再认领，否则任务会停留在 fulfilling
+        if order_id not in self._inflight:
+            now = int(time.time())
+            claimed = await self._storage.execute(
+                "UPDATE fulfillment_jobs SET state = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE order_id = ? AND state IN (?, ?)",
+                (JOB_FULFILLING, now, order_id, JOB_PAID, JOB_FAILED))
+            if claimed:
+                self._inflight.add(order_id)
+                # 登记为执行中的任务，stop() 会等待它；调用方被取消也不会中断发放
+                await asyncio.shield(self._spawn(order_id))
+        row = await self._storage.fetchone("SELECT state FROM fulfillment_jobs WHERE order_id = ?", (order_id,))
+        return row[0] if row else None
+
+    async def last_error(self, order_id: str) -> Optional[str]:
+        row = await self._storage.fetchone("SELECT last_error FROM fulfillment_jobs WHERE order_id = ?", (order_id,))
+        return row[0] if row else None
+
+    def _backoff(self, attempts: int) -> int:
+        return int(min(self.max_backoff, self.base_backoff * (2 ** max(0, attempts - 1))))
+
+    async def _claim(self, limit: int):
+        scope, scope_params = self.scope.sql()
+
+        def txn(conn):
+            now = int(time.time())
+            rows = conn.execute(
+                f"SELECT order_id, attempts FROM fulfillment_jobs WHERE state = ? AND next_run_at <= ? AND {scope} "
+                "ORDER BY next_run_at LIMIT ?", (JOB_PAID, now, *scope_params, limit)).fetchall()
+            for order_id, _ in rows:
+                conn.execute("UPDATE fulfillment_jobs SET state = ?, attempts = attempts + 1, updated_at = ? WHERE order_id = ?",
+                             (JOB_FULFILLING, now, order_id))
+            return [order_id for order_id, _ in rows]
+        return await self._storage.transaction(txn)
+
+    def _spawn(self, order_id: str) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self._execute(order_id))
+        self._jobs.add(task)
+        task.add_done_callback(self._job_done)
+        return task
+
+    def _job_done(self, task: asyncio.Task):
+        self._jobs.discard(task)
+        self.notify()
+
+    async def _execute(self, order_id: str):
+        try:
+            await self._handler(order_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._fail(order_id, e)
+        else:
+            # 处理函数未自行调用 complete() 时在这里收尾（已完成则不会重复更新）
+            await self.complete(order_id)
+        finally:
+            self._inflight.discard(order_id)
+
+    async def _fail(self, order_id: str, error: Exception):
+        def txn(conn):
+            now = int(time.time())
+            row = conn.execute("SELECT attempts FROM fulfillment_jobs WHERE order_id = ?", (order_id,)).fetchone()
+            attempts = row[0] if row else self.max_attempts
+            if isinstance(error, PermanentFulfillmentError) or attempts >= self.max_attempts:
+                conn.execute("UPDATE fulfillment_jobs SET state = ?, last_error = ?, updated_at = ? WHERE order_id = ?",
+                             (JOB_FAILED, str(error), now, order_id))
+                return None
+            next_run_at = now + self._backoff(attempts)
+            conn.execute("UPDATE fulfillment_jobs SET state = ?, next_run_at = ?, last_error = ?, updated_at = ? WHERE order_id = ?",
+                         (JOB_PAID, next_run_at, str(error), now, order_id))
+            return next_run_at
+        next_run_at = await self._storage.transaction(txn)
+        if next_run_at is None:
+            logger.error(f"订单 {order_id} 发放失败，已放弃: {error}", extra={"event": "fulfillment.failed", "order_id": order_id})
+            if self.on_finished:
+                self.on_finished(order_id, JOB_FAILED)
+        else:
+            logger.warning(f"订单 {order_id} 发放失败，将于 {next_run_at - int(time.time())} 秒后重试: {error}",
+                           extra={"event": "fulfillment.retry", "order_id": order_id})
+
+    async def _next_due_in(self) -> float:
+        scope, scope_params = self.scope.sql()
+        row = await self._storage.fetchone(
+            f"SELECT MIN(next_run_at) FROM fulfillment_jobs WHERE state = ? AND {scope}", (JOB_PAID, *scope_params))
+        if not row or row[0] is None:
+            return self.poll_interval
+        return max(0.0, min(self.poll_interval, row[0] - time.time()))
+
+    async def _run(self):
+        while True:
+            try:
+                self._wake.clear()
+                free = self.concurrency - len(self._inflight)
+                if free > 0:
+                    for order_id in await self._claim(free):
+                        self._inflight.add(order_id)
+                        self._spawn(order_id)
+                if len(self._inflight) >= self.concurrency:
+                    delay = self.poll_interval
+                else:
+                    delay = await self._next_due_in()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"任务调度出错: {e}")
+                await asyncio.sleep(5)
@@ -0,0 +1,69 @@
+"""支付网关 HTTP 客户端
+
+整个进程共用一个 aiohttp.ClientSession：连接池复用 TCP/TLS 连接并缓存 DNS，
+下单时只需一次请求往返，也不会在高峰期耗尽本地临时端口。
+"""
+import asyncio
+from typing import Any, Optional
+
+import aiohttp
+
+
+class GatewayClient:
+    """带连接池与超时设置的长连接 HTTP 客户端，在 on_ready 创建、关闭时释放"""
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 30,
+        dns_ttl: int = 300,
+        keepalive_timeout: float = 60,
+        timeout: float = 15,
+        connect_timeout: float = 5,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def start(self) -> aiohttp.ClientSession:
+        """创建会话（重复调用是安全的）"""
+        async with self._lock:
+            if self.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.dns_ttl,
+                    use_dns_cache=True,
+                    keepalive_timeout=self.keepalive_timeout,
+                    enable_cleanup_closed=True,
+                )
+                self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            return self._session
+
+    async def close(self):
+        async with self._lock:
+            if not self.closed:
+                await self._session.close()
+            self._session = None
+
+    async def request_json(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> Any:
+        """发送请求并按 JSON 解析响应（忽略 Content-Type），未启动时自动创建会话"""
+        session = self._session if not self.closed else await self.start()
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with session.request(method, url, **kwargs) as resp:
+            return await resp.json(content_type=None)
+
+    async def post_json(self, url: str, **kwargs) -> Any:
+        return await self.request_json("POST", url, **kwargs)
+
+    async def get_json(self, url: str, **kwargs) -> Any:
+        return await self.request_json("GET", url, **kwargs)
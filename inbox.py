@@ -0,0 +1,117 @@
+"""Webhook 回调收件箱
+
+回调处理只做两件事：验证签名、把事件追加到 webhook_inbox 表（随 group commit
+落盘），随后立即回复网关。订单状态更新与发放任务创建由后台消费者批量完成，
+回调延迟因此不受 Discord 或业务处理耗时影响。
+
+分片部署时每组分片的主节点各自消费属于本分片服务器订单的事件，并直接唤醒本进程的发放队列；
+找不到订单的事件由负责全局任务的进程（0 号分片）消费。
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Callable, Dict, List, Optional
+
+from sharding import ShardScope
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# apply(conn, order_id, now) -> 是否产生了新的发放任务
+ApplyEvent = Callable[[sqlite3.Connection, str, int], bool]
+
+
+class WebhookInbox:
+    def __init__(
+        self,
+        storage: Storage,
+        apply: ApplyEvent,
+        batch_size: int = 200,
+        poll_interval: float = 5.0,
+        scope: Optional[ShardScope] = None,
+    ):
+        self._storage = storage
+        self._apply = apply
+        self.batch_size = batch_size
+        # 没有唤醒信号时的轮询间隔（其他进程写入的事件靠轮询发现）
+        self.poll_interval = poll_interval
+        self.scope = scope or ShardScope()
+        # 有新的发放任务产生时回调，参数为订单号列表
+        self.on_enqueued: Optional[Callable[[List[str]], None]] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def append(self, platform: str, order_id: str, payload: Dict) -> int:
+        """追加一条已验签的支付成功事件，落盘后返回事件 ID"""
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+        event_id = await self._storage.transaction(lambda conn: conn.execute(
+            "INSERT INTO webhook_inbox (platform, order_id, payload, received_at) VALUES (?, ?, ?, ?)",
+            (platform, order_id, body, int(time.time()))).lastrowid)
+        self.notify()
+        return event_id
+
+    async def pending_count(self) -> int:
+        row = await self._storage.fetchone("SELECT COUNT(*) FROM webhook_inbox WHERE processed_at IS NULL")
+        return row[0]
+
+    async def drain_once(self) -> int:
+        """处理一批未消费的事件，返回处理条数"""
+        scope, scope_params = self.scope.sql("o.guild_id")
+        if self.scope.primary and not self.scope.everything:
+            scope = f"({scope} OR o.guild_id IS NULL)"
+        rows = await self._storage.fetchall(
+            f"SELECT i.id, i.order_id FROM webhook_inbox i LEFT JOIN orders o ON o.order_id = i.order_id "
+            f"WHERE i.processed_at IS NULL AND {scope} ORDER BY i.id LIMIT ?",
+            (*scope_params, self.batch_size))
+        if not rows:
+            return 0
+
+        def txn(conn):
+            now = int(time.time())
+            created = [order_id for _, order_id in rows if self._apply(conn, order_id, now)]
+            ids = [event_id for event_id, _ in rows]
+            conn.execute(f"UPDATE webhook_inbox SET processed_at = ? WHERE id IN ({','.join('?' * len(ids))})",
+                         (now, *ids))
+            return created
+
+        created = await self._storage.transaction(txn)
+        if created and self.on_enqueued:
+            self.on_enqueued(created)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                self._wake.clear()
+                if await self.drain_once() >= self.batch_size:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"处理回调事件出错: {e}")
+                await asyncio.sleep(5)
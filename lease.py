@@ -0,0 +1,130 @@
+"""基于 SQLite 的主节点租约
+
+多进程部署时，回调收件箱消费、发放队列、到期调度等后台任务只能由一个进程执行。
+各进程共用同一个数据库，通过 leases 表竞争同名租约：
+- 租约未被持有或已过期时，第一个写入成功的进程成为持有者
+- 持有者每隔 ttl/3 续约一次；续约失败（被他人接管或数据库长时间不可用）即视为失去租约
+- 正常退出时主动释放，待命进程无需等到租约过期即可接管
+
+租约时间使用各进程的墙上时钟，只适用于共享同一个数据库文件的同机多进程。
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Callable, Optional, Sequence
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def default_holder() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _claim(conn, name: str, holder: str, ttl: float) -> bool:
+    """在调用方事务中获取或续约一次，返回 holder 是否持有该租约"""
+    now = time.time()
+    conn.execute(
+        "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+        "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+        (name, holder, now + ttl, now))
+    row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return row[0] == holder
+
+
+class Lease:
+    def __init__(self, storage: Storage, name: str, holder: Optional[str] = None,
+                 ttl: float = 30.0, retry_interval: float = 5.0):
+        self._storage = storage
+        self.name = name
+        self.holder = holder or default_holder()
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        # 续约失败、确认已失去租约时回调
+        self.on_lost: Optional[Callable[[], None]] = None
+        self.held = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def try_acquire(self) -> bool:
+        """尝试获取或续约一次，返回当前是否持有租约"""
+        self.held = await self._storage.transaction(lambda conn: _claim(conn, self.name, self.holder, self.ttl))
+        return self.held
+
+    async def current_holder(self) -> Optional[str]:
+        row = await self._storage.fetchone(
+            "SELECT holder FROM leases WHERE name = ? AND expires_at >= ?", (self.name, time.time()))
+        return row[0] if row else None
+
+    async def acquire(self):
+        """等待直到获得租约"""
+        announced = False
+        while not await self.try_acquire():
+            if not announced:
+                logger.info(f"租约 {self.name} 由 {await self.current_holder()} 持有，进入待命",
+                            extra={"event": "lease.standby", "lease": self.name, "holder": self.holder})
+                announced = True
+            await asyncio.sleep(self.retry_interval)
+        logger.info(f"已获得租约 {self.name}", extra={"event": "lease.acquired", "lease": self.name,
+                                                     "holder": self.holder})
+
+    def start(self):
+        """在持有租约后启动后台续约"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._renew())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def release(self):
+        self.stop()
+        if not self.held:
+            return
+        self.held = False
+        await self._storage.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+        logger.info(f"已释放租约 {self.name}", extra={"event": "lease.released", "lease": self.name})
+
+    async def _renew(self):
+        deadline = time.monotonic() + self.ttl
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if await self.try_acquire():
+                    deadline = time.monotonic() + self.ttl
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"续约 {self.name} 失败: {e}")
+                # 租约尚未过期前允许数据库短暂不可用
+                if time.monotonic() < deadline:
+                    continue
+            self.held = False
+            logger.error(f"已失去租约 {self.name}", extra={"event": "lease.lost", "lease": self.name})
+            if self.on_lost:
+                self.on_lost()
+            return
+
+
+async def claim_first_free(storage: Storage, names: Sequence[str], holder: Optional[str] = None,
+                           ttl: float = 30.0, retry_interval: float = 5.0) -> Optional[Lease]:
+    """在一个事务中按顺序尝试 names，返回第一个获得的租约（尚未启动续约）；全部被占用时返回 None"""
+    holder = holder or default_holder()
+
+    def txn(conn):
+        for name in names:
+            if _claim(conn, name, holder, ttl):
+                return name
+        return None
+
+    name = await storage.transaction(txn)
+    if name is None:
+        return None
+    lease = Lease(storage, name, holder, ttl, retry_interval)
+    lease.held = True
+    return lease
@@ -0,0 +1,153 @@
+"""订单生命周期维护
+
+后台定期执行：
+- 超过有效期仍未支付的 pending 订单标记为 expired
+- 早于保留期的已关闭订单（paid/expired，且发放任务不存在或已完成）分批移入 orders_archive；
+  发放失败的订单保留在热表中，仍可用 /fix_order 重试
+- 清理已消费的旧回调事件
+- 数据库为 auto_vacuum=INCREMENTAL 时回收空闲页
+
+每一批都是独立的小事务，与正常读写交错执行，热表始终保持较小。
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from fulfillment import JOB_FULFILLED
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class OrderLifecycle:
+    def __init__(
+        self,
+        storage: Storage,
+        pending_ttl: int = 24 * 60 * 60,
+        archive_after: int = 90 * SECONDS_PER_DAY,
+        inbox_retention: int = 7 * SECONDS_PER_DAY,
+        batch_size: int = 500,
+        interval: float = 30 * 60,
+        vacuum_pages: int = 1000,
+    ):
+        self._storage = storage
+        self.pending_ttl = pending_ttl
+        self.archive_after = archive_after
+        self.inbox_retention = inbox_retention
+        self.batch_size = batch_size
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self._task: Optional[asyncio.Task] = None
+        self._vacuum_hint_shown = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _batched(self, fn) -> int:
+        """重复执行 fn(conn) 直到某一批处理不足 batch_size 条，返回总数"""
+        total = 0
+        while True:
+            count = await self._storage.transaction(fn)
+            total += count
+            if count < self.batch_size:
+                return total
+            # 让出事件循环，避免长时间占用写线程
+            await asyncio.sleep(0)
+
+    async def expire_pending(self) -> int:
+        cutoff = int(time.time()) - self.pending_ttl
+        return await self._batched(lambda conn: conn.execute(
+            "UPDATE orders SET status = 'expired' WHERE rowid IN "
+            "(SELECT rowid FROM orders WHERE status = 'pending' AND created_at < ? LIMIT ?)",
+            (cutoff, self.batch_size)).rowcount)
+
+    async def archive_closed(self) -> int:
+        cutoff = int(time.time()) - self.archive_after
+
+        def archive_batch(conn):
+            now = int(time.time())
+            order_ids = []
+            for status in ("paid", "expired"):
+                rows = conn.execute(
+                    "SELECT order_id FROM orders WHERE status = ? AND created_at < ? "
+                    "AND NOT EXISTS (SELECT 1 FROM fulfillment_jobs j WHERE j.order_id = orders.order_id "
+                    "AND j.state != ?) LIMIT ?",
+                    (status, cutoff, JOB_FULFILLED, self.batch_size - len(order_ids))).fetchall()
+                order_ids.extend(row[0] for row in rows)
+                if len(order_ids) >= self.batch_size:
+                    break
+            if not order_ids:
+                return 0
+            placeholders = ",".join("?" * len(order_ids))
+            conn.execute(
+                f"INSERT OR REPLACE INTO orders_archive (order_id, guild_id, user_id, plan_id, status, created_at, archived_at) "
+                f"SELECT order_id, guild_id, user_id, plan_id, status, created_at, ? FROM orders WHERE order_id IN ({placeholders})",
+                (now, *order_ids))
+            conn.execute(f"DELETE FROM fulfillment_jobs WHERE order_id IN ({placeholders})", order_ids)
+            conn.execute(f"DELETE FROM orders WHERE order_id IN ({placeholders})", order_ids)
+            return len(order_ids)
+
+        return await self._batched(archive_batch)
+
+    async def prune_inbox(self) -> int:
+        cutoff = int(time.time()) - self.inbox_retention
+        return await self._batched(lambda conn: conn.execute(
+            "DELETE FROM webhook_inbox WHERE id IN (SELECT id FROM webhook_inbox "
+            "WHERE processed_at IS NOT NULL AND received_at < ? ORDER BY id LIMIT ?)",
+            (cutoff, self.batch_size)).rowcount)
+
+    async def incremental_vacuum(self) -> int:
+        """回收最多 vacuum_pages 个空闲页，返回回收前的空闲页数"""
+        mode = (await self._storage.fetchone("PRAGMA auto_vacuum"))[0]
+        if mode != 2:
+            if not self._vacuum_hint_shown:
+                self._vacuum_hint_shown = True
+                logger.warning("数据库未启用 auto_vacuum=INCREMENTAL，跳过空间回收"
+                               "（可停机后执行 PRAGMA auto_vacuum=INCREMENTAL; VACUUM; 启用）")
+            return 0
+        free_pages = (await self._storage.fetchone("PRAGMA freelist_count"))[0]
+        if free_pages:
+            await self._storage.transaction(lambda conn: self._vacuum(conn, min(free_pages, self.vacuum_pages)))
+        return free_pages
+
+    @staticmethod
+    def _vacuum(conn, pages: int):
+        # sqlite3 模块执行 PRAGMA incremental_vacuum 时只 step 一次（只回收一页），
+        # executescript 又会提交当前事务，因此逐页执行
+        for _ in range(pages):
+            conn.execute("PRAGMA incremental_vacuum(1)")
+
+    async def run_once(self) -> Dict[str, int]:
+        summary = {
+            "expired": await self.expire_pending(),
+            "archived": await self.archive_closed(),
+            "inbox_pruned": await self.prune_inbox(),
+            "free_pages": await self.incremental_vacuum(),
+        }
+        if summary["expired"] or summary["archived"] or summary["inbox_pruned"]:
+            logger.info("订单维护完成", extra={"event": "lifecycle.run", **summary})
+        return summary
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"订单维护失败: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,129 @@
+"""结构化日志
+
+- 调用方只把日志记录放入内存队列（QueueHandler），格式化与写出由后台线程完成，
+  事件循环上不再有同步的 stdout/文件写入
+- 默认输出 JSON Lines，extra 中的字段作为顶层键输出；也可切换为便于阅读的文本格式
+- 签名、密钥、token 等字段在输出前统一脱敏
+- 高频事件可按 event 名称配置采样率，未命中采样的记录在入队前丢弃
+
+用法：
+    logger = logging.getLogger(__name__)
+    logger.info("收到回调", extra={"event": "webhook.received", "params": data})
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+# 字段名（小写）包含以下任一片段即脱敏
+SENSITIVE_KEYS = ("sign", "signature", "key", "token", "secret", "password")
+REDACTED = "***"
+
+# LogRecord 自带的属性，不作为 extra 字段输出
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _is_sensitive(name: str, sensitive: Iterable[str]) -> bool:
+    name = name.lower()
+    return any(part in name for part in sensitive)
+
+
+def redact(value: Any, sensitive: Iterable[str] = SENSITIVE_KEYS) -> Any:
+    """递归替换字典中敏感字段的值"""
+    if isinstance(value, Mapping):
+        return {k: REDACTED if _is_sensitive(str(k), sensitive) else redact(v, sensitive) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v, sensitive) for v in value]
+    return value
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and not k.startswith("_")}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(redact(_extra_fields(record)))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        extra = redact(_extra_fields(record))
+        if extra:
+            text += " " + json.dumps(extra, ensure_ascii=False, default=str)
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """按 extra 中的 event 名称采样；WARNING 及以上级别始终保留"""
+
+    def __init__(self, rates: Mapping[str, float]):
+        super().__init__()
+        self.rates = dict(rates)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """入队时不做格式化（标准实现会在调用线程里 format），交给后台线程处理"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # 队列满时丢弃新记录而不是阻塞事件循环
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(
+    level: str = "INFO",
+    fmt: str = "json",
+    path: Optional[str] = None,
+    sample: Optional[Mapping[str, float]] = None,
+    queue_size: int = 10000,
+) -> logging.handlers.QueueListener:
+    """配置根日志器，返回已启动的 QueueListener（退出前调用 stop() 刷新剩余日志）"""
+    formatter = JsonFormatter() if fmt == "json" else TextFormatter()
+    output = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(queue_size)
+    handler = _QueueHandler(log_queue)
+    if sample:
+        handler.addFilter(SamplingFilter(sample))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
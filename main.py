@@ -9,6 +9,7 @@ from discord.ext import commands as ext_commands
 
 # 先设置默认值，避免NameError
 ENABLE_PRIVILEGED_INTENTS = False  # 默认禁用privileged intents
+SHARDING_CONFIG = {}  # 默认不分片
 
 # 动态检测需要的参数
 DISCORD_PY_VERSION = 1
@@ -36,7 +37,13 @@ def create_bot():
                 intents.members = True  # 只有在明确启用时才设置privileged intent
             else:
                 intents.members = False
-            bot = discord.Bot(intents=intents)
+            if SHARDING_CONFIG.get("enabled"):
+                # 多服务器部署：自动分片；shard_ids 指定时本进程只连接这些分片
+                bot = discord.AutoShardedBot(intents=intents,
+                                             shard_count=SHARDING_CONFIG.get("shard_count"),
+                                             shard_ids=SHARDING_CONFIG.get("shard_ids"))
+            else:
+                bot = discord.Bot(intents=intents)
             DISCORD_PY_VERSION = 2
         else:
             raise AttributeError("No Intents available")
@@ -88,10 +95,18 @@ except (AttributeError, TypeError):
         exit(1)  # 强制退出，要求用户安装Py-cord
 
 def slash_command(*args, **kwargs):
-    """Py-cord slash command装饰器"""
+    """Py-cord slash command装饰器
+
+    本机器人的指令都是服务器内的管理指令：只允许在服务器中使用（注册为全局命令时私信里也不可见），
+    默认只对管理员显示。私信中 has_permissions 检查总是通过，因此额外加上 guild_only 检查。
+    """
     def decorator(func):
         if PY_CORD_MODE and HAS_SLASH_COMMANDS:
-            return bot.slash_command(*args, **kwargs)(func)
+            if kwargs.get("guild_ids") is None:
+                # 按服务器注册的命令本身不会出现在私信中，contexts 只能用于全局命令
+                kwargs.setdefault("contexts", {discord.InteractionContextType.guild})
+            kwargs.setdefault("default_member_permissions", discord.Permissions(administrator=True))
+            return bot.slash_command(*args, **kwargs)(commands.guild_only()(func))
         else:
             print(f"❌ 无法注册slash command - 需要Py-cord支持")
             return func
@@ -129,71 +144,134 @@ except AttributeError:
 
     def __repr__(self):
         return repr(self.type_hint)
+import asyncio
+import logging
 import sqlite3
 import aiohttp
 from aiohttp import web
 import hashlib
+import io
+import hmac
+import signal
+import sys
 import time
 import json
 import urllib.parse
+from collections import OrderedDict
 from urllib.parse import urlparse, urlunparse
 
-# ================= 配置区域 =================
-
-def fetch_plans():
-    # 强制指定顺序：id, name, price, currency, role_id, duration_months
-    c.execute("SELECT id, name, price, currency, role_id, duration_months FROM plans")
-    return c.fetchall()
+from expiry import ExpiryScheduler
+from fulfillment import FulfillmentQueue, JOB_FULFILLED, PermanentFulfillmentError, enqueue_paid_order
+from http_client import GatewayClient
+from inbox import WebhookInbox
+from lease import Lease, claim_first_free
+from lifecycle import OrderLifecycle, SECONDS_PER_DAY
+from log import setup_logging
+from members import UNKNOWN_ROLE, MemberResolver
+from metrics import LoopLagMonitor, Registry
+from migrations import migrate
+from order_id import MAX_NODE_ID, OrderIdGenerator, default_node_id
+from order_query import OrderFilter, fetch_order_page, search_order_prefix
+from panels import PanelRegistry
+from admission import AdmissionController, AdmissionRejected
+from checkout_cache import CheckoutCache, CheckoutLink
+from plan_catalog import PlanCatalog
+from profiler import StackSampler, StallWatchdog
+from sharding import ShardScope
+from reconcile import OrderReconciler
+from role_reconcile import RoleReconciler
+from role_worker import RoleWorkerPool
+from storage import Storage
 
-def fetch_plan_by_name(name: str):
-    # 强制指定顺序：id, name, price, currency, role_id, duration_months
-    c.execute("SELECT id, name, price, currency, role_id, duration_months FROM plans WHERE name = ?", (name,))
-    return c.fetchone()
+# ================= 配置区域 =================
 
-def build_trade_no(user_id: int, prefix: str = "ORD") -> str:
-    """生成不超过32字符的订单号，前缀+时间戳+用户ID后6位"""
-    ts = int(time.time())
-    suffix = str(user_id % 1_000_000).zfill(6)
-    trade_no = f"{prefix}{ts}{suffix}"
-    return trade_no[:32]
+async def fetch_plans(guild_id: int):
+    # 从内存套餐目录读取，元素顺序：id, name, price, currency, role_id, duration_months
+    return (await plan_catalog.current(guild_id)).plans
+
+async def fetch_plan_by_name(guild_id: int, name: str):
+    return (await plan_catalog.current(guild_id)).find(name)
+
+async def insert_order(trade_no: str, guild_id: int, user_id: int, plan_id: int, status: str = 'pending', pay_type: str = None):
+    """写入一条订单记录"""
+    await db.execute("INSERT INTO orders (order_id, guild_id, user_id, plan_id, status, created_at, pay_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (trade_no, guild_id, user_id, plan_id, status, int(time.time()), pay_type))
+
+def build_trade_no(prefix: str = "ORD") -> str:
+    """生成不超过32字符、全局唯一且按时间递增的订单号：前缀+毫秒时间戳+节点号+序号"""
+    return order_ids.next(prefix)
+
+SECONDS_PER_MONTH = 30 * 24 * 60 * 60
+
+def extend_subscription(conn, guild_id: int, user_id: int, role_id: int, plan_id: int, duration_months: int, now: int):
+    """在调用方事务中写入或续期订阅，返回 (订阅 id, 新的到期时间)
+
+    同一服务器、用户、身份组只有一行订阅：续费从 max(当前时间, 原到期时间) 起顺延，
+    购买永久套餐或原订阅已是永久时到期时间为 -1。
+    """
+    seconds = -1 if duration_months == -1 else duration_months * SECONDS_PER_MONTH
+    conn.execute(
+        "INSERT INTO subscriptions (guild_id, user_id, role_id, plan_id, expire_date, created_at) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(guild_id, user_id, role_id) DO UPDATE SET "
+        "plan_id = CASE WHEN subscriptions.expire_date = -1 THEN subscriptions.plan_id ELSE excluded.plan_id END, "
+        "expire_date = CASE WHEN subscriptions.expire_date = -1 OR excluded.expire_date = -1 THEN -1 "
+        "ELSE MAX(subscriptions.expire_date, ?) + ? END",
+        (guild_id, user_id, role_id, plan_id, -1 if seconds == -1 else now + seconds, now, now, seconds))
+    return conn.execute("SELECT id, expire_date FROM subscriptions WHERE guild_id = ? AND user_id = ? AND role_id = ?",
+                        (guild_id, user_id, role_id)).fetchone()
 
 async def fulfill_order(trade_no: str):
-    """在支付确认后为用户发放身份组并写入订阅"""
-    c.execute("SELECT user_id, plan_id FROM orders WHERE order_id = ?", (trade_no,))
-    order = c.fetchone()
+    """发放任务处理函数：为用户发放身份组并写入订阅
+
+    由 fulfillment_queue 调用；抛出异常时任务会退避重试，PermanentFulfillmentError 则直接放弃。
+    """
+    order = await db.fetchone("SELECT user_id, plan_id, guild_id FROM orders WHERE order_id = ?", (trade_no,))
     if not order:
-        print(f"[Webhook] 未找到订单 {trade_no}")
-        return
-    user_id, plan_id = order
-    c.execute("SELECT id, name, price, currency, role_id, duration_months FROM plans WHERE id = ?", (plan_id,))
-    plan = c.fetchone()
+        raise PermanentFulfillmentError(f"未找到订单 {trade_no}")
+    user_id, plan_id, guild_id = order
+    plan = (await plan_catalog.current(guild_id)).get(plan_id)
     if not plan:
-        print(f"[Webhook] 未找到订单对应套餐 {plan_id}")
-        return
+        raise PermanentFulfillmentError(f"未找到订单对应套餐 {plan_id}")
     _, _, _, _, role_id, duration = plan
 
-    guild = bot.get_guild(GUILD_ID)
+    guild = bot.get_guild(guild_id)
     if not guild:
-        print("[Webhook] 未找到指定的 Guild")
-        return
-    member = guild.get_member(user_id)
-    role = guild.get_role(role_id)
-    if not member or not role:
-        print(f"[Webhook] 成员或角色缺失 user={user_id} role={role_id}")
-        return
-
-    try:
-        await member.add_roles(role)
-    except Exception as e:
-        print(f"[Webhook] 赋予角色失败: {e}")
-        return
+        # 分片尚未就绪或机器人已离开该服务器，稍后重试
+        raise RuntimeError(f"未找到服务器 guild={guild_id}")
+    if not guild.get_role(role_id):
+        raise PermanentFulfillmentError(f"角色缺失 role={role_id}")
+
+    # 记下续期前的订阅行：若它在添加身份组后被到期回收删除，身份组也可能已被移除
+    previous = await db.fetchone("SELECT id FROM subscriptions WHERE guild_id = ? AND user_id = ? AND role_id = ?",
+                                 (guild_id, user_id, role_id))
+
+    # 按 ID 添加身份组，不依赖成员缓存（未开启 members intent 时大部分成员都不在缓存中）
+    added = await role_workers.submit(
+        guild.id, lambda: member_resolver.add_role(guild.id, user_id, role_id, reason=f"订单 {trade_no}"), "add_role")
+    if not added:
+        # 用户尚未加入或已离开服务器，稍后重试
+        raise RuntimeError(f"成员不在服务器 user={user_id}")
 
     current_time = int(time.time())
-    expire_date = -1 if duration == -1 else current_time + (duration * 30 * 24 * 60 * 60)
-    c.execute("INSERT INTO subscriptions (user_id, role_id, plan_id, expire_date, created_at) VALUES (?, ?, ?, ?, ?)",
-              (user_id, role_id, plan_id, expire_date, current_time))
-    conn.commit()
-    print(f"[Webhook] 已为用户 {user_id} 发放角色 {role_id}，订单 {trade_no}")
+    # 订阅续期与任务完成同一事务提交，重试或重复执行都不会重复顺延
+    subscription = await fulfillment_queue.complete(trade_no, lambda conn: extend_subscription(
+        conn, guild_id, user_id, role_id, plan_id, duration, current_time))
+    if subscription is None:
+        return
+    sub_id, expire_date = subscription
+    expiry_scheduler.schedule(sub_id, user_id, role_id, expire_date)
+    if previous is not None and previous[0] != sub_id:
+        # 原订阅在此期间过期并被删除，续期写入的是新行，补回可能已被回收的身份组
+        try:
+            await role_workers.submit(
+                guild.id, lambda: member_resolver.add_role(guild.id, user_id, role_id, reason=f"订单 {trade_no}"),
+                "add_role")
+        except Exception as e:
+            logger.warning(f"补回身份组失败，等待身份组对账处理: {e}",
+                           extra={"event": "fulfillment.regrant_failed", "order_id": trade_no, "user_id": user_id,
+                                  "role_id": role_id})
+    logger.info("已发放身份组", extra={"event": "fulfillment.granted", "order_id": trade_no, "guild_id": guild_id,
+                                       "user_id": user_id, "role_id": role_id, "expire_date": expire_date})
 
 def load_config(path: Optional[str] = None) -> dict:
     """从配置文件加载设置，默认读取 config.json，可通过环境变量 BOT_CONFIG_PATH 覆盖。"""
@@ -210,7 +288,6 @@ def load_config(path: Optional[str] = None) -> dict:
     if payment_platform == "yipay":
         required_keys = [
             "token",
-            "guild_id",
             "yipay_url",
             "yipay_pid",
             "yipay_key",
@@ -219,7 +296,6 @@ def load_config(path: Optional[str] = None) -> dict:
     elif payment_platform == "epusdt":
         required_keys = [
             "token",
-            "guild_id",
             "epusdt_url",
             "epusdt_token",
             "payment_methods"
@@ -228,9 +304,22 @@ def load_config(path: Optional[str] = None) -> dict:
         raise ValueError(f"不支持的支付平台: {payment_platform}")
 
     missing = [k for k in required_keys if k not in config]
+    # 单服务器配置 guild_id，多服务器配置 guild_ids
+    if "guild_id" not in config and not config.get("guild_ids"):
+        missing.append("guild_id")
     if missing:
         raise ValueError(f"配置文件缺少必填字段: {', '.join(missing)}")
 
+    # 指定 shard_ids 时必须同时给出 shard_count，否则非 bot 进程会把自己当作负责全部分片
+    sharding = config.get("sharding", {})
+    if sharding.get("enabled") and sharding.get("shard_ids") is not None:
+        shard_count = sharding.get("shard_count")
+        if not shard_count:
+            raise ValueError("sharding.shard_ids 需要同时配置 sharding.shard_count")
+        invalid = [shard_id for shard_id in sharding["shard_ids"] if not 0 <= shard_id < shard_count]
+        if invalid:
+            raise ValueError(f"sharding.shard_ids 超出范围 (0 ~ {shard_count - 1}): {invalid}")
+
     # 标准化 URL，确保以 / 结尾
     if payment_platform == "yipay":
         yipay_url = config.get("yipay_url", "")
@@ -248,8 +337,23 @@ def load_config(path: Optional[str] = None) -> dict:
 
 CONFIG = load_config()
 
+# 结构化日志：记录先进入内存队列，由后台线程格式化为 JSON Lines 并写出
+LOGGING_CONFIG = CONFIG.get("logging", {})
+log_listener = setup_logging(
+    level=LOGGING_CONFIG.get("level", "INFO"),
+    fmt=LOGGING_CONFIG.get("format", "json"),
+    path=LOGGING_CONFIG.get("file"),
+    sample=LOGGING_CONFIG.get("sample"),
+)
+logger = logging.getLogger("bot")
+webhook_logger = logging.getLogger("webhook")
+
 TOKEN = CONFIG["token"]
-GUILD_ID = CONFIG["guild_id"]
+# 注册管理命令的服务器；global_commands 为 true 时注册为全局命令，机器人加入的任何服务器都可使用
+GUILD_IDS = CONFIG.get("guild_ids") or [CONFIG["guild_id"]]
+GUILD_ID = CONFIG.get("guild_id", GUILD_IDS[0])  # 升级到多服务器结构时旧数据归属的服务器
+COMMAND_GUILD_IDS = None if CONFIG.get("global_commands", False) else GUILD_IDS
+SHARDING_CONFIG = CONFIG.get("sharding", {})
 PAYMENT_PLATFORM = CONFIG.get("payment_platform", "epusdt")
 ENABLE_PRIVILEGED_INTENTS = CONFIG.get("enable_privileged_intents", False)
 DEFAULT_CURRENCY = CONFIG.get("default_currency", "USDT").upper()
@@ -257,6 +361,10 @@ DEFAULT_CURRENCY = CONFIG.get("default_currency", "USDT").upper()
 # 使用配置重新创建bot
 create_bot()
 
+# 本进程负责的分片：发放、到期等后台任务只处理这些分片上的服务器
+shard_scope = ShardScope(SHARDING_CONFIG.get("shard_count"), SHARDING_CONFIG.get("shard_ids")) \
+    if SHARDING_CONFIG.get("enabled") else ShardScope()
+
 # 支付平台配置
 if PAYMENT_PLATFORM == "yipay":
     YIPAY_URL = CONFIG["yipay_url"]
@@ -300,50 +408,122 @@ def normalize_notify_url(raw: str) -> str:
 
 NOTIFY_URL = normalize_notify_url(RAW_NOTIFY_URL)
 
+# 订单号生成器；未配置 node_id 时，bot 进程启动时从数据库租用空闲的节点号（见 allocate_node_id），
+# 多台机器使用各自的数据库时须为每个实例配置不同的 node_id（0~9999）
+order_ids = OrderIdGenerator(CONFIG.get("node_id"))
+node_lease: Optional[Lease] = None
+
+# 支付网关 HTTP 连接池（on_ready 时创建，关闭 bot 时释放）
+GATEWAY_HTTP = CONFIG.get("gateway_http", {})
+gateway_client = GatewayClient(
+    limit=GATEWAY_HTTP.get("limit", 100),
+    limit_per_host=GATEWAY_HTTP.get("limit_per_host", 30),
+    dns_ttl=GATEWAY_HTTP.get("dns_ttl", 300),
+    keepalive_timeout=GATEWAY_HTTP.get("keepalive_timeout", 60),
+    timeout=GATEWAY_HTTP.get("timeout", 15),
+    connect_timeout=GATEWAY_HTTP.get("connect_timeout", 5),
+)
+
 # ================= 数据库初始化 =================
-conn = sqlite3.connect(DB_PATH)
-c = conn.cursor()
-
-# 创建套餐表
-c.execute('''CREATE TABLE IF NOT EXISTS plans
-             (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              name TEXT,
-              price REAL,
-              currency TEXT DEFAULT 'USDT',
-              role_id INTEGER,
-              duration_months INTEGER)''') # duration_months: -1 代表永久, currency: 'USDT' 或 'CNY'
-
-# 创建订单表
-c.execute('''CREATE TABLE IF NOT EXISTS orders
-             (order_id TEXT PRIMARY KEY,
-              user_id INTEGER,
-              plan_id INTEGER,
-              status TEXT,
-              created_at INTEGER)''')
-
-# 创建订阅表（用于到期管理）
-c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
-             (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              user_id INTEGER,
-              role_id INTEGER,
-              plan_id INTEGER,
-              expire_date INTEGER,
-              created_at INTEGER)''') # expire_date: -1 代表永久
-
-conn.commit()
-
-# 数据库迁移：为plans表添加currency字段
-try:
-    # 检查currency字段是否存在
-    c.execute("PRAGMA table_info(plans)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'currency' not in columns:
-        print("🔄 正在为plans表添加currency字段...")
-        c.execute("ALTER TABLE plans ADD COLUMN currency TEXT DEFAULT 'USDT'")
-        conn.commit()
-        print("✅ 数据库迁移完成")
-except Exception as e:
-    print(f"⚠️ 数据库迁移检查失败: {e}")
+# 所有数据库访问都经由 db 在专用线程中执行，不阻塞事件循环；
+# 写入按 db_batch_window_ms 毫秒窗口合并提交，每次写入在提交后才返回
+db = Storage(
+    DB_PATH,
+    batch_window=CONFIG.get("db_batch_window_ms", 2) / 1000,
+    max_batch=CONFIG.get("db_max_batch", 256),
+)
+db.open(lambda conn: migrate(conn, default_guild_id=GUILD_ID))
+
+# ================= 多进程部署 =================
+# python main.py [all|bot|webhook]
+#   all      单进程运行 Discord 连接、webhook 服务器与后台任务（默认）
+#   bot      Discord 连接与后台任务，不监听回调端口
+#   webhook  只运行回调服务器，可启动多个进程共享同一端口（SO_REUSEPORT），
+#            回调事件写入共享数据库的收件箱，由主节点消费
+# 后台任务（收件箱消费、发放、到期、归档、对账）只在持有 workers 租约的 bot/all 进程中运行；
+# 配置 sharding.shard_ids 时，发放与到期只处理本进程分片的服务器，全局任务由 0 号分片所在进程运行；
+# 其余 bot 进程待命，不连接 Discord，主节点退出或失联后自动接管
+DEPLOYMENT_CONFIG = CONFIG.get("deployment", {})
+PROCESS_ROLES = ("all", "bot", "webhook")
+PROCESS_ROLE = "all"
+# 分片部署时每组分片各自选出主节点
+worker_lease = Lease(
+    db,
+    "workers" if shard_scope.everything else f"workers:{shard_scope.name}",
+    ttl=DEPLOYMENT_CONFIG.get("lease_ttl", 30),
+    retry_interval=DEPLOYMENT_CONFIG.get("standby_retry", 5),
+)
+
+# 套餐目录缓存：首次使用时加载，仅在 /set_plan、/delete_plan 后重建
+plan_catalog = PlanCatalog(db)
+
+# ================= 监控指标 =================
+# 由 webhook 服务器的 /metrics 路由以 Prometheus 文本格式输出
+METRICS_CONFIG = CONFIG.get("metrics", {})
+metrics = Registry(prefix="premium_bot_")
+gateway_latency = metrics.histogram(
+    "gateway_create_order_seconds", "支付网关下单耗时", ("platform", "pay_type", "result"))
+webhook_latency = metrics.histogram(
+    "webhook_request_seconds", "支付回调处理耗时（含验签与落盘）", ("platform", "status"))
+db_commit_latency = metrics.histogram("db_commit_seconds", "数据库批量提交耗时")
+db_batch_size = metrics.histogram(
+    "db_commit_batch_size", "每次提交合并的写入数", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+role_latency = metrics.histogram(
+    "role_operation_seconds", "身份组添加/移除耗时（含重试）", ("operation", "result"))
+loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "事件循环调度滞后", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+order_events = metrics.counter("orders_total", "订单事件数（created/paid/fulfilled/failed）", ("platform", "pay_type", "event"))
+loop_lag_monitor = LoopLagMonitor(loop_lag)
+loop_stalls = metrics.counter("event_loop_stalls_total", "事件循环卡顿次数（需开启 profiler）", ("coroutine",))
+
+# ================= 性能分析 =================
+# profiler.enabled 开启卡顿看门狗；按需采样通过 /profile 命令或带 token 的 /debug/profile 路由触发
+PROFILER_CONFIG = CONFIG.get("profiler", {})
+stack_sampler = StackSampler()
+stall_watchdog = StallWatchdog(
+    threshold=PROFILER_CONFIG.get("slow_threshold_ms", 100) / 1000,
+    on_stall=lambda duration, coroutines, top: loop_stalls.inc(coroutine=coroutines[-1] if coroutines else "unknown"),
+)
+MAX_PROFILE_SECONDS = 60
+
+metrics.gauge("checkout_inflight", "正在进行的网关下单数",
+              lambda: {(): checkout_admission.inflight})
+metrics.gauge("checkout_queued", "排队等待网关名额的下单数",
+              lambda: {(): checkout_admission.queued})
+metrics.callback_counter("checkout_rejected_total", "被准入控制拒绝的下单数",
+              lambda: {("rate",): checkout_admission.rejected_rate, ("busy",): checkout_admission.rejected_busy},
+              labelnames=("reason",))
+metrics.gauge("role_queue_depth", "排队中的身份组操作数",
+              lambda: {(): role_workers.stats()["queue_depth"]})
+metrics.callback_counter("member_lookups_total", "成员解析次数（按结果来源）",
+              lambda: {("cache",): member_resolver.hits["cache"], ("lru",): member_resolver.hits["lru"],
+                       ("gateway",): member_resolver.fetched["gateway"], ("rest",): member_resolver.fetched["rest"],
+                       ("missing",): member_resolver.missing},
+              labelnames=("source",))
+metrics.callback_counter("role_reconcile_changes_total", "身份组对账补发/回收/失败次数",
+              lambda: {("add",): role_reconciler.added, ("remove",): role_reconciler.removed,
+                       ("failed",): role_reconciler.failed},
+              labelnames=("action",))
+
+def observe_db_commit(seconds, batch_size):
+    db_commit_latency.observe(seconds)
+    db_batch_size.observe(batch_size)
+
+db.on_commit = observe_db_commit
+
+async def count_order_events(event: str, order_ids):
+    """按订单的支付方式累计订单事件"""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    rows = await db.fetchall(
+        f"SELECT COALESCE(pay_type, 'unknown') FROM orders WHERE order_id IN ({','.join('?' * len(order_ids))})",
+        order_ids)
+    for (pay_type,) in rows:
+        order_events.inc(platform=PAYMENT_PLATFORM, pay_type=pay_type, event=event)
+
+def track_order_events(event: str, order_ids):
+    asyncio.get_running_loop().create_task(count_order_events(event, order_ids))
 
 # ================= 支付工具类 =================
 class YiPay:
@@ -417,21 +597,19 @@ class YiPay:
 
         # 调用易支付API
         api_url = urllib.parse.urljoin(YIPAY_URL, "mapi.php")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, data=payload, timeout=15) as resp:
-                data = await resp.json(content_type=None)
-                if data.get("code") != 1:
-                    raise RuntimeError(f"易支付下单失败: {data}")
-
-                # 返回支付链接
-                if "payurl" in data:
-                    return data["payurl"]
-                elif "qrcode" in data:
-                    return data["qrcode"]
-                elif "urlscheme" in data:
-                    return data["urlscheme"]
-                else:
-                    raise RuntimeError(f"易支付未返回支付链接: {data}")
+        data = await gateway_client.post_json(api_url, data=payload)
+        if data.get("code") != 1:
+            raise RuntimeError(f"易支付下单失败: {data}")
+
+        # 返回支付链接
+        if "payurl" in data:
+            return data["payurl"]
+        elif "qrcode" in data:
+            return data["qrcode"]
+        elif "urlscheme" in data:
+            return data["urlscheme"]
+        else:
+            raise RuntimeError(f"易支付未返回支付链接: {data}")
 
     @staticmethod
     async def _create_epusdt_order(trade_no, name, money, type_code):
@@ -455,20 +633,40 @@ class YiPay:
         payload["signature"] = YiPay.generate_sign_epusdt(payload, EPUSDT_TOKEN)
 
         api_url = urllib.parse.urljoin(EPUSDT_URL, "api/v1/order/create-transaction")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, json=payload, timeout=15) as resp:
-                data = await resp.json(content_type=None)
-                if data.get("status_code") != 200 or "data" not in data:
-                    raise RuntimeError(f"Epusdt 下单失败: {data}")
-                payment_url = data["data"].get("payment_url")
-                if not payment_url:
-                    raise RuntimeError(f"Epusdt 未返回支付链接: {data}")
-                return payment_url
+        data = await gateway_client.post_json(api_url, json=payload)
+        if data.get("status_code") != 200 or "data" not in data:
+            raise RuntimeError(f"Epusdt 下单失败: {data}")
+        payment_url = data["data"].get("payment_url")
+        if not payment_url:
+            raise RuntimeError(f"Epusdt 未返回支付链接: {data}")
+        # Epusdt 只能按自己的 trade_id 查询订单状态，记录下来供对账使用
+        gateway_trade_id = data["data"].get("trade_id")
+        if gateway_trade_id:
+            await db.execute("UPDATE orders SET gateway_trade_id = ? WHERE order_id = ?", (gateway_trade_id, trade_no))
+        return payment_url
 
     @staticmethod
-    async def check_order_status(trade_no):
-        """检查订单状态（用于兼容性）"""
-        return True
+    async def check_order_status(trade_no, gateway_trade_id=None):
+        """向支付平台查询订单是否已支付，返回 (是否已支付, 平台响应)；无法查询时返回 None"""
+        if PAYMENT_PLATFORM == "yipay":
+            api_url = urllib.parse.urljoin(YIPAY_URL, "api.php")
+            data = await gateway_client.get_json(api_url, params={
+                "act": "order",
+                "pid": YIPAY_PID,
+                "key": YIPAY_KEY,
+                "out_trade_no": trade_no,
+            })
+            # code=1 表示查询成功，status=1 表示已支付；订单不存在时 code 非 1
+            return data.get("code") == 1 and str(data.get("status")) == "1", data
+        elif PAYMENT_PLATFORM == "epusdt":
+            if not gateway_trade_id:
+                return None
+            api_url = urllib.parse.urljoin(EPUSDT_URL, f"pay/check-status/{gateway_trade_id}")
+            data = await gateway_client.get_json(api_url)
+            # status: 1 等待支付, 2 支付成功, 3 已过期
+            status = (data.get("data") or {}).get("status")
+            return str(status) == "2", data
+        return None
 
 
 # ================= Webhook 监听（异步回调） =================
@@ -479,30 +677,27 @@ async def handle_notify(request: web.Request):
         if not data:  # 如果POST为空，尝试GET
             data = dict(request.query)
 
-        print(f"[Webhook] 📨 收到回调请求: {request.method} {request.path}")
-        print(f"[Webhook] 📋 参数: {data}")
+        webhook_logger.info("收到回调请求", extra={"event": "webhook.received", "method": request.method,
+                                                   "path": request.path, "params": data})
 
         if PAYMENT_PLATFORM == "yipay":
             # 易支付回调验证
             signature = data.get("sign")
             local_sign = YiPay.generate_sign_yipay(data, YIPAY_KEY)
-            print(f"[Webhook] 🔐 签名验证: 收到={signature}, 本地={local_sign}")
 
             if signature != local_sign:
-                print(f"[Webhook] ❌ 签名验证失败")
+                webhook_logger.warning("回调签名验证失败", extra={"event": "webhook.bad_signature", "platform": "yipay",
+                                                              "order_id": data.get("out_trade_no")})
                 return web.Response(text="fail", status=403)
 
-            print(f"[Webhook] ✅ 签名验证成功")
-
             # trade_status == "TRADE_SUCCESS" 表示支付成功
             if data.get("trade_status") == "TRADE_SUCCESS":
                 trade_no = data.get("out_trade_no")  # 商户订单号
                 if trade_no:
-                    c.execute("UPDATE orders SET status = 'paid' WHERE order_id = ?", (trade_no,))
-                    conn.commit()
-                    print(f"[Webhook] 💰 易支付订单 {trade_no} 支付成功")
-                    # 异步发放身份组
-                    bot.loop.create_task(fulfill_order(trade_no))
+                    # 事件写入收件箱落盘后立即回复 success，订单更新与发放由后台消费者完成
+                    await webhook_inbox.append("yipay", trade_no, data)
+                    webhook_logger.info("订单支付成功", extra={"event": "webhook.paid", "platform": "yipay",
+                                                             "order_id": trade_no})
             return web.Response(text="success")
 
         elif PAYMENT_PLATFORM == "epusdt":
@@ -511,28 +706,58 @@ async def handle_notify(request: web.Request):
             signature = data.get("signature")
             local_sign = YiPay.generate_sign_epusdt(data, EPUSDT_TOKEN)
             if signature != local_sign:
+                webhook_logger.warning("回调签名验证失败", extra={"event": "webhook.bad_signature", "platform": "epusdt",
+                                                              "order_id": data.get("order_id")})
                 return web.Response(text="fail", status=403)
 
             # status == 2 表示支付成功
             if str(data.get("status")) == "2":
                 trade_no = data.get("order_id")
                 if trade_no:
-                    c.execute("UPDATE orders SET status = 'paid' WHERE order_id = ?", (trade_no,))
-                    conn.commit()
-                    print(f"[Webhook] Epusdt订单 {trade_no} 支付成功")
-                    # 异步发放身份组
-                    bot.loop.create_task(fulfill_order(trade_no))
+                    await webhook_inbox.append("epusdt", trade_no, data)
+                    webhook_logger.info("订单支付成功", extra={"event": "webhook.paid", "platform": "epusdt",
+                                                             "order_id": trade_no})
             return web.Response(text="ok")
 
         else:
             return web.Response(text="unsupported platform", status=400)
 
     except Exception as e:
-        print(f"[Webhook] Error: {e}")
+        webhook_logger.exception("处理回调出错", extra={"event": "webhook.error"})
         return web.Response(text="error", status=500)
 
 
-async def start_web_server():
+async def timed_notify(request: web.Request):
+    started = time.perf_counter()
+    response = await handle_notify(request)
+    webhook_latency.observe(time.perf_counter() - started, platform=PAYMENT_PLATFORM, status=str(response.status))
+    return response
+
+def token_matches(request: web.Request, token: str) -> bool:
+    """校验 ?token= 或 Authorization: Bearer 携带的令牌；按字节比较，非 ASCII 输入不会引发异常"""
+    supplied = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+    return bool(token) and hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8"))
+
+async def handle_metrics(request: web.Request):
+    # webhook 端口通常对公网开放，必须携带 token（未配置 token 时不注册该路由）
+    if not token_matches(request, METRICS_CONFIG.get("token", "")):
+        return web.Response(text="forbidden", status=403)
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+async def handle_profile(request: web.Request):
+    if not token_matches(request, PROFILER_CONFIG.get("token", "")):
+        return web.Response(text="forbidden", status=403)
+    try:
+        seconds = min(float(request.query.get("seconds", 10)), MAX_PROFILE_SECONDS)
+    except ValueError:
+        return web.Response(text="invalid seconds", status=400)
+    summary, folded_stacks = await stack_sampler.profile(seconds)
+    # format=folded 时返回折叠栈，可直接交给 flamegraph.pl / speedscope
+    body = folded_stacks if request.query.get("format") == "folded" else summary
+    return web.Response(text=body + "\n", content_type="text/plain", charset="utf-8")
+
+async def start_web_server(reuse_port: bool = False):
     global web_runner, web_site
     if web_runner:
         return
@@ -542,13 +767,21 @@ async def start_web_server():
     if notify_path == "/":
         notify_path = "/notify"
     # 易支付使用GET回调，彩虹易支付使用POST回调
-    app.router.add_get(notify_path, handle_notify)
-    app.router.add_post(notify_path, handle_notify)
-    web_runner = web.AppRunner(app)
+    app.router.add_get(notify_path, timed_notify)
+    app.router.add_post(notify_path, timed_notify)
+    if METRICS_CONFIG.get("enabled", False):
+        if METRICS_CONFIG.get("token"):
+            app.router.add_get(METRICS_CONFIG.get("path", "/metrics"), handle_metrics)
+        else:
+            logger.warning("metrics.enabled 已开启但未配置 metrics.token，/metrics 路由未注册")
+    if PROFILER_CONFIG.get("token"):
+        app.router.add_get("/debug/profile", handle_profile)
+    # 访问日志会原样记录带签名的查询串，关闭；回调耗时见 /metrics
+    web_runner = web.AppRunner(app, access_log=None)
     await web_runner.setup()
-    web_site = web.TCPSite(web_runner, "0.0.0.0", WEBHOOK_PORT)
+    web_site = web.TCPSite(web_runner, "0.0.0.0", WEBHOOK_PORT, reuse_port=reuse_port or None)
     await web_site.start()
-    print(f"🌍 Webhook Server running on 0.0.0.0:{WEBHOOK_PORT} path={notify_path}")
+    logger.info("Webhook 服务器已启动", extra={"event": "webhook.started", "port": WEBHOOK_PORT, "path": notify_path})
 
 # ================= Discord Bot 设置 =================
 # Bot和intents已在导入部分兼容性处理
@@ -557,6 +790,166 @@ async def start_web_server():
 web_runner: Optional[web.AppRunner] = None
 web_site: Optional[web.TCPSite] = None
 
+async def shutdown_resources():
+    """关闭 webhook 服务器、后台调度与网关连接池，并等待排队中的数据库写入提交"""
+    global web_runner, web_site
+    if web_runner:
+        await web_runner.cleanup()
+        web_runner = None
+        web_site = None
+    expiry_scheduler.stop()
+    role_reconciler.stop()
+    order_lifecycle.stop()
+    order_reconciler.stop()
+    panel_registry.stop()
+    webhook_inbox.stop()
+    # 先等待执行中的发放任务结束（它们依赖身份组工作池），再释放租约，避免接管进程重复发放
+    await fulfillment_queue.stop(FULFILLMENT_CONFIG.get("shutdown_timeout", 10))
+    await role_workers.stop()
+    loop_lag_monitor.stop()
+    stall_watchdog.stop()
+    await gateway_client.close()
+    # 待命进程可以立即接管，不必等租约过期
+    await worker_lease.release()
+    if node_lease is not None:
+        await node_lease.release()
+    await db.drain()
+
+# bot.close() 在正常退出和 Ctrl+C 时都会被调用，借此释放长连接资源
+_bot_close = bot.close
+
+async def close_bot():
+    await shutdown_resources()
+    await _bot_close()
+
+bot.close = close_bot
+
+async def allocate_node_id():
+    """未配置 node_id 时租用一个空闲节点号，共享数据库的进程生成的订单号互不冲突；失去租约时退出"""
+    global order_ids, node_lease
+    if CONFIG.get("node_id") is not None:
+        return
+    start = default_node_id()
+    names = [f"node:{(start + offset) % (MAX_NODE_ID + 1)}" for offset in range(MAX_NODE_ID + 1)]
+    node_lease = await claim_first_free(db, names, ttl=DEPLOYMENT_CONFIG.get("node_lease_ttl", 300))
+    if node_lease is None:
+        raise RuntimeError("没有空闲的节点号，请在配置中指定 node_id")
+    node_lease.on_lost = lambda: bot.loop.create_task(bot.close())
+    node_lease.start()
+    order_ids = OrderIdGenerator(int(node_lease.name.split(":", 1)[1]))
+    logger.info(f"已分配订单号节点 {order_ids.node_id}", extra={"event": "node.allocated", "node_id": order_ids.node_id})
+
+async def acquire_worker_lease():
+    """等待成为主节点并开始续约；失去租约时退出，交由进程管理器重启为待命进程"""
+    await worker_lease.acquire()
+    worker_lease.on_lost = lambda: bot.loop.create_task(bot.close())
+    worker_lease.start()
+    # 只有主节点会创建订单
+    await allocate_node_id()
+
+async def serve_webhook():
+    """webhook 角色：只运行回调服务器，直到收到退出信号"""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopped.set)
+        except NotImplementedError:
+            pass
+    await start_web_server(reuse_port=DEPLOYMENT_CONFIG.get("reuse_port", True))
+    loop_lag_monitor.start()
+    if PROFILER_CONFIG.get("enabled", False):
+        stall_watchdog.start()
+    try:
+        await stopped.wait()
+    finally:
+        await shutdown_resources()
+
+# ================= 结账 =================
+
+# 人民币支付通道，USDT 定价的套餐走这些通道时需换算为 CNY
+CNY_PAY_TYPES = ('alipay', 'wxpay', 'qqpay')
+
+# 结账链接复用：同一用户/套餐/支付方式在有效期内复用未支付的订单与支付链接
+checkout_cache = CheckoutCache(ttl=CONFIG.get("checkout_reuse_ttl", 300))
+
+# 下单准入控制：单用户限频 + 全局网关并发上限（超出时短暂排队，队列满则直接提示繁忙）
+ADMISSION_CONFIG = CONFIG.get("checkout_admission", {})
+checkout_admission = AdmissionController(
+    user_rate=ADMISSION_CONFIG.get("user_rate", 0.2),
+    user_burst=ADMISSION_CONFIG.get("user_burst", 5),
+    max_inflight=ADMISSION_CONFIG.get("max_inflight", 16),
+    max_queue=ADMISSION_CONFIG.get("max_queue", 64),
+    queue_timeout=ADMISSION_CONFIG.get("queue_timeout", 5.0),
+)
+
+def compute_payment_amount(price, currency: str, type_code: str):
+    """根据套餐货币单位和支付方式决定传递给支付平台的金额，返回 (金额, 显示货币)"""
+    if currency == 'CNY':
+        # 套餐是CNY定价，直接使用价格
+        return round(float(price), 2), "CNY"
+    # 套餐是USDT定价，需要根据支付方式转换
+    if type_code in CNY_PAY_TYPES:
+        # 人民币支付：转换USDT到CNY
+        return round(float(price) * float(USDT_TO_CNY_RATE), 2), "CNY"
+    # USDT支付：直接使用USDT金额
+    return round(float(price), 2), "USDT"
+
+async def create_checkout(guild_id: int, user_id: int, plan, type_code: str):
+    """创建（或复用）待支付订单与支付链接，返回 (CheckoutLink, 是否复用)"""
+    plan_id, plan_name, price, currency, _, _ = plan
+    # 价格与货币纳入 key，套餐改价后旧链接自然失效
+    key = (user_id, plan_id, price, currency, type_code)
+
+    async def create():
+        # 复用的链接不占用名额，只有真正访问网关的下单才受全局并发限制
+        async with checkout_admission.gateway_slot():
+            # 生成订单号并存入数据库
+            trade_no = build_trade_no()
+            await insert_order(trade_no, guild_id, user_id, plan_id, pay_type=type_code)
+            payment_amount, display_currency = compute_payment_amount(price, currency, type_code)
+            # 获取支付链接
+            started = time.perf_counter()
+            result = "error"
+            try:
+                pay_url = await YiPay.create_order(trade_no, f"Plan-{plan_name}", payment_amount, type_code)
+                result = "ok"
+            finally:
+                gateway_latency.observe(time.perf_counter() - started,
+                                        platform=PAYMENT_PLATFORM, pay_type=type_code, result=result)
+        order_events.inc(platform=PAYMENT_PLATFORM, pay_type=type_code, event="created")
+        return CheckoutLink(trade_no, pay_url, payment_amount, display_currency, time.monotonic())
+
+    async def still_pending(link: CheckoutLink) -> bool:
+        row = await db.fetchone("SELECT status FROM orders WHERE order_id = ?", (link.trade_no,))
+        return bool(row) and row[0] == 'pending'
+
+    return await checkout_cache.get_or_create(key, create, still_pending)
+
+async def send_checkout(interaction, plan, network_name: str, type_code: str, network_label: str = "支付方式"):
+    """为交互用户下单并以临时消息发送支付链接（调用前须已 defer）"""
+    try:
+        checkout_admission.check_user(interaction.user.id)
+        link, reused = await create_checkout(interaction.guild_id, interaction.user.id, plan, type_code)
+    except AdmissionRejected as e:
+        if e.reason == "rate":
+            message = f"⏳ 操作过于频繁，请 {max(1, round(e.retry_after))} 秒后再试。"
+        else:
+            message = "⏳ 当前下单人数较多，请稍后再试。"
+        await interaction.followup.send(message, ephemeral=True)
+        return
+
+    embed = discord.Embed(title="💳 订单已创建", description=f"请点击下方链接支付 **{link.payment_amount} {link.display_currency}**", color=0xF6C344)
+    embed.add_field(name="套餐", value=plan[1], inline=True)
+    embed.add_field(name=network_label, value=network_name, inline=True)
+    embed.add_field(name="🔗 支付链接", value=f"[👉 点击前往支付]({link.pay_url})", inline=False)
+    if reused:
+        embed.set_footer(text='已为你保留尚未支付的订单，支付完成后，系统会自动开通会员')
+    else:
+        embed.set_footer(text='支付完成后，系统会自动开通会员')
+
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
 # ================= UI 交互视图 =================
 
 class PaymentVerifyView(ui.View):
@@ -570,7 +963,7 @@ class PaymentVerifyView(ui.View):
     # 保留类以兼容旧代码，但不添加按钮
 
 class NetworkSelect(ui.Select):
-    def __init__(self, view, plan_info=None):
+    def __init__(self, view, plan_info=None, guild_id=None):
         # plan_info: (id, name, price, role_id, duration) or None before plan chosen
         self.plan_info = plan_info
         self.code_to_name = {v: k for k, v in PAYMENT_METHODS.items()}
@@ -588,19 +981,20 @@ class NetworkSelect(ui.Select):
             min_values=1,
             max_values=1,
             options=options,
-            custom_id="network_select"
+            # 持久化视图按服务器区分 custom_id，各服务器的面板互不覆盖
+            custom_id="network_select" if guild_id is None else f"network_select:{guild_id}"
         )
         self.parent_view = view
 
     async def callback(self, interaction: discord.Interaction):
-        if not self.parent_view.selected_plan:
+        plan_info = self.plan_info or self.parent_view.selected_plan(interaction.user.id)
+        if not plan_info:
             await interaction.response.send_message("请先选择套餐，再选择支付网络。", ephemeral=True)
             return
 
         # 先defer响应，避免超时
         await interaction.response.defer(ephemeral=True)
 
-        self.plan_info = self.parent_view.selected_plan
         type_code = self.values[0]
         network_name = self.code_to_name.get(type_code, type_code)
         await self.parent_view.generate_payment(interaction, network_name, type_code)
@@ -612,51 +1006,15 @@ class NetworkSelectView(ui.View):
         self.plan_info = plan_info # (id, name, price, role_id, duration)
         self.add_item(NetworkSelect(self, plan_info))
 
+    def selected_plan(self, user_id):
+        return self.plan_info
+
     async def generate_payment(self, interaction, network_name, type_code):
-        user_id = interaction.user.id
-        plan_id, plan_name, price, currency, _, _ = self.plan_info
-
-        # 生成订单号
-        trade_no = build_trade_no(user_id)
-
-        # 存入数据库
-        c.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?)",
-                  (trade_no, user_id, plan_id, 'pending', int(time.time())))
-        conn.commit()
-
-        # 根据套餐货币单位和支付方式决定传递给支付平台的金额
-        if currency == 'CNY':
-            # 套餐是CNY定价，直接使用价格
-            payment_amount = round(float(price), 2)
-            display_currency = "CNY"
-            display_price = payment_amount
-        else:  # USDT
-            # 套餐是USDT定价，需要根据支付方式转换
-            if type_code in ['alipay', 'wxpay', 'qqpay']:
-                # 人民币支付：转换USDT到CNY
-                payment_amount = round(float(price) * float(USDT_TO_CNY_RATE), 2)
-                display_currency = "CNY"
-                display_price = payment_amount
-            else:
-                # USDT支付：直接使用USDT金额
-                payment_amount = round(float(price), 2)
-                display_currency = "USDT"
-                display_price = payment_amount
-
-        # 获取支付链接
-        pay_url = await YiPay.create_order(trade_no, f"Plan-{plan_name}", payment_amount, type_code)
-        
-        embed = discord.Embed(title="💳 订单已创建", description=f"请点击下方链接支付 **{display_price} {display_currency}**", color=0xF6C344)
-        embed.add_field(name="套餐", value=plan_name, inline=True)
-        embed.add_field(name="网络", value=network_name, inline=True)
-        embed.add_field(name="🔗 支付链接", value=f"[👉 点击前往支付]({pay_url})", inline=False)
-        embed.set_footer(text='支付完成后，系统会自动开通会员')
-        
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await send_checkout(interaction, self.plan_info, network_name, type_code, network_label="网络")
 
 
 class PlanSelect(ui.Select):
-    def __init__(self, view, plans):
+    def __init__(self, view, plans, guild_id=None):
         # plans: list of (id, name, price, currency, role_id, duration)
         self.plan_map = {str(p[0]): p for p in plans}
         options = []
@@ -713,7 +1071,7 @@ class PlanSelect(ui.Select):
             min_values=1,
             max_values=1,
             options=options,
-            custom_id="plan_select"
+            custom_id="plan_select" if guild_id is None else f"plan_select:{guild_id}"
         )
         self.parent_view = view
 
@@ -723,28 +1081,41 @@ class PlanSelect(ui.Select):
         if not plan:
             await interaction.response.send_message("❌ 未找到该套餐，请重试。", ephemeral=True)
             return
-        self.parent_view.selected_plan = plan
-        # 启用网络选择并更新消息
-        if hasattr(self.parent_view, "network_select"):
-            self.parent_view.network_select.disabled = False
-            self.parent_view.network_select.placeholder = "选择支付网络"
-            self.parent_view.network_select.plan_info = plan
-        # 高亮已选套餐
-        for opt in self.options:
-            opt.default = (opt.value == selected_id)
-        self.placeholder = f"已选：{plan[1]}"
-        await interaction.response.edit_message(content=f"已选择套餐：**{plan[1]}**，请继续选择支付网络。", view=self.parent_view)
+        # 面板由所有用户共享，选择只记在该用户名下，不修改面板本身
+        self.parent_view.select_plan(interaction.user.id, plan)
+        await interaction.response.send_message(f"已选择套餐：**{plan[1]}**，请继续选择支付网络。", ephemeral=True)
 
 
+# 用户在充值面板上选择的套餐：(guild_id, user_id) -> Plan。放在模块级而不是视图实例上：
+# 套餐变更后面板会以相同 custom_id 注册新的视图，刷新前做出的选择仍然有效
+MAX_PANEL_SELECTIONS = 10000
+panel_selections: "OrderedDict[tuple, tuple]" = OrderedDict()
+
 class PlanAndNetworkView(ui.View):
-    def __init__(self):
-        super().__init__(timeout=None)
-        self.selected_plan = None
-        self.reload_selects()
+    """充值面板的持久化视图；同一份套餐快照只构建一次，由所有面板消息共享"""
 
-    def reload_selects(self):
+    def __init__(self, plans, guild_id=None):
+        # plans: 由调用方从该服务器的套餐快照取得，构造视图时不访问数据库
+        super().__init__(timeout=None)
+        self.guild_id = guild_id
+        self.reload_selects(plans)
+
+    def select_plan(self, user_id, plan):
+        key = (self.guild_id, user_id)
+        panel_selections.pop(key, None)
+        panel_selections[key] = plan
+        while len(panel_selections) > MAX_PANEL_SELECTIONS:
+            panel_selections.popitem(last=False)
+
+    def selected_plan(self, user_id):
+        plan = panel_selections.get((self.guild_id, user_id))
+        if plan is None or self.guild_id is None:
+            return plan
+        # 以当前套餐目录为准：选择之后套餐可能已改价或被删除
+        return plan_catalog.snapshot(self.guild_id).get(plan[0])
+
+    def reload_selects(self, plans):
         self.clear_items()
-        plans = fetch_plans()
 
         if not plans:
             # 创建一个有占位符选项的禁用选择器
@@ -758,69 +1129,85 @@ class PlanAndNetworkView(ui.View):
                     )
                 ],
                 disabled=True,
-                custom_id="plan_select_disabled"
+                custom_id="plan_select_disabled" if self.guild_id is None else f"plan_select_disabled:{self.guild_id}"
             )
             self.add_item(disabled_select)
             return
 
-        plan_select = PlanSelect(self, plans)
+        plan_select = PlanSelect(self, plans, self.guild_id)
         self.add_item(plan_select)
 
-        # 网络下拉默认禁用，待选择套餐后启用
-        network_select = NetworkSelect(self, None)
-        network_select.disabled = True
-        network_select.placeholder = "请先选择套餐，再选择支付网络"
+        # 面板被所有用户共享，网络下拉始终可用，回调时按用户查找已选套餐
+        network_select = NetworkSelect(self, None, self.guild_id)
         self.network_select = network_select
         self.add_item(network_select)
 
     async def generate_payment(self, interaction, network_name, type_code):
-        if not self.selected_plan:
-            await interaction.response.send_message("请先选择套餐。", ephemeral=True)
+        plan = self.selected_plan(interaction.user.id)
+        if not plan:
+            await interaction.followup.send("请先选择套餐。", ephemeral=True)
             return
-        user_id = interaction.user.id
-        plan_id, plan_name, price, currency, _, _ = self.selected_plan
-
-        # 生成订单号
-        trade_no = build_trade_no(user_id)
-
-        # 存入数据库
-        c.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?)",
-                  (trade_no, user_id, plan_id, 'pending', int(time.time())))
-        conn.commit()
-
-        # 根据套餐货币单位和支付方式决定传递给支付平台的金额
-        if currency == 'CNY':
-            # 套餐是CNY定价，直接使用价格
-            payment_amount = round(float(price), 2)
-            display_currency = "CNY"
-            display_price = payment_amount
-        else:  # USDT
-            # 套餐是USDT定价，需要根据支付方式转换
-            if type_code in ['alipay', 'wxpay', 'qqpay']:
-                # 人民币支付：转换USDT到CNY
-                payment_amount = round(float(price) * float(USDT_TO_CNY_RATE), 2)
-                display_currency = "CNY"
-                display_price = payment_amount
-            else:
-                # USDT支付：直接使用USDT金额
-                payment_amount = round(float(price), 2)
-                display_currency = "USDT"
-                display_price = payment_amount
-
-        # 获取支付链接
-        pay_url = await YiPay.create_order(trade_no, f"Plan-{plan_name}", payment_amount, type_code)
-
-        embed = discord.Embed(title="💳 订单已创建", description=f"请点击下方链接支付 **{display_price} {display_currency}**", color=0xF6C344)
-        embed.add_field(name="套餐", value=plan_name, inline=True)
-        embed.add_field(name="支付方式", value=network_name, inline=True)
-        embed.add_field(name="🔗 支付链接", value=f"[👉 点击前往支付]({pay_url})", inline=False)
-        embed.set_footer(text='支付完成后，系统会自动开通会员')
+        await send_checkout(interaction, plan, network_name, type_code)
+
+def build_panel_embed(plans) -> discord.Embed:
+    """构建充值面板的主 Embed (价格表)"""
+    embed_main = discord.Embed(
+        title="LEVEL UP YOUR TRADING 🚀",
+        description="选择套餐 → 选择支付方式 → 支付 → 自动开通会员",
+        color=0xF6C344  # 黄色边框
+    )
+
+    # 从套餐快照生成价格表
+    price_text = ""
+    for p in plans:
+        _, name, price, currency, _, duration = p
+        if duration == -1:
+            duration_str = "/永久"
+        elif duration == 1:
+            duration_str = "/月"
+        elif duration == 12:
+            duration_str = "/年"
+        else:
+            duration_str = f"/{duration}个月"
+
+        formatted_price = f"{round(float(price), 2):g}"
+        price_text += f"**{name}**：{formatted_price} {currency}{duration_str}\n"
+
+    if not price_text:
+        price_text = "暂无套餐配置，请使用管理员指令配置。"
+
+    steps_text = "```\n✅ 选套餐 + 支付方式\n💳 点击前往支付\n🔗 完成支付\n🎉 自动开通会员\n```"
+
+    embed_main.add_field(name="💰 会员价格", value=price_text, inline=False)
+    embed_main.add_field(name="📌 开通步骤", value=steps_text, inline=False)
+    embed_main.set_thumbnail(url="https://cdn-icons-png.flaticon.com/512/3135/3135715.png") # 示例图标
+    return embed_main
 
-        await interaction.followup.send(embed=embed, ephemeral=True)
+def render_panel(snapshot):
+    return build_panel_embed(snapshot.plans), PlanAndNetworkView(snapshot.plans, snapshot.guild_id)
+
+async def edit_panel(channel_id, message_id, embed, view):
+    """编辑一条已发布的面板；消息已被删除时返回 False"""
+    message = bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+    try:
+        await message.edit(embed=embed, view=view)
+    except discord.NotFound:
+        return False
+    return True
+
+# 面板登记表：套餐变更后在后台限速更新所有已发布的面板
+PANEL_CONFIG = CONFIG.get("panels", {})
+panel_registry = PanelRegistry(
+    db,
+    render_panel,
+    edit_panel,
+    rate=PANEL_CONFIG.get("edit_rate", 1.0),
+    burst=PANEL_CONFIG.get("edit_burst", 5),
+)
 
 # ================= 斜杠指令 (Admin) =================
 
-@slash_command(guild_ids=[GUILD_ID], description="添加或更新会员套餐")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="添加或更新会员套餐")
 @commands.has_permissions(administrator=True)
 async def set_plan(
     ctx,
@@ -831,8 +1218,6 @@ async def set_plan(
 ):
     # 使用配置文件中的默认货币单位
     currency = DEFAULT_CURRENCY
-    print(f"调试: set_plan - 名称:{name}, 价格:{price}, 货币:{currency}, 时长:{duration}")
-    print(f"调试: 数据库路径: {DB_PATH}")
 
     # 检查价格是否合理
     if currency == 'CNY' and price > 1000:
@@ -843,31 +1228,33 @@ async def set_plan(
         await ctx.respond(f"❌ USDT价格转换后超过1000元！{price} USDT = {cny_equivalent} CNY", ephemeral=True)
         return
 
-    # 检查是否已存在同名套餐，存在则更新，不存在则插入
-    c.execute("SELECT id FROM plans WHERE name = ?", (name,))
-    data = c.fetchone()
-    if data:
-        c.execute("UPDATE plans SET price=?, currency=?, role_id=?, duration_months=? WHERE name=?",
-                  (price, currency, role.id, duration, name))
-        action = "更新"
-    else:
-        c.execute("INSERT INTO plans (name, price, currency, role_id, duration_months) VALUES (?, ?, ?, ?, ?)",
-                  (name, price, currency, role.id, duration))
-        action = "添加"
-    conn.commit()
+    # 检查本服务器是否已存在同名套餐，存在则更新，不存在则插入
+    guild_id = ctx.guild.id
+
+    def upsert_plan(conn):
+        data = conn.execute("SELECT id FROM plans WHERE guild_id = ? AND name = ?", (guild_id, name)).fetchone()
+        if data:
+            conn.execute("UPDATE plans SET price=?, currency=?, role_id=?, duration_months=? WHERE id=?",
+                         (price, currency, role.id, duration, data[0]))
+            return "更新"
+        conn.execute("INSERT INTO plans (guild_id, name, price, currency, role_id, duration_months) VALUES (?, ?, ?, ?, ?, ?)",
+                     (guild_id, name, price, currency, role.id, duration))
+        return "添加"
+
+    action = await db.transaction(upsert_plan)
+    snapshot = await plan_catalog.reload(guild_id)
+    panel_registry.schedule_refresh(snapshot)
 
     # 验证数据是否正确保存
-    c.execute("SELECT id, name, price, currency, duration_months FROM plans WHERE name = ?", (name,))
-    saved_data = c.fetchone()
-    if saved_data:
-        print(f"调试: 数据验证成功 - 保存的数据: {saved_data}")
-    else:
-        print(f"调试: 数据验证失败 - 没有找到保存的数据")
+    saved_data = snapshot.find(name)
+    if not saved_data:
+        logger.warning("套餐保存后未在目录中找到", extra={"event": "plan.missing", "plan": name})
 
-    print(f"调试: {action}套餐成功 - {name}: {price} {currency}")
+    logger.info(f"{action}套餐", extra={"event": "plan.saved", "guild_id": guild_id, "plan": name, "price": price,
+                                      "currency": currency, "duration": duration})
     await ctx.respond(f"✅ 已{action}套餐 **{name}**: {price} {currency.upper()} -> {role.mention}", ephemeral=True)
 
-@slash_command(guild_ids=[GUILD_ID], description="发送充值面板")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="发送充值面板")
 @commands.has_permissions(administrator=True)
 async def send_panel(ctx):
     # 权限自检，避免 Missing Access
@@ -878,112 +1265,81 @@ async def send_panel(ctx):
         await ctx.respond("❌ 机器人在此频道缺少发送消息或嵌入权限，请管理员为机器人开启：发送消息、嵌入链接。", ephemeral=True)
         return
 
-    # 构建主 Embed (价格表)
-    embed_main = discord.Embed(
-        title="LEVEL UP YOUR TRADING 🚀",
-        description="选择套餐 → 选择支付方式 → 支付 → 自动开通会员",
-        color=0xF6C344  # 黄色边框
-    )
-    
-    # 动态从数据库读取价格显示在 Embed 中
-    c.execute("SELECT id, name, price, currency, role_id, duration_months FROM plans")
-    plans = c.fetchall()
-    price_text = ""
-    for p in plans:
-        _, name, price, currency, _, duration = p
-        if duration == -1:
-            duration_str = "/永久"
-        elif duration == 1:
-            duration_str = "/月"
-        elif duration == 12:
-            duration_str = "/年"
-        else:
-            duration_str = f"/{duration}个月"
-
-        formatted_price = f"{round(float(price), 2):g}"
-        price_text += f"**{name}**：{formatted_price} {currency}{duration_str}\n"
-    
-    if not price_text:
-        price_text = "暂无套餐配置，请使用管理员指令配置。"
-
-    steps_text = "```\n✅ 选套餐 + 支付方式\n💳 点击前往支付\n🔗 完成支付\n🎉 自动开通会员\n```"
-
-    embed_main.add_field(name="💰 会员价格", value=price_text, inline=False)
-    embed_main.add_field(name="📌 开通步骤", value=steps_text, inline=False)
-    embed_main.set_thumbnail(url="https://cdn-icons-png.flaticon.com/512/3135/3135715.png") # 示例图标
-
-    # 在slash command中直接回复包含embed和view的消息
-    view = PlanAndNetworkView()
+    # 面板内容按本服务器的套餐快照缓存，服务器内所有面板共用同一个视图
+    snapshot = await plan_catalog.current(ctx.guild.id)
+    embed_main, view = panel_registry.render(snapshot)
     await ctx.respond(embed=embed_main, view=view)
+    message = await ctx.interaction.original_response()
+    await panel_registry.register(ctx.guild.id, channel.id, message.id, snapshot)
 
-@slash_command(guild_ids=[GUILD_ID], description="删除套餐")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="删除套餐")
 @commands.has_permissions(administrator=True)
 async def delete_plan(
     ctx,
     name: str
 ):
-    c.execute("SELECT id FROM plans WHERE name = ?", (name,))
-    data = c.fetchone()
-    if data:
-        c.execute("DELETE FROM plans WHERE name = ?", (name,))
-        conn.commit()
+    deleted = await db.execute("DELETE FROM plans WHERE guild_id = ? AND name = ?", (ctx.guild.id, name))
+    if deleted:
+        panel_registry.schedule_refresh(await plan_catalog.reload(ctx.guild.id))
         await ctx.respond(f"✅ 已删除套餐 **{name}**", ephemeral=True)
     else:
         await ctx.respond(f"❌ 未找到套餐 **{name}**", ephemeral=True)
 
-@slash_command(guild_ids=[GUILD_ID], description="查看所有套餐")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="查看所有套餐")
 @commands.has_permissions(administrator=True)
 async def list_plans(ctx):
-    c.execute("SELECT name, price, currency, duration_months FROM plans")
-    plans = c.fetchall()
+    plans = await fetch_plans(ctx.guild.id)
     if plans:
-        plan_list = "\n".join([f"**{p[0]}**: {p[1]} {p[2]} (时长: {p[3]}个月)" for p in plans])
+        plan_list = "\n".join([f"**{p.name}**: {p.price} {p.currency} (时长: {p.duration_months}个月)" for p in plans])
         await ctx.respond(f"📋 **当前套餐列表：**\n{plan_list}", ephemeral=True)
     else:
         await ctx.respond("❌ 暂无套餐配置", ephemeral=True)
 
-@slash_command(guild_ids=[GUILD_ID], description="手动授予用户会员（管理员）")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="手动授予用户会员（管理员）")
 @commands.has_permissions(administrator=True)
 async def grant_member(
     ctx,
     user: discord.Member,
     plan_name: str
 ):
-    plan = fetch_plan_by_name(plan_name)
+    plan = await fetch_plan_by_name(ctx.guild.id, plan_name)
     if not plan:
         await ctx.respond(f"❌ 未找到套餐 **{plan_name}**，请确认名称是否一致。", ephemeral=True)
         return
 
-    plan_id, name, price, role_id, duration = plan
+    plan_id, role_id, duration = plan.id, plan.role_id, plan.duration_months
     role = ctx.guild.get_role(role_id)
     if not role:
         await ctx.respond(f"❌ 未找到套餐对应的身份组（role_id={role_id}），请检查配置。", ephemeral=True)
         return
 
     try:
-        await user.add_roles(role)
+        added = await role_workers.submit(
+            ctx.guild.id, lambda: member_resolver.add_role(ctx.guild.id, user.id, role_id, reason="管理员手动授予"), "add_role")
     except Exception as e:
         await ctx.respond(f"⚠️ 授予身份组失败：{e}", ephemeral=True)
         return
+    if not added:
+        await ctx.respond(f"⚠️ 授予身份组失败：{user.mention} 不在当前服务器中", ephemeral=True)
+        return
 
-    # 写入订单和订阅记录，状态设为手动付费
-    trade_no = f"MANUAL_{int(time.time())}_{user.id}"
+    # 写入订单并续期订阅，状态设为手动付费
+    trade_no = build_trade_no("MANUAL")
     current_time = int(time.time())
-    if duration == -1:
-        expire_date = -1
-    else:
-        expire_date = current_time + (duration * 30 * 24 * 60 * 60)
+    guild_id = ctx.guild.id
+
+    def record_grant(conn):
+        conn.execute("INSERT INTO orders (order_id, guild_id, user_id, plan_id, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (trade_no, guild_id, user.id, plan_id, 'paid', current_time))
+        return extend_subscription(conn, guild_id, user.id, role_id, plan_id, duration, current_time)
 
-    c.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?)",
-              (trade_no, user.id, plan_id, 'paid', current_time))
-    c.execute("INSERT INTO subscriptions (user_id, role_id, plan_id, expire_date, created_at) VALUES (?, ?, ?, ?, ?)",
-              (user.id, role_id, plan_id, expire_date, current_time))
-    conn.commit()
+    sub_id, expire_date = await db.transaction(record_grant)
+    expiry_scheduler.schedule(sub_id, user.id, role_id, expire_date)
 
-    expire_text = "永久" if duration == -1 else f"{duration} 个月"
+    expire_text = "永久" if expire_date == -1 else f"{duration} 个月，到期时间 {datetime.fromtimestamp(expire_date).strftime('%Y-%m-%d %H:%M')}"
     await ctx.respond(f"✅ 已为 {user.mention} 授予 {role.mention}（{expire_text}）。", ephemeral=True)
 
-@slash_command(guild_ids=[GUILD_ID], description="测试回调功能（模拟支付成功，无需真实支付）")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="测试回调功能（模拟支付成功，无需真实支付）")
 @commands.has_permissions(administrator=True)
 async def test_callback(
     ctx,
@@ -991,8 +1347,8 @@ async def test_callback(
 ):
     """模拟 Epusdt 回调，测试支付成功流程"""
     # 检查订单是否存在
-    c.execute("SELECT user_id, plan_id, status FROM orders WHERE order_id = ?", (order_id,))
-    order = c.fetchone()
+    order = await db.fetchone("SELECT user_id, plan_id, status FROM orders WHERE order_id = ? AND guild_id = ?",
+                              (order_id, ctx.guild.id))
     if not order:
         await ctx.respond(f"❌ 未找到订单 **{order_id}**。请先创建一个订单（通过购买流程）。", ephemeral=True)
         return
@@ -1003,13 +1359,12 @@ async def test_callback(
         return
     
     # 获取套餐信息以构造回调数据
-    c.execute("SELECT name, price FROM plans WHERE id = ?", (plan_id,))
-    plan = c.fetchone()
+    plan = (await plan_catalog.current(ctx.guild.id)).get(plan_id)
     if not plan:
         await ctx.respond(f"❌ 未找到订单对应的套餐信息。", ephemeral=True)
         return
     
-    plan_name, price = plan
+    plan_name, price = plan.name, plan.price
     
     # 构造模拟的回调数据（按照 Epusdt 回调格式）
     mock_callback_data = {
@@ -1027,14 +1382,15 @@ async def test_callback(
     
     # 模拟调用 handle_notify 的逻辑
     try:
-        # 更新订单状态
-        c.execute("UPDATE orders SET status = 'paid' WHERE order_id = ?", (order_id,))
-        conn.commit()
-        
-        # 异步发放身份组
-        await fulfill_order(order_id)
-        
-        member = ctx.guild.get_member(user_id)
+        # 更新订单状态并创建发放任务，随后立即执行
+        await fulfillment_queue.enqueue(order_id)
+        state = await fulfillment_queue.process(order_id)
+        if state != JOB_FULFILLED:
+            error = await fulfillment_queue.last_error(order_id)
+            await ctx.respond(f"⚠️ 订单 `{order_id}` 已标记为已支付，但发放身份组失败（{state}）：{error}", ephemeral=True)
+            return
+
+        member = await member_resolver.resolve(ctx.guild, user_id)
         if member:
             await ctx.respond(
                 f"✅ **测试回调成功！**\n"
@@ -1056,7 +1412,7 @@ async def test_callback(
     except Exception as e:
         await ctx.respond(f"❌ 测试回调时出错：{e}", ephemeral=True)
 
-@slash_command(guild_ids=[GUILD_ID], description="手动处理已支付订单")
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="手动处理已支付订单")
 @commands.has_permissions(administrator=True)
 async def process_paid_order(
     ctx,
@@ -1064,81 +1420,205 @@ async def process_paid_order(
 ):
     """手动处理后台补单的情况，将订单标记为已支付并发放会员权限"""
     # 检查订单是否存在
-    c.execute("SELECT user_id, plan_id, status FROM orders WHERE order_id = ?", (order_id,))
-    order = c.fetchone()
+    order = await db.fetchone("SELECT user_id, plan_id, status FROM orders WHERE order_id = ? AND guild_id = ?",
+                              (order_id, ctx.guild.id))
 
     if not order:
-        # 如果订单不存在，尝试查找相似的订单号
-        c.execute("SELECT order_id, user_id, plan_id, status FROM orders WHERE order_id LIKE ? LIMIT 5", (f'%{order_id}%',))
-        similar_orders = c.fetchall()
+        archived = await db.fetchone("SELECT status, archived_at FROM orders_archive WHERE order_id = ? AND guild_id = ?",
+                                     (order_id, ctx.guild.id))
+        if archived:
+            archived_time = datetime.fromtimestamp(archived[1]).strftime('%Y-%m-%d %H:%M')
+            await ctx.respond(f"ℹ️ 订单 `{order_id}` 已于 {archived_time} 归档，状态：{archived[0]}", ephemeral=True)
+            return
+
+        # 如果订单不存在，按前缀查找（输入订单号的开头部分即可）
+        similar_orders = await search_order_prefix(db, order_id, guild_id=ctx.guild.id)
 
         if similar_orders:
             order_list = "\n".join([f"`{o[0]}` - 用户:{o[1]} - 状态:{o[3]}" for o in similar_orders])
-            await ctx.respond(f"❌ 未找到订单 `{order_id}`，但找到相似订单：\n{order_list}", ephemeral=True)
+            await ctx.respond(f"❌ 未找到订单 `{order_id}`，但找到以此开头的订单：\n{order_list}", ephemeral=True)
         else:
             await ctx.respond(f"❌ 未找到订单 `{order_id}`", ephemeral=True)
         return
 
     user_id, plan_id, current_status = order
 
-    if current_status == 'paid':
+    job = await db.fetchone("SELECT state FROM fulfillment_jobs WHERE order_id = ?", (order_id,))
+    if current_status == 'paid' and (not job or job[0] == JOB_FULFILLED):
         await ctx.respond(f"✅ 订单 `{order_id}` 已经是已支付状态", ephemeral=True)
         return
 
-    # 将订单标记为已支付
-    c.execute("UPDATE orders SET status = 'paid' WHERE order_id = ?", (order_id,))
-    conn.commit()
+    # 将订单标记为已支付并创建发放任务（已支付但发放失败的订单会直接重试）
+    await fulfillment_queue.enqueue(order_id)
 
     # 获取用户信息
-    member = ctx.guild.get_member(user_id)
-    user_mention = f"<@{user_id}>" if not member else member.mention
+    user_mention = f"<@{user_id}>"
 
-    try:
-        # 调用fulfill_order来发放会员权限
-        await fulfill_order(order_id)
+    state = await fulfillment_queue.process(order_id)
+    if state == JOB_FULFILLED:
         await ctx.respond(f"✅ 已手动处理订单 `{order_id}`\n用户: {user_mention}\n状态: 已支付 → 已发放会员权限", ephemeral=True)
-    except Exception as e:
-        await ctx.respond(f"⚠️ 订单 `{order_id}` 已标记为已支付，但发放权限时出错: {e}", ephemeral=True)
+    else:
+        error = await fulfillment_queue.last_error(order_id)
+        await ctx.respond(f"⚠️ 订单 `{order_id}` 已标记为已支付，但发放权限时出错（{state}）: {error}", ephemeral=True)
+
+# 每行约 100 字符，控制在 Discord 单条消息 2000 字符以内
+ORDER_PAGE_SIZE = 15
+
+def parse_date(value: str) -> int:
+    """解析 YYYY-MM-DD 为当天 0 点的时间戳"""
+    return int(datetime.strptime(value.strip(), "%Y-%m-%d").timestamp())
+
+async def render_order_page(page, flt: OrderFilter) -> str:
+    snapshot = await plan_catalog.current(flt.guild_id)
+    order_list = []
+    for order_id, user_id, plan_id, order_status, created_at in page.rows:
+        plan = snapshot.get(plan_id)
+        plan_name_str = plan.name if plan else "未知套餐"
+
+        # 格式化时间
+        time_str = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
+
+        status_emoji = "✅" if order_status == "paid" else "⏳"
+        order_list.append(f"{status_emoji} `{order_id}` - {plan_name_str} - <@{user_id}> - {order_status} - {time_str}")
 
-@slash_command(guild_ids=[GUILD_ID], description="查看订单记录")
+    title = "📋 **订单记录**"
+    description = flt.describe()
+    if description:
+        title += f"（{description}）"
+    return f"{title}\n\n" + "\n".join(order_list)
+
+class OrderPageView(ui.View):
+    """订单翻页按钮：只记住当前页首尾订单的 (created_at, order_id)"""
+
+    def __init__(self, flt: OrderFilter, page):
+        super().__init__(timeout=600)
+        self.flt = flt
+        self.page = page
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.newer_button.disabled = not self.page.has_newer
+        self.older_button.disabled = not self.page.has_older
+
+    async def show(self, interaction: discord.Interaction, **cursor):
+        page = await fetch_order_page(db, self.flt, page_size=ORDER_PAGE_SIZE, **cursor)
+        if not page.rows:
+            # 翻页期间订单被归档等情况
+            await interaction.response.send_message("❌ 没有更多订单了", ephemeral=True)
+            return
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(content=await render_order_page(page, self.flt), view=self)
+
+    @ui.button(label="◀ 较新", style=discord.ButtonStyle.secondary)
+    async def newer_button(self, button, interaction):
+        await self.show(interaction, newer_than=self.page.first_key)
+
+    @ui.button(label="较早 ▶", style=discord.ButtonStyle.secondary)
+    async def older_button(self, button, interaction):
+        await self.show(interaction, older_than=self.page.last_key)
+
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="查看订单记录")
 @commands.has_permissions(administrator=True)
 async def list_orders(
     ctx,
-    status: str = None
+    status: str = None,
+    user: discord.Member = None,
+    plan_name: str = None,
+    since: str = None,
+    until: str = None
 ):
-    """查看订单记录"""
-    if status:
-        c.execute("SELECT order_id, user_id, plan_id, status, created_at FROM orders WHERE status = ? ORDER BY created_at DESC LIMIT 20", (status,))
-    else:
-        c.execute("SELECT order_id, user_id, plan_id, status, created_at FROM orders ORDER BY created_at DESC LIMIT 20")
-    
-    orders = c.fetchall()
-    if not orders:
+    """查看订单记录，支持按用户/套餐/状态/日期（YYYY-MM-DD）筛选并翻页"""
+    plan_id = None
+    if plan_name:
+        plan = (await plan_catalog.current(ctx.guild.id)).find(plan_name)
+        if not plan:
+            await ctx.respond(f"❌ 未找到套餐 **{plan_name}**", ephemeral=True)
+            return
+        plan_id = plan.id
+
+    try:
+        since_ts = parse_date(since) if since else None
+        # 结束日期包含当天
+        until_ts = parse_date(until) + 86400 if until else None
+    except ValueError:
+        await ctx.respond("❌ 日期格式应为 YYYY-MM-DD", ephemeral=True)
+        return
+
+    flt = OrderFilter(guild_id=ctx.guild.id, user_id=user.id if user else None, plan_id=plan_id, status=status,
+                      since=since_ts, until=until_ts)
+    page = await fetch_order_page(db, flt, page_size=ORDER_PAGE_SIZE)
+
+    if not page.rows:
         await ctx.respond("❌ 暂无订单记录", ephemeral=True)
         return
-    
-    order_list = []
-    for order in orders:
-        order_id, user_id, plan_id, order_status, created_at = order
-        c.execute("SELECT name FROM plans WHERE id = ?", (plan_id,))
-        plan_name = c.fetchone()
-        plan_name_str = plan_name[0] if plan_name else "未知套餐"
-        
-        # 格式化时间
-        time_str = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
-        
-        status_emoji = "✅" if order_status == "paid" else "⏳"
-        order_list.append(f"{status_emoji} `{order_id}` - {plan_name_str} - <@{user_id}> - {order_status} - {time_str}")
-    
-    await ctx.respond(
-        f"📋 **订单记录**（最近20条）\n\n" + "\n".join(order_list),
+
+    await ctx.respond(await render_order_page(page, flt), view=OrderPageView(flt, page), ephemeral=True)
+
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="查看下单限流与链接复用统计")
+@commands.has_permissions(administrator=True)
+async def checkout_stats(ctx):
+    admission = checkout_admission.stats()
+    cache = checkout_cache.stats()
+    lines = [
+        "📊 **下单统计**",
+        f"进行中: {admission['inflight']}/{checkout_admission.max_inflight}（峰值 {admission['peak_inflight']}），排队: {admission['queued']}",
+        f"已放行: {admission['admitted']}，用户限频拒绝: {admission['rejected_rate']}，繁忙拒绝: {admission['rejected_busy']}",
+        f"链接复用: 命中 {cache['hits']}，合并 {cache['coalesced']}，新建 {cache['misses']}，缓存 {cache['entries']} 条",
+    ]
+    await ctx.respond("\n".join(lines), ephemeral=True)
+
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="采样事件循环调用栈，定位卡顿热点")
+@commands.has_permissions(administrator=True)
+async def profile(
+    ctx,
+    seconds: int = 10
+):
+    seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+    await ctx.defer(ephemeral=True)
+    summary, folded_stacks = await stack_sampler.profile(seconds)
+    stalls = f"，卡顿看门狗已记录 {stall_watchdog.stalls} 次卡顿" if stall_watchdog.running else ""
+    await ctx.followup.send(
+        f"📈 采样 {seconds} 秒{stalls}\n```\n{summary[:1800]}\n```",
+        file=discord.File(io.BytesIO(folded_stacks.encode("utf-8")), filename="profile.folded"),
         ephemeral=True
     )
 
+@slash_command(guild_ids=COMMAND_GUILD_IDS, description="比对订阅与实际身份组，补发缺失的身份组（管理员）")
+@commands.has_permissions(administrator=True)
+async def reconcile_roles(
+    ctx,
+    dry_run: bool = True,
+    remove_extra: bool = False
+):
+    """dry_run 只统计差异不做修改；remove_extra 同时回收没有有效订阅的身份组"""
+    if role_reconciler.busy(ctx.guild.id):
+        await ctx.respond("⏳ 身份组对账正在进行，请稍后再试", ephemeral=True)
+        return
+    await ctx.defer(ephemeral=True)
+    try:
+        summary = await role_reconciler.reconcile(ctx.guild, remove_extra=remove_extra, dry_run=dry_run)
+    except Exception as e:
+        await ctx.followup.send(f"❌ 身份组对账失败：{e}", ephemeral=True)
+        return
+    lines = [
+        f"🔄 **身份组对账{'（预览）' if dry_run else ''}** 用时 {summary['seconds']} 秒",
+        f"成员: {summary['members']}，受管身份组: {summary['roles']}，有效订阅: {summary['subscriptions']}",
+        f"缺失身份组: {summary['missing']}，已补发: {summary['added']}",
+    ]
+    if summary["extra"] < 0:
+        lines.append("多余身份组: 未开启 members intent，无法检查")
+    else:
+        lines.append(f"多余身份组: {summary['extra']}，已回收: {summary['removed']}"
+                     + ("" if remove_extra or dry_run else "（未开启 remove_extra，不回收）"))
+    if summary["failed"]:
+        lines.append(f"⚠️ 失败: {summary['failed']}")
+    await ctx.followup.send("\n".join(lines), ephemeral=True)
+
 # ================= 定时任务：检查到期订阅 =================
 @bot.event
 async def on_ready():
-    print(f"Logged in as {bot.user}")
+    logger.info(f"Logged in as {bot.user}", extra={"event": "bot.ready"})
 
     # 同步slash commands (仅在官方discord.py模式下需要)
     if HAS_SLASH_COMMANDS and not PY_CORD_MODE:
@@ -1147,56 +1627,237 @@ async def on_ready():
             guild = discord.Object(id=GUILD_ID)
             bot.tree.copy_global_to(guild=guild)
             await bot.tree.sync(guild=guild)
-            print("✅ 已同步slash commands到服务器")
+            logger.info("已同步slash commands到服务器")
         except Exception as e:
-            print(f"⚠️ 同步slash commands失败: {e}")
+            logger.warning(f"同步slash commands失败: {e}")
+
+    # 预加载所有服务器的套餐目录，之后的面板与下单流程不再查询 plans 表
+    await plan_catalog.reload_all()
 
-    # 重启后保持按钮监听状态
+    # 重启后保持按钮监听状态；停机期间套餐若有变化，在后台更新已发布的面板
     if HAS_UI_COMPONENTS:
-        bot.add_view(PlanAndNetworkView())
+        panel_registry.on_rendered = bot.add_view
+        for guild_id in await panel_registry.guild_ids():
+            if shard_scope.owns(guild_id):
+                snapshot = plan_catalog.snapshot(guild_id)
+                panel_registry.render(snapshot)
+                panel_registry.schedule_refresh(snapshot)
     else:
-        print("⚠️ UI组件不支持，跳过按钮注册")
-
-    # 启动 webhook 服务器（用于接收 Epusdt 回调）
-    await start_web_server()
-
-    # 启动定时任务检查到期订阅
-    check_expired_subscriptions.start()
-    # 启动时立即跑一次过期检查
-    await process_expired_subscriptions()
-
-async def process_expired_subscriptions():
-    """检查并移除过期的订阅"""
-    current_time = int(time.time())
-    c.execute("SELECT user_id, role_id, id FROM subscriptions WHERE expire_date != -1 AND expire_date < ?", (current_time,))
-    expired = c.fetchall()
-    
-    for user_id, role_id, sub_id in expired:
-        # 尝试从所有服务器中移除角色
-        for guild in bot.guilds:
-            member = guild.get_member(user_id)
-            role = guild.get_role(role_id)
-            if member and role:
-                try:
-                    await member.remove_roles(role)
-                    print(f"已移除用户 {user_id} 在服务器 {guild.id} 的身份组 {role_id}")
-                except Exception as e:
-                    print(f"移除身份组失败: {e}")
-        
-        # 从数据库删除过期订阅记录
-        c.execute("DELETE FROM subscriptions WHERE id = ?", (sub_id,))
-    
-    conn.commit()
-    print(f"检查完成，处理了 {len(expired)} 个过期订阅")
-
-@tasks.loop(minutes=60)  # 每小时检查一次
-async def check_expired_subscriptions():
-    await process_expired_subscriptions()
+        logger.warning("UI组件不支持，跳过按钮注册")
+
+    # 创建网关连接池；单进程部署时同时启动 webhook 服务器（用于接收支付回调）
+    await gateway_client.start()
+    if PROCESS_ROLE == "all":
+        await start_web_server()
+
+    # 启动身份组工作池与到期调度器（启动时会立即处理停机期间已过期的订阅）
+    role_workers.start()
+    loop_lag_monitor.start()
+    if PROFILER_CONFIG.get("enabled", False):
+        stall_watchdog.start()
+    expiry_scheduler.start()
+    if ROLE_RECONCILE_CONFIG.get("enabled", False):
+        role_reconciler.start()
+
+    # 恢复上次退出时未完成的发放任务并启动发放队列
+    recovered = await fulfillment_queue.recover()
+    if recovered:
+        logger.info(f"已恢复 {recovered} 个未完成的发放任务", extra={"event": "fulfillment.recovered"})
+    fulfillment_queue.start()
+
+    # 每组分片消费属于本分片服务器订单的回调事件，并直接唤醒本进程的发放队列
+    webhook_inbox.start()
+
+    # 以下任务不区分服务器，分片部署时只由 0 号分片所在进程运行
+    if shard_scope.primary:
+        # 过期未支付订单清理与历史订单归档
+        order_lifecycle.start()
+
+        # 主动对账：补记回调丢失的已支付订单
+        if RECONCILE_CONFIG.get("enabled", True):
+            order_reconciler.start()
+
+async def process_expired_subscriptions(expired=None):
+    """移除过期订阅的身份组并删除记录，返回未能回收而保留的订阅 ID
+
+    expired 为 (user_id, role_id, sub_id, guild_id) 列表，省略时查询本进程分片内所有已过期订阅。
+    只删除身份组已移除（或成员、身份组已不存在）的记录，其余留待下次重试。
+    """
+    if expired is None:
+        current_time = int(time.time())
+        scope, scope_params = shard_scope.sql()
+        expired = await db.fetchall(
+            f"SELECT user_id, role_id, id, guild_id FROM subscriptions WHERE expire_date BETWEEN 0 AND ? AND {scope}",
+            (current_time, *scope_params))
+
+    async def revoke(user_id, role_id, guild_id) -> bool:
+        """返回记录能否删除：身份组已移除，或成员已离开服务器、身份组已被删除"""
+        # 订阅记录了所属服务器，直接定位，无需遍历 bot.guilds；服务器暂不可用时保留记录
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            return False
+        try:
+            # 交给工作池并发执行，按服务器限流并自动重试 429/5xx；按 ID 移除，未缓存的成员与身份组同样会被回收
+            removed = await role_workers.submit(
+                guild.id, lambda: member_resolver.remove_role(guild.id, user_id, role_id, reason="订阅到期"), "remove_role")
+        except Exception as e:
+            if isinstance(e, discord.NotFound) and e.code == UNKNOWN_ROLE:
+                return True
+            logger.warning(f"移除身份组失败: {e}", extra={"event": "expiry.remove_failed", "user_id": user_id,
+                                                      "role_id": role_id})
+            return False
+        if removed:
+            logger.info("已移除过期身份组", extra={"event": "expiry.role_removed", "user_id": user_id,
+                                               "guild_id": guild.id, "role_id": role_id})
+        return True
 
-@check_expired_subscriptions.before_loop
-async def before_check_expired():
-    await bot.wait_until_ready()
+    results = await asyncio.gather(*(revoke(user_id, role_id, guild_id) for user_id, role_id, _, guild_id in expired))
+    failed = [row[2] for row, ok in zip(expired, results) if not ok]
+    expired = [row for row, ok in zip(expired, results) if ok]
+
+    # 分批删除仍处于过期状态的订阅记录；回收期间被续期的订阅保留，并补回刚移除的身份组
+    def delete_expired(conn):
+        now = int(time.time())
+        sub_ids = [sub_id for _, _, sub_id, _ in expired]
+        deleted = set()
+        for start in range(0, len(sub_ids), 500):
+            chunk = sub_ids[start:start + 500]
+            condition = f"id IN ({','.join('?' * len(chunk))}) AND expire_date BETWEEN 0 AND ?"
+            deleted.update(row[0] for row in conn.execute(f"SELECT id FROM subscriptions WHERE {condition}", (*chunk, now)))
+            conn.execute(f"DELETE FROM subscriptions WHERE {condition}", (*chunk, now))
+        return deleted
+
+    deleted = await db.transaction(delete_expired)
+    renewed = [row for row in expired if row[2] not in deleted]
+    if renewed:
+        existing = {row[0] for row in await db.fetchall(
+            f"SELECT id FROM subscriptions WHERE id IN ({','.join('?' * len(renewed))})", [row[2] for row in renewed])}
+
+        async def regrant(user_id, role_id, guild_id):
+            logger.info("订阅已续期，补回身份组", extra={"event": "expiry.renewed", "user_id": user_id,
+                                                   "guild_id": guild_id, "role_id": role_id})
+            await role_workers.submit(
+                guild_id, lambda: member_resolver.add_role(guild_id, user_id, role_id, reason="订阅已续期"), "add_role")
+
+        await asyncio.gather(*(regrant(user_id, role_id, guild_id) for user_id, role_id, sub_id, guild_id in renewed
+                               if sub_id in existing), return_exceptions=True)
+    logger.info(f"检查完成，处理了 {len(deleted)} 个过期订阅，{len(failed)} 个回收失败待重试",
+                extra={"event": "expiry.processed", "failed": len(failed), "role_workers": role_workers.stats()})
+    return failed
+
+# 身份组操作工作池：限制并发、按服务器限流、失败自动退避重试
+ROLE_WORKER_CONFIG = CONFIG.get("role_workers", {})
+role_workers = RoleWorkerPool(
+    workers=ROLE_WORKER_CONFIG.get("workers", 4),
+    rate=ROLE_WORKER_CONFIG.get("rate", 5.0),
+    burst=ROLE_WORKER_CONFIG.get("burst", 10),
+    max_retries=ROLE_WORKER_CONFIG.get("max_retries", 5),
+)
+role_workers.on_result = lambda name, seconds, ok: role_latency.observe(
+    seconds, operation=name, result="ok" if ok else "error")
+
+# 成员解析：身份组按 ID 增删；需要成员对象时依次查 discord 缓存、LRU，最后批量向 Discord 查询
+MEMBERS_CONFIG = CONFIG.get("members", {})
+member_resolver = MemberResolver(
+    bot,
+    max_entries=MEMBERS_CONFIG.get("cache_size", 10000),
+    ttl=MEMBERS_CONFIG.get("ttl_seconds", 600),
+    negative_ttl=MEMBERS_CONFIG.get("negative_ttl_seconds", 60),
+    batch_window=MEMBERS_CONFIG.get("batch_window_ms", 50) / 1000,
+)
+
+# 身份组对账：比对订阅表与服务器中实际持有的身份组，补发缺失的、按需回收多余的
+ROLE_RECONCILE_CONFIG = CONFIG.get("role_reconcile", {})
+role_reconciler = RoleReconciler(
+    db,
+    bot,
+    member_resolver,
+    role_workers,
+    plan_catalog,
+    scope=shard_scope,
+    # 列出服务器成员需要 members 特权 intent
+    full_scan=ENABLE_PRIVILEGED_INTENTS,
+    remove_extra=ROLE_RECONCILE_CONFIG.get("remove_extra", False),
+    chunk_size=ROLE_RECONCILE_CONFIG.get("chunk_size", 1000),
+    interval=ROLE_RECONCILE_CONFIG.get("interval_hours", 24) * 3600,
+)
+
+# 发放任务队列：持久化、按订单去重、失败退避重试
+FULFILLMENT_CONFIG = CONFIG.get("fulfillment", {})
+fulfillment_queue = FulfillmentQueue(
+    db,
+    fulfill_order,
+    concurrency=FULFILLMENT_CONFIG.get("concurrency", 8),
+    max_attempts=FULFILLMENT_CONFIG.get("max_attempts", 8),
+    base_backoff=FULFILLMENT_CONFIG.get("base_backoff", 10),
+    max_backoff=FULFILLMENT_CONFIG.get("max_backoff", 3600),
+    # 兜底轮询间隔；分片部署时由其他进程写入的任务只能靠轮询发现，默认调低
+    poll_interval=FULFILLMENT_CONFIG.get("poll_interval", 30 if shard_scope.everything else 5),
+    scope=shard_scope,
+)
+fulfillment_queue.on_finished = lambda order_id, state: track_order_events(state, [order_id])
+
+# 回调收件箱：webhook 只负责验签与追加事件，由消费者批量标记订单并创建发放任务
+webhook_inbox = WebhookInbox(db, enqueue_paid_order, poll_interval=CONFIG.get("inbox_poll_interval", 5),
+                             scope=shard_scope)
+
+def on_orders_paid(order_ids):
+    # 已支付订单的链接不可再复用
+    checkout_cache.invalidate_orders(order_ids)
+    fulfillment_queue.notify()
+    track_order_events("paid", order_ids)
+
+webhook_inbox.on_enqueued = on_orders_paid
+
+# 到期调度器：按最近的到期时间精确唤醒，取代每小时一次的全量扫描
+EXPIRY_CONFIG = CONFIG.get("expiry", {})
+expiry_scheduler = ExpiryScheduler(
+    db,
+    process_expired_subscriptions,
+    window_seconds=EXPIRY_CONFIG.get("window_seconds", 3600),
+    window_size=EXPIRY_CONFIG.get("window_size", 1000),
+    retry_delay=EXPIRY_CONFIG.get("retry_delay", 600),
+    scope=shard_scope,
+)
+
+# 订单生命周期：过期未支付订单、归档历史订单、清理已消费的回调事件
+LIFECYCLE_CONFIG = CONFIG.get("order_lifecycle", {})
+order_lifecycle = OrderLifecycle(
+    db,
+    pending_ttl=int(LIFECYCLE_CONFIG.get("pending_ttl_hours", 24) * 3600),
+    archive_after=int(LIFECYCLE_CONFIG.get("archive_after_days", 90) * SECONDS_PER_DAY),
+    inbox_retention=int(LIFECYCLE_CONFIG.get("inbox_retention_days", 7) * SECONDS_PER_DAY),
+    batch_size=LIFECYCLE_CONFIG.get("batch_size", 500),
+    interval=LIFECYCLE_CONFIG.get("interval_minutes", 30) * 60,
+)
+
+# 支付对账：按订单年龄自适应地查询网关，查到已支付的订单追加到回调收件箱
+RECONCILE_CONFIG = CONFIG.get("reconcile", {})
+
+async def record_reconciled_payment(trade_no, data):
+    await webhook_inbox.append(PAYMENT_PLATFORM, trade_no, {"source": "reconcile", "response": data})
+
+order_reconciler = OrderReconciler(
+    db,
+    YiPay.check_order_status,
+    record_reconciled_payment,
+    concurrency=RECONCILE_CONFIG.get("concurrency", 4),
+    min_age=RECONCILE_CONFIG.get("min_age_seconds", 30),
+    tick=RECONCILE_CONFIG.get("tick_seconds", 30),
+)
 
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    PROCESS_ROLE = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if PROCESS_ROLE not in PROCESS_ROLES:
+        raise SystemExit(f"用法: python main.py [{'|'.join(PROCESS_ROLES)}]")
+    try:
+        if PROCESS_ROLE == "webhook":
+            bot.loop.run_until_complete(serve_webhook())
+        else:
+            # 待命进程停在这里，成为主节点后才连接 Discord
+            bot.loop.run_until_complete(acquire_worker_lease())
+            bot.run(TOKEN)
+    finally:
+        db.close()
+        log_listener.stop()
 
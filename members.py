@@ -0,0 +1,178 @@
+"""成员解析
+
+未开启 members 特权 intent 时，gateway 不会下发完整的成员列表，guild.get_member 对未缓存的成员
+返回 None。身份组的发放与回收因此不再依赖成员对象：
+- add_role/remove_role 直接按 (guild_id, user_id, role_id) 调用 HTTP 接口，成员不在服务器时返回 False
+- 确实需要成员对象时（展示、对账）由 resolve 依次尝试 discord 自身缓存、最近解析过的成员（有界 LRU），
+  最后合并同一服务器短时间内的查询，经 gateway 按 user_ids 批量请求（每批最多 100 个），
+  gateway 不可用时退回逐个 REST fetch_member
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# gateway REQUEST_GUILD_MEMBERS 每次最多查询的 user_id 数
+MAX_QUERY_IDS = 100
+# Discord 错误码：Unknown Member
+UNKNOWN_MEMBER = 10007
+# Discord 错误码：Unknown Role
+UNKNOWN_ROLE = 10011
+
+# LRU 中表示“已确认不在服务器”的占位
+_ABSENT = object()
+
+
+class MemberResolver:
+    def __init__(
+        self,
+        bot,
+        max_entries: int = 10000,
+        ttl: float = 600,
+        negative_ttl: float = 60,
+        batch_window: float = 0.05,
+        query_timeout: float = 10,
+    ):
+        self._bot = bot
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # 不在服务器的结果缓存较短时间，用户随时可能加入
+        self.negative_ttl = negative_ttl
+        self.batch_window = batch_window
+        self.query_timeout = query_timeout
+        # (guild_id, user_id) -> (过期时间, 成员或 _ABSENT)
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[float, object]]" = OrderedDict()
+        # guild_id -> {user_id: 等待结果的 future}，同一窗口内的查询合并为一批
+        self._pending: Dict[int, Dict[int, asyncio.Future]] = {}
+        self.hits = {"cache": 0, "lru": 0}
+        self.fetched = {"gateway": 0, "rest": 0}
+        self.missing = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "pending": sum(len(waiters) for waiters in self._pending.values()),
+            "cache_hits": self.hits["cache"],
+            "lru_hits": self.hits["lru"],
+            "gateway_fetched": self.fetched["gateway"],
+            "rest_fetched": self.fetched["rest"],
+            "missing": self.missing,
+        }
+
+    # ---------- LRU ----------
+    def _get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[0]:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, guild_id: int, user_id: int, member: Optional[discord.Member]):
+        ttl = self.ttl if member is not None else self.negative_ttl
+        key = (guild_id, user_id)
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + ttl, member if member is not None else _ABSENT)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, guild_id: int, user_id: int):
+        """成员的身份组变化后丢弃缓存的成员对象"""
+        self._entries.pop((guild_id, user_id), None)
+
+    # ---------- 解析 ----------
+    async def resolve(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        """返回成员对象，成员不在服务器时返回 None"""
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.hits["cache"] += 1
+            return member
+        cached = self._get((guild.id, user_id))
+        if cached is not None:
+            self.hits["lru"] += 1
+            return None if cached is _ABSENT else cached
+
+        waiters = self._pending.get(guild.id)
+        if waiters is None:
+            waiters = self._pending[guild.id] = {}
+            asyncio.get_running_loop().create_task(self._flush(guild))
+        future = waiters.get(user_id)
+        if future is None:
+            future = waiters[user_id] = asyncio.get_running_loop().create_future()
+        # 多个调用方共享同一次查询，取消其中一个不影响其他等待者
+        return await asyncio.shield(future)
+
+    async def resolve_many(self, guild: discord.Guild, user_ids: Iterable[int]) -> Dict[int, discord.Member]:
+        """批量解析，只返回仍在服务器中的成员"""
+        user_ids = list(dict.fromkeys(user_ids))
+        members = await asyncio.gather(*(self.resolve(guild, user_id) for user_id in user_ids))
+        return {user_id: member for user_id, member in zip(user_ids, members) if member is not None}
+
+    async def _flush(self, guild: discord.Guild):
+        await asyncio.sleep(self.batch_window)
+        waiters = self._pending.pop(guild.id, {})
+        user_ids = list(waiters)
+        for start in range(0, len(user_ids), MAX_QUERY_IDS):
+            chunk = user_ids[start:start + MAX_QUERY_IDS]
+            try:
+                found = await self._query(guild, chunk)
+            except Exception as e:
+                for user_id in chunk:
+                    if not waiters[user_id].done():
+                        waiters[user_id].set_exception(e)
+                continue
+            for user_id in chunk:
+                member = found.get(user_id)
+                if member is None:
+                    self.missing += 1
+                self._put(guild.id, user_id, member)
+                if not waiters[user_id].done():
+                    waiters[user_id].set_result(member)
+
+    async def _query(self, guild: discord.Guild, user_ids: List[int]) -> Dict[int, discord.Member]:
+        try:
+            members = await asyncio.wait_for(
+                guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False), self.query_timeout)
+            self.fetched["gateway"] += len(members)
+            return {member.id: member for member in members}
+        except (asyncio.TimeoutError, discord.ClientException, RuntimeError) as e:
+            # gateway 未连接（如 webhook 进程）或查询超时
+            logger.warning(f"gateway 成员查询失败，改用 REST: {e}",
+                           extra={"event": "members.query_fallback", "guild_id": guild.id, "count": len(user_ids)})
+
+        async def fetch(user_id):
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                return None
+            self.fetched["rest"] += 1
+            return member
+
+        members = await asyncio.gather(*(fetch(user_id) for user_id in user_ids))
+        return {member.id: member for member in members if member is not None}
+
+    # ---------- 按 ID 修改身份组 ----------
+    async def add_role(self, guild_id: int, user_id: int, role_id: int, reason: Optional[str] = None) -> bool:
+        """为成员添加身份组；成员不在服务器时返回 False，其他错误原样抛出供工作池重试"""
+        return await self._modify(self._bot.http.add_role, guild_id, user_id, role_id, reason)
+
+    async def remove_role(self, guild_id: int, user_id: int, role_id: int, reason: Optional[str] = None) -> bool:
+        return await self._modify(self._bot.http.remove_role, guild_id, user_id, role_id, reason)
+
+    async def _modify(self, request, guild_id, user_id, role_id, reason) -> bool:
+        try:
+            await request(guild_id, user_id, role_id, reason=reason)
+        except discord.NotFound as e:
+            if e.code != UNKNOWN_MEMBER:
+                raise
+            self._put(guild_id, user_id, None)
+            return False
+        self.invalidate(guild_id, user_id)
+        return True
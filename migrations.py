@@ -0,0 +1,247 @@
+"""数据库版本化迁移
+
+每个迁移有一个递增的版本号，已执行的版本记录在 schema_version 表中。
+启动时只需读取该表即可判断要执行哪些迁移，不会重复检查已有表结构。
+新的表结构变更只需在 MIGRATIONS 末尾追加一项。
+"""
+import logging
+import sqlite3
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _initial_schema(conn: sqlite3.Connection):
+    # 创建套餐表
+    conn.execute('''CREATE TABLE IF NOT EXISTS plans
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  price REAL,
+                  currency TEXT DEFAULT 'USDT',
+                  role_id INTEGER,
+                  duration_months INTEGER)''') # duration_months: -1 代表永久, currency: 'USDT' 或 'CNY'
+
+    # 创建订单表
+    conn.execute('''CREATE TABLE IF NOT EXISTS orders
+                 (order_id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  plan_id INTEGER,
+                  status TEXT,
+                  created_at INTEGER)''')
+
+    # 创建订阅表（用于到期管理）
+    conn.execute('''CREATE TABLE IF NOT EXISTS subscriptions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  role_id INTEGER,
+                  plan_id INTEGER,
+                  expire_date INTEGER,
+                  created_at INTEGER)''') # expire_date: -1 代表永久
+
+
+def _plan_currency(conn: sqlite3.Connection):
+    # 旧版本数据库的plans表没有currency字段
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(plans)").fetchall()]
+    if 'currency' not in columns:
+        conn.execute("ALTER TABLE plans ADD COLUMN currency TEXT DEFAULT 'USDT'")
+
+
+def _core_indexes(conn: sqlite3.Connection):
+    # 同名套餐只保留最早的一条，才能建立唯一索引；先把引用被删套餐的订单、订阅指向保留的那一条
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in ("orders", "subscriptions", "orders_archive"):
+        if table not in tables:
+            continue
+        conn.execute(f'''UPDATE {table} SET plan_id =
+                         (SELECT MIN(p2.id) FROM plans p2 WHERE p2.name IS (SELECT name FROM plans WHERE id = {table}.plan_id))
+                         WHERE plan_id IN (SELECT id FROM plans WHERE id NOT IN (SELECT MIN(id) FROM plans GROUP BY name))''')
+    conn.execute("DELETE FROM plans WHERE id NOT IN (SELECT MIN(id) FROM plans GROUP BY name)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_plans_name ON plans(name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_expire ON subscriptions(expire_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_role ON subscriptions(user_id, role_id)")
+
+
+def _fulfillment_jobs(conn: sqlite3.Connection):
+    # 发放任务表：state 为 paid/fulfilling/fulfilled/failed，order_id 唯一用于回调去重
+    conn.execute('''CREATE TABLE IF NOT EXISTS fulfillment_jobs
+                 (order_id TEXT PRIMARY KEY,
+                  state TEXT NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_run_at INTEGER NOT NULL,
+                  last_error TEXT,
+                  created_at INTEGER,
+                  updated_at INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fulfillment_jobs_state_next ON fulfillment_jobs(state, next_run_at)")
+
+
+def _webhook_inbox(conn: sqlite3.Connection):
+    # 已验签的回调事件，processed_at 为空表示尚未被消费
+    conn.execute('''CREATE TABLE IF NOT EXISTS webhook_inbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  platform TEXT,
+                  order_id TEXT,
+                  payload TEXT,
+                  received_at INTEGER,
+                  processed_at INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_unprocessed ON webhook_inbox(id) WHERE processed_at IS NULL")
+
+
+def _orders_archive(conn: sqlite3.Connection):
+    # 已关闭的历史订单，结构与 orders 相同，额外记录归档时间
+    conn.execute('''CREATE TABLE IF NOT EXISTS orders_archive
+                 (order_id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  plan_id INTEGER,
+                  status TEXT,
+                  created_at INTEGER,
+                  archived_at INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_user ON orders_archive(user_id)")
+
+
+def _order_gateway_trade_id(conn: sqlite3.Connection):
+    # 网关侧交易号（Epusdt 的 trade_id），对账查询订单状态时使用
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(orders)").fetchall()]
+    if 'gateway_trade_id' not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN gateway_trade_id TEXT")
+
+
+def _order_browse_indexes(conn: sqlite3.Connection):
+    # 订单分页按 (created_at, order_id) 倒序，各筛选条件都需要以筛选列
+    # 或 created_at 为开头的复合索引，带上 order_id 使排序可以完全走索引
+    conn.execute("DROP INDEX IF EXISTS idx_orders_user")
+    conn.execute("DROP INDEX IF EXISTS idx_orders_status_created")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at, order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at, order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_plan_created ON orders(plan_id, created_at, order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, order_id)")
+
+
+def _panels(conn: sqlite3.Connection):
+    # 已发布的充值面板消息，fingerprint 为发布/最近一次编辑时的套餐目录指纹
+    conn.execute('''CREATE TABLE IF NOT EXISTS panels
+                 (message_id INTEGER PRIMARY KEY,
+                  channel_id INTEGER NOT NULL,
+                  guild_id INTEGER,
+                  fingerprint TEXT,
+                  created_at INTEGER)''')
+
+
+def _order_pay_type(conn: sqlite3.Connection):
+    # 下单时选择的支付方式（alipay/wxpay/usdt...），用于按支付方式统计
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(orders)").fetchall()]
+    if 'pay_type' not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN pay_type TEXT")
+
+
+def _leases(conn: sqlite3.Connection):
+    # 多进程部署时的租约（如后台任务的主节点），过期前须由持有者续约
+    conn.execute('''CREATE TABLE IF NOT EXISTS leases
+                 (name TEXT PRIMARY KEY,
+                  holder TEXT NOT NULL,
+                  expires_at REAL NOT NULL)''')
+
+
+def _guild_scope(conn: sqlite3.Connection):
+    # 多服务器：套餐、订单、订阅、发放任务都归属于某个服务器
+    for table in ("plans", "orders", "orders_archive", "subscriptions", "fulfillment_jobs"):
+        columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if 'guild_id' not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN guild_id INTEGER")
+    # 套餐名称只需在同一服务器内唯一
+    conn.execute("DROP INDEX IF EXISTS ux_plans_name")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_plans_guild_name ON plans(guild_id, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_guild_created ON orders(guild_id, created_at, order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_guild_status_created ON orders(guild_id, status, created_at, order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_guild_user_role ON subscriptions(guild_id, user_id, role_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_panels_guild ON panels(guild_id, message_id)")
+
+
+def _subscription_stacking(conn: sqlite3.Connection):
+    # 续费不再新增订阅行：同一服务器、用户、身份组只保留最新一行。
+    # 旧数据中各行的时间是并行消耗的，合并时把各行剩余时间叠加到当前时间上，已付费的时长不会丢失；
+    # 含永久行时合并为永久，并沿用永久行的套餐
+    now = int(time.time())
+    duplicates = "SELECT MAX(id) FROM subscriptions GROUP BY guild_id, user_id, role_id HAVING COUNT(*) > 1"
+    same_key = ("s.guild_id IS subscriptions.guild_id AND s.user_id = subscriptions.user_id "
+                "AND s.role_id = subscriptions.role_id")
+    conn.execute(f'''UPDATE subscriptions SET
+                     plan_id = COALESCE((SELECT s.plan_id FROM subscriptions s WHERE {same_key} AND s.expire_date = -1
+                                         ORDER BY s.id DESC LIMIT 1), plan_id),
+                     expire_date = (SELECT CASE WHEN MIN(s.expire_date) = -1 THEN -1
+                                               WHEN MAX(s.expire_date) <= ? THEN MAX(s.expire_date)
+                                               ELSE ? + SUM(MAX(s.expire_date - ?, 0)) END
+                                    FROM subscriptions s WHERE {same_key})
+                 WHERE id IN ({duplicates})''', (now, now, now))
+    conn.execute("DELETE FROM subscriptions WHERE id NOT IN (SELECT MAX(id) FROM subscriptions GROUP BY guild_id, user_id, role_id)")
+    conn.execute("DROP INDEX IF EXISTS idx_subscriptions_guild_user_role")
+    conn.execute("DROP INDEX IF EXISTS idx_subscriptions_user_role")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_subscriptions_guild_user_role ON subscriptions(guild_id, user_id, role_id)")
+
+
+def backfill_guild_id(conn: sqlite3.Connection, guild_id: int):
+    """单服务器时代的数据全部归属于原配置的服务器"""
+    for table in ("plans", "orders", "orders_archive", "subscriptions", "fulfillment_jobs", "panels"):
+        conn.execute(f"UPDATE {table} SET guild_id = ? WHERE guild_id IS NULL", (guild_id,))
+
+
+# 引入 guild_id 的迁移版本，执行时需要用默认服务器回填旧数据
+GUILD_SCOPE_VERSION = 12
+
+# (版本号, 说明, 迁移函数)，版本号必须严格递增
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "创建 plans/orders/subscriptions 表", _initial_schema),
+    (2, "plans 表添加 currency 字段", _plan_currency),
+    (3, "添加订单/订阅/套餐查询索引", _core_indexes),
+    (4, "创建 fulfillment_jobs 发放任务表", _fulfillment_jobs),
+    (5, "创建 webhook_inbox 回调收件箱", _webhook_inbox),
+    (6, "创建 orders_archive 订单归档表", _orders_archive),
+    (7, "orders 表添加 gateway_trade_id 字段", _order_gateway_trade_id),
+    (8, "添加订单分页筛选索引", _order_browse_indexes),
+    (9, "创建 panels 充值面板登记表", _panels),
+    (10, "orders 表添加 pay_type 字段", _order_pay_type),
+    (11, "创建 leases 租约表", _leases),
+    (12, "多服务器：各表添加 guild_id 字段与索引", _guild_scope),
+    (13, "合并重复订阅并为 (guild_id, user_id, role_id) 建立唯一索引", _subscription_stacking),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection, default_guild_id: Optional[int] = None) -> int:
+    """依次执行尚未应用的迁移，每个迁移单独一个事务；返回迁移后的版本号
+
+    default_guild_id 为升级到多服务器结构时旧数据归属的服务器。
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                 (version INTEGER PRIMARY KEY,
+                  description TEXT,
+                  applied_at INTEGER)''')
+    version = current_version(conn)
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        # 多个进程同时启动时，只有先拿到写锁的进程执行迁移
+        if current_version(conn) >= target:
+            conn.rollback()
+            version = target
+            continue
+        logger.info(f"正在执行数据库迁移 {target}: {description}")
+        try:
+            apply(conn)
+            if target == GUILD_SCOPE_VERSION and default_guild_id is not None:
+                backfill_guild_id(conn, default_guild_id)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (target, description, int(time.time())))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        version = target
+    return version
@@ -0,0 +1,62 @@
+"""订单号生成器
+
+格式：前缀 + 13 位毫秒时间戳 + 4 位节点号 + 4 位序号，例如
+ORD1760000000000004200001（24 字符，纯字母数字，满足网关 32 字符限制）。
+
+- 同一毫秒内靠序号区分，单节点每毫秒最多 10000 个，序号用尽时借用下一毫秒
+- 时钟回拨时沿用上次的时间戳，保证同一生成器产生的订单号严格递增
+- 不同进程/机器通过节点号区分：配置 node_id，或由共享同一数据库的进程通过租约分配（见 main.allocate_node_id）
+"""
+import os
+import threading
+import time
+from typing import Optional
+
+NODE_DIGITS = 4
+SEQUENCE_DIGITS = 4
+MAX_NODE_ID = 10 ** NODE_DIGITS - 1
+_SEQUENCE_LIMIT = 10 ** SEQUENCE_DIGITS
+MAX_TRADE_NO_LENGTH = 32
+
+
+def default_node_id() -> int:
+    """由进程号推出的节点号，不保证唯一（进程号可能超过 10000），只作为分配节点号时的起点或单进程时的默认值"""
+    return os.getpid() % (MAX_NODE_ID + 1)
+
+
+class OrderIdGenerator:
+    """线程安全的单调订单号生成器"""
+
+    def __init__(self, node_id: Optional[int] = None, prefix: str = "ORD"):
+        node_id = default_node_id() if node_id is None else int(node_id)
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"node_id 必须在 0~{MAX_NODE_ID} 之间: {node_id}")
+        self.node_id = node_id
+        self.prefix = prefix
+        self._node = str(node_id).zfill(NODE_DIGITS)
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _tick(self):
+        now_ms = time.time_ns() // 1_000_000
+        with self._lock:
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # 同一毫秒或时钟回拨：继续递增序号，用尽后借用下一毫秒
+                self._sequence += 1
+                if self._sequence >= _SEQUENCE_LIMIT:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return self._last_ms, self._sequence
+
+    def next(self, prefix: Optional[str] = None) -> str:
+        ms, sequence = self._tick()
+        trade_no = f"{self.prefix if prefix is None else prefix}{ms:013d}{self._node}{sequence:0{SEQUENCE_DIGITS}d}"
+        if len(trade_no) > MAX_TRADE_NO_LENGTH:
+            raise ValueError(f"订单号前缀过长: {trade_no}")
+        return trade_no
+
+    __call__ = next
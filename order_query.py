@@ -0,0 +1,106 @@
+"""订单分页查询
+
+按 (created_at, order_id) 倒序做 keyset 分页：翻页只需记住当前页首尾两条订单的键，
+每一页都是一次索引范围扫描，与翻到第几页、表有多大无关。
+筛选条件（服务器/用户/套餐/状态/时间范围）都有对应的 (列, created_at) 索引。
+"""
+from typing import List, NamedTuple, Optional, Tuple
+
+from storage import Storage
+
+ORDER_COLUMNS_SQL = "order_id, user_id, plan_id, status, created_at"
+
+# 分页游标：(created_at, order_id)
+PageKey = Tuple[int, str]
+
+
+class OrderFilter(NamedTuple):
+    guild_id: Optional[int] = None
+    user_id: Optional[int] = None
+    plan_id: Optional[int] = None
+    status: Optional[str] = None
+    since: Optional[int] = None
+    until: Optional[int] = None
+
+    def describe(self) -> str:
+        parts = []
+        if self.user_id is not None:
+            parts.append(f"用户 <@{self.user_id}>")
+        if self.plan_id is not None:
+            parts.append(f"套餐 #{self.plan_id}")
+        if self.status:
+            parts.append(f"状态 {self.status}")
+        if self.since is not None or self.until is not None:
+            parts.append("时间范围")
+        return "、".join(parts)
+
+
+class OrderPage(NamedTuple):
+    # 元素顺序：order_id, user_id, plan_id, status, created_at（按时间倒序）
+    rows: List[tuple]
+    has_newer: bool
+    has_older: bool
+
+    @property
+    def first_key(self) -> Optional[PageKey]:
+        return (self.rows[0][4], self.rows[0][0]) if self.rows else None
+
+    @property
+    def last_key(self) -> Optional[PageKey]:
+        return (self.rows[-1][4], self.rows[-1][0]) if self.rows else None
+
+
+def _where(flt: OrderFilter) -> Tuple[List[str], List]:
+    clauses, params = [], []
+    for column, value in (("guild_id", flt.guild_id), ("user_id", flt.user_id), ("plan_id", flt.plan_id),
+                          ("status", flt.status)):
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if flt.since is not None:
+        clauses.append("created_at >= ?")
+        params.append(flt.since)
+    if flt.until is not None:
+        clauses.append("created_at < ?")
+        params.append(flt.until)
+    return clauses, params
+
+
+async def fetch_order_page(
+    storage: Storage,
+    flt: OrderFilter,
+    older_than: Optional[PageKey] = None,
+    newer_than: Optional[PageKey] = None,
+    page_size: int = 20,
+) -> OrderPage:
+    """读取一页订单；older_than 翻到下一页（更早），newer_than 翻到上一页，都省略时为第一页"""
+    clauses, params = _where(flt)
+    if newer_than is not None:
+        clauses.append("(created_at, order_id) > (?, ?)")
+        params.extend(newer_than)
+        order = "ASC"
+    else:
+        if older_than is not None:
+            clauses.append("(created_at, order_id) < (?, ?)")
+            params.extend(older_than)
+        order = "DESC"
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = await storage.fetchall(
+        f"SELECT {ORDER_COLUMNS_SQL} FROM orders {where} "
+        f"ORDER BY created_at {order}, order_id {order} LIMIT ?",
+        (*params, page_size + 1))
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if newer_than is not None:
+        rows.reverse()
+        return OrderPage(rows, has_newer=more, has_older=True)
+    return OrderPage(rows, has_newer=older_than is not None, has_older=more)
+
+
+async def search_order_prefix(storage: Storage, prefix: str, limit: int = 5,
+                              guild_id: Optional[int] = None) -> List[tuple]:
+    """按订单号前缀查找（主键范围扫描，取代前导通配符 LIKE）；指定 guild_id 时只返回该服务器的订单"""
+    scope, params = ("AND guild_id = ? ", (guild_id,)) if guild_id is not None else ("", ())
+    return await storage.fetchall(
+        f"SELECT {ORDER_COLUMNS_SQL} FROM orders WHERE order_id >= ? AND order_id < ? {scope}ORDER BY order_id LIMIT ?",
+        (prefix, prefix + "\uffff", *params, limit))
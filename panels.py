@@ -0,0 +1,120 @@
+"""充值面板登记表
+
+- 每条已发布的面板消息都记录在 panels 表中，连同发布时套餐目录的内容指纹
+- 面板的 Embed 与下拉组件按服务器的套餐快照只构建一次，该服务器的所有面板与持久化视图共用
+- 套餐变更后在后台按速率限制逐条编辑该服务器过期的面板，消息已被删除则移出登记表
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from plan_catalog import PlanSnapshot
+from ratelimit import TokenBucket
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# render(snapshot) -> (embed, view)
+RenderPanel = Callable[[PlanSnapshot], Tuple[Any, Any]]
+# edit(channel_id, message_id, embed, view) -> 消息是否仍然存在
+EditPanel = Callable[[int, int, Any, Any], Awaitable[bool]]
+
+
+class PanelRegistry:
+    def __init__(
+        self,
+        storage: Storage,
+        render: RenderPanel,
+        edit: EditPanel,
+        rate: float = 1.0,
+        burst: int = 5,
+        page_size: int = 100,
+    ):
+        self._storage = storage
+        self._render = render
+        self._edit = edit
+        self._bucket = TokenBucket(rate, burst)
+        self.page_size = page_size
+        # 新视图构建完成时回调（用于注册持久化视图）
+        self.on_rendered: Optional[Callable[[Any], None]] = None
+        # guild_id -> (指纹, embed, view)
+        self._rendered: Dict[Optional[int], Tuple[str, Any, Any]] = {}
+        self._tasks: Dict[Optional[int], asyncio.Task] = {}
+
+    def render(self, snapshot: PlanSnapshot) -> Tuple[Any, Any]:
+        """返回该快照对应的 (embed, view)，同一服务器的同一份套餐内容只构建一次"""
+        rendered = self._rendered.get(snapshot.guild_id)
+        if rendered is None or rendered[0] != snapshot.fingerprint:
+            embed, view = self._render(snapshot)
+            rendered = self._rendered[snapshot.guild_id] = (snapshot.fingerprint, embed, view)
+            if self.on_rendered:
+                self.on_rendered(view)
+        return rendered[1], rendered[2]
+
+    async def register(self, guild_id: Optional[int], channel_id: int, message_id: int, snapshot: PlanSnapshot):
+        await self._storage.execute(
+            "INSERT OR REPLACE INTO panels (message_id, channel_id, guild_id, fingerprint, created_at) VALUES (?, ?, ?, ?, ?)",
+            (message_id, channel_id, guild_id, snapshot.fingerprint, int(time.time())))
+
+    async def count(self) -> int:
+        return (await self._storage.fetchone("SELECT COUNT(*) FROM panels"))[0]
+
+    async def guild_ids(self) -> List[int]:
+        """发布过面板的服务器"""
+        rows = await self._storage.fetchall("SELECT DISTINCT guild_id FROM panels WHERE guild_id IS NOT NULL")
+        return [row[0] for row in rows]
+
+    def schedule_refresh(self, snapshot: PlanSnapshot):
+        """在后台把该服务器的过期面板更新到 snapshot；新的调用会取代该服务器尚未完成的旧任务"""
+        task = self._tasks.get(snapshot.guild_id)
+        if task and not task.done():
+            task.cancel()
+        self._tasks[snapshot.guild_id] = asyncio.get_running_loop().create_task(self._refresh_logged(snapshot))
+
+    def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    async def _refresh_logged(self, snapshot: PlanSnapshot):
+        try:
+            updated, removed = await self.refresh(snapshot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"刷新面板失败: {e}")
+            return
+        if updated or removed:
+            logger.info(f"已刷新 {updated} 个面板，移除 {removed} 个已删除的面板",
+                        extra={"event": "panels.refreshed", "guild_id": snapshot.guild_id})
+
+    async def refresh(self, snapshot: PlanSnapshot) -> Tuple[int, int]:
+        """逐条编辑该服务器指纹不一致的面板，返回 (更新数, 移除数)"""
+        embed, view = self.render(snapshot)
+        updated = removed = 0
+        after = 0
+        while True:
+            rows = await self._storage.fetchall(
+                "SELECT message_id, channel_id FROM panels WHERE guild_id = ? AND message_id > ? AND fingerprint != ? "
+                "ORDER BY message_id LIMIT ?", (snapshot.guild_id, after, snapshot.fingerprint, self.page_size))
+            if not rows:
+                return updated, removed
+            for message_id, channel_id in rows:
+                after = message_id
+                await self._bucket.acquire()
+                try:
+                    exists = await self._edit(channel_id, message_id, embed, view)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # 权限变化等错误：保留记录，下次刷新再试
+                    logger.warning(f"编辑面板 {message_id} 失败: {e}")
+                    continue
+                if exists:
+                    await self._storage.execute("UPDATE panels SET fingerprint = ? WHERE message_id = ?",
+                                                (snapshot.fingerprint, message_id))
+                    updated += 1
+                else:
+                    await self._storage.execute("DELETE FROM panels WHERE message_id = ?", (message_id,))
+                    removed += 1
@@ -0,0 +1,109 @@
+"""进程内套餐目录缓存
+
+套餐只会通过 /set_plan、/delete_plan 修改，因此启动时加载一次，
+之后只在这两个管理命令执行后重建对应服务器的目录。读路径直接访问内存中的
+不可变快照，不再产生数据库 I/O。每个服务器有独立的套餐目录。
+"""
+import asyncio
+import hashlib
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from storage import Storage
+
+# 强制指定顺序：guild_id, id, name, price, currency, role_id, duration_months
+PLAN_COLUMNS_SQL = "SELECT guild_id, id, name, price, currency, role_id, duration_months FROM plans"
+
+
+class Plan(NamedTuple):
+    """套餐记录；仍可按 (id, name, price, currency, role_id, duration) 解包"""
+    id: int
+    name: str
+    price: float
+    currency: str
+    role_id: int
+    duration_months: int
+
+
+class PlanSnapshot:
+    """某一时刻某个服务器的只读套餐目录，带 id 与名称索引"""
+
+    __slots__ = ("guild_id", "plans", "by_id", "by_name", "version", "fingerprint")
+
+    def __init__(self, plans: Iterable[Plan], version: int, guild_id: Optional[int] = None):
+        self.guild_id = guild_id
+        self.plans: Tuple[Plan, ...] = tuple(plans)
+        self.by_id: Mapping[int, Plan] = MappingProxyType({p.id: p for p in self.plans})
+        self.by_name: Mapping[str, Plan] = MappingProxyType({p.name: p for p in self.plans})
+        self.version = version
+        # 内容指纹：跨进程重启保持不变，用于判断已发布的面板是否过期
+        self.fingerprint = hashlib.sha1(repr((guild_id, self.plans)).encode("utf-8")).hexdigest()[:16]
+
+    def get(self, plan_id: int) -> Optional[Plan]:
+        return self.by_id.get(plan_id)
+
+    def find(self, name: str) -> Optional[Plan]:
+        return self.by_name.get(name)
+
+    def __iter__(self):
+        return iter(self.plans)
+
+    def __len__(self):
+        return len(self.plans)
+
+
+class PlanCatalog:
+    """全进程共享的套餐目录；每个服务器的快照重建时整体替换，读取方无需加锁"""
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self._snapshots: Dict[int, PlanSnapshot] = {}
+        self._version = 0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def guild_ids(self) -> Tuple[int, ...]:
+        """配置了套餐的服务器"""
+        return tuple(self._snapshots)
+
+    def snapshot(self, guild_id: int) -> PlanSnapshot:
+        """该服务器的当前快照（未加载或没有套餐时为空目录）"""
+        snapshot = self._snapshots.get(guild_id)
+        return snapshot if snapshot is not None else PlanSnapshot((), self._version, guild_id)
+
+    async def current(self, guild_id: int) -> PlanSnapshot:
+        """返回该服务器的当前快照，首次调用时从数据库加载全部服务器"""
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    await self._load_all()
+        return self.snapshot(guild_id)
+
+    async def reload(self, guild_id: int) -> PlanSnapshot:
+        """丢弃该服务器的旧快照并从数据库重建（套餐被修改后调用）"""
+        async with self._lock:
+            if not self._loaded:
+                await self._load_all()
+            else:
+                rows = await self._storage.fetchall(PLAN_COLUMNS_SQL + " WHERE guild_id = ? ORDER BY id", (guild_id,))
+                self._version += 1
+                self._snapshots[guild_id] = PlanSnapshot((Plan(*row[1:]) for row in rows), self._version, guild_id)
+        return self.snapshot(guild_id)
+
+    async def reload_all(self) -> Dict[int, PlanSnapshot]:
+        async with self._lock:
+            await self._load_all()
+        return dict(self._snapshots)
+
+    async def _load_all(self):
+        rows = await self._storage.fetchall(PLAN_COLUMNS_SQL + " ORDER BY guild_id, id")
+        grouped: Dict[int, list] = {}
+        for row in rows:
+            grouped.setdefault(row[0], []).append(Plan(*row[1:]))
+        self._version += 1
+        self._snapshots = {guild_id: PlanSnapshot(plans, self._version, guild_id) for guild_id, plans in grouped.items()}
+        self._loaded = True
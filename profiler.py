@@ -0,0 +1,159 @@
+"""事件循环性能分析
+
+- 卡顿监测（可选开启）：事件循环里的心跳协程定期打点，后台看门狗线程发现心跳
+  超过阈值未更新时抓取事件循环线程的调用栈；恢复后记录卡顿时长、正在执行的协程名
+  （如 generate_payment、process_expired_subscriptions）与栈顶位置
+- 按需采样：在后台线程中以固定间隔采样事件循环线程的调用栈，输出折叠栈
+  （flamegraph.pl / speedscope 可直接读取）与热点汇总
+
+两者都只在独立线程中读取 sys._current_frames()，不在事件循环上做额外工作。
+"""
+import asyncio
+import inspect
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def _stack(frame: Optional[FrameType]) -> List[FrameType]:
+    """由外到内的调用栈"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def coroutine_names(frames: List[FrameType]) -> List[str]:
+    """调用栈中正在执行的协程函数名（由外到内）"""
+    return [_frame_name(f) for f in frames if f.f_code.co_flags & inspect.CO_COROUTINE]
+
+
+def folded(frames: List[FrameType]) -> str:
+    return ";".join(f"{_frame_name(f)} ({f.f_code.co_filename.rsplit('/', 1)[-1]}:{f.f_code.co_firstlineno})"
+                    for f in frames)
+
+
+class StallWatchdog:
+    """事件循环卡顿看门狗"""
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02,
+                 on_stall: Optional[Callable[[float, List[str], str], None]] = None):
+        self.threshold = threshold
+        self.interval = interval
+        # 每次卡顿都会写日志；另可设置 on_stall(卡顿秒数, 协程名列表, 栈顶位置)，在看门狗线程中调用
+        self.on_stall = on_stall
+        self.stalls = 0
+        self._loop_thread: Optional[int] = None
+        self._last_beat = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        stalled_since = None
+        captured: Tuple[List[str], str] = ([], "")
+        while not self._stop.wait(self.interval):
+            beat = self._last_beat
+            lag = time.perf_counter() - beat - self.interval
+            if stalled_since is None:
+                if lag > self.threshold:
+                    stalled_since = beat
+                    # 卡顿进行中抓栈，才能看到是谁占住了事件循环
+                    frames = _stack(sys._current_frames().get(self._loop_thread))
+                    top = f"{frames[-1].f_code.co_filename}:{frames[-1].f_lineno} {_frame_name(frames[-1])}" if frames else ""
+                    captured = (coroutine_names(frames), top)
+            elif beat > stalled_since:
+                self.stalls += 1
+                duration = beat - stalled_since - self.interval
+                stalled_since = None
+                self._log_stall(duration, *captured)
+                if self.on_stall:
+                    try:
+                        self.on_stall(duration, *captured)
+                    except Exception:
+                        logger.exception("卡顿回调出错")
+
+    def _log_stall(self, duration: float, coroutines: List[str], top: str):
+        logger.warning(f"事件循环卡顿 {duration * 1000:.0f}ms，正在执行: {' > '.join(coroutines) or '未知'}",
+                       extra={"event": "profiler.stall", "duration_ms": round(duration * 1000),
+                              "coroutines": coroutines, "top_frame": top})
+
+
+class StackSampler:
+    """按需采样事件循环线程的调用栈"""
+
+    def __init__(self):
+        self._loop_thread: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    def bind(self):
+        """在事件循环线程中调用，记录要采样的线程"""
+        self._loop_thread = threading.get_ident()
+
+    def _sample(self, seconds: float, interval: float) -> Tuple[Counter, int]:
+        stacks: Counter = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                stacks[folded(_stack(frame))] += 1
+                samples += 1
+            time.sleep(interval)
+        return stacks, samples
+
+    async def profile(self, seconds: float = 10, interval: float = 0.005) -> Tuple[str, str]:
+        """采样 seconds 秒，返回 (热点汇总, 折叠栈文本)；同一时间只允许一个采样"""
+        if self._loop_thread is None:
+            self.bind()
+        async with self._lock:
+            stacks, samples = await asyncio.to_thread(self._sample, seconds, interval)
+        folded_text = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+        # 按栈顶函数汇总；栈顶在 selectors 中说明事件循环正空闲等待 I/O
+        leaves: Counter = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        idle = sum(c for leaf, c in leaves.items() if "(selectors.py:" in leaf)
+        lines = [f"采样 {samples} 次，间隔 {interval * 1000:g}ms，空闲 {idle / samples:.0%}" if samples else "没有采到样本"]
+        for leaf, count in leaves.most_common(15):
+            lines.append(f"{count / samples:6.1%}  {leaf}")
+        return "\n".join(lines), folded_text
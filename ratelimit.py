@@ -0,0 +1,86 @@
+"""令牌桶限流工具"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class TokenBucket:
+    """以 rate 个/秒的速度补充令牌，最多积累 capacity 个"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, n: float = 1) -> float:
+        """距离可取出 n 个令牌还需等待的秒数（不消耗令牌）"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.updated - now)
+        if self.tokens >= n:
+            return wait
+        return wait + (n - self.tokens) / self.rate
+
+    def try_acquire(self, n: float = 1) -> bool:
+        if self.delay(n) > 0:
+            return False
+        self.tokens -= n
+        return True
+
+    async def acquire(self, n: float = 1):
+        while True:
+            wait = self.delay(n)
+            if wait <= 0:
+                self.tokens -= n
+                return
+            await asyncio.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """清空令牌并在 seconds 秒内暂停补充（收到 429 时使用）"""
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        """令牌已补满，丢弃该桶不会改变限流行为"""
+        self.delay()
+        return self.tokens >= self.capacity
+
+
+class KeyedTokenBuckets:
+    """按 key 分别限流的令牌桶集合，超过 max_keys 时淘汰最久未使用的空闲桶"""
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[key] = bucket
+            self._evict()
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self):
+        while len(self._buckets) > self.max_keys:
+            key, bucket = next(iter(self._buckets.items()))
+            if not bucket.idle:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,139 @@
+"""支付对账
+
+定期向支付网关查询近期仍为 pending 的订单，发现已支付但回调丢失的订单时，
+把结果追加到回调收件箱，与 webhook 走同一条处理路径（enqueue_paid_order
+按订单状态去重，回调与对账同时到达也只会发放一次）。
+
+查询间隔随订单年龄自适应增长：刚创建的订单查得勤，越旧的订单查得越少，
+超过回看窗口后不再查询（由生命周期任务标记为 expired）。
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# query(order_id, gateway_trade_id) -> (是否已支付, 网关原始响应)；无法查询时返回 None
+QueryStatus = Callable[[str, Optional[str]], Awaitable[Optional[Tuple[bool, Dict]]]]
+# on_paid(order_id, 网关原始响应)
+OnPaid = Callable[[str, Dict], Awaitable[None]]
+
+# (订单年龄上限秒数, 查询间隔秒数)，按年龄升序
+DEFAULT_SCHEDULE: Sequence[Tuple[int, int]] = (
+    (10 * 60, 60),
+    (60 * 60, 5 * 60),
+    (6 * 60 * 60, 15 * 60),
+    (24 * 60 * 60, 60 * 60),
+)
+
+
+class OrderReconciler:
+    def __init__(
+        self,
+        storage: Storage,
+        query: QueryStatus,
+        on_paid: OnPaid,
+        concurrency: int = 4,
+        min_age: int = 30,
+        schedule: Sequence[Tuple[int, int]] = DEFAULT_SCHEDULE,
+        tick: float = 30,
+        batch_limit: int = 200,
+    ):
+        self._storage = storage
+        self._query = query
+        self._on_paid = on_paid
+        self.concurrency = max(1, concurrency)
+        # 给回调留出到达时间，太新的订单不查
+        self.min_age = min_age
+        self.schedule = sorted(schedule)
+        self.tick = tick
+        self.batch_limit = batch_limit
+        self._next_check: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.checked = 0
+        self.recovered = 0
+        self.errors = 0
+
+    @property
+    def lookback(self) -> int:
+        return self.schedule[-1][0]
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked": len(self._next_check), "checked": self.checked,
+                "recovered": self.recovered, "errors": self.errors}
+
+    def interval_for(self, age: float) -> Optional[int]:
+        for max_age, interval in self.schedule:
+            if age < max_age:
+                return interval
+        return None
+
+    async def _due_orders(self, now: float) -> List[Tuple[str, Optional[str], int]]:
+        rows = await self._storage.fetchall(
+            "SELECT order_id, gateway_trade_id, created_at FROM orders "
+            "WHERE status = 'pending' AND created_at BETWEEN ? AND ? ORDER BY created_at DESC",
+            (int(now) - self.lookback, int(now) - self.min_age))
+        pending = {row[0] for row in rows}
+        # 已支付/已过期的订单不再跟踪
+        for order_id in list(self._next_check):
+            if order_id not in pending:
+                del self._next_check[order_id]
+        due = [row for row in rows if self._next_check.get(row[0], 0) <= now]
+        return due[:self.batch_limit]
+
+    async def _check(self, semaphore: asyncio.Semaphore, order_id: str, gateway_trade_id: Optional[str], created_at: int):
+        async with semaphore:
+            try:
+                result = await self._query(order_id, gateway_trade_id)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"查询订单 {order_id} 失败: {e}", extra={"event": "reconcile.query_failed", "order_id": order_id})
+                result = None
+            finally:
+                self.checked += 1
+        now = time.time()
+        # 已支付的订单也照常排期：收件箱消费前它仍是 pending，避免下一轮重复补记
+        interval = self.interval_for(now - created_at)
+        if interval is None:
+            self._next_check.pop(order_id, None)
+        else:
+            self._next_check[order_id] = now + interval
+        if result is not None and result[0]:
+            self.recovered += 1
+            logger.warning("订单已在网关支付但未收到回调，已补记", extra={"event": "reconcile.recovered", "order_id": order_id})
+            await self._on_paid(order_id, result[1])
+
+    async def run_once(self) -> int:
+        """检查一轮到期的订单，返回查询数量"""
+        due = await self._due_orders(time.time())
+        if due:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*(self._check(semaphore, *row) for row in due))
+        return len(due)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"对账出错: {e}")
+            await asyncio.sleep(self.tick)
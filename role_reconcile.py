@@ -0,0 +1,285 @@
+"""身份组对账
+
+订阅表与服务器中实际的身份组会逐渐出现偏差（发放时添加失败、管理员手动改动、套餐被删除）。
+对账按服务器执行：
+1. 分页拉取服务器成员（每页 1000 个原始 JSON，不构造 Member 对象），只记下成员 ID 与各受管身份组的持有者；
+   ID 保存在 array('Q') 中，10 万成员约占 800KB
+2. 成员拉取完成后再按 (guild_id, user_id, role_id) 索引顺序分页读取有效订阅，期间新写入的订阅因此也会被看到
+3. 对每个身份组的有序 ID 数组做归并差集，得到最小的补发集合（有订阅、在服务器中、未持有）
+   与回收集合（持有但没有有效订阅，且没有进行中的发放任务）；每次回收前再确认一次该用户没有有效订阅，
+   对账期间的发放与手动授予（/grant_member）因此不会被误回收
+4. 补发与回收经身份组工作池执行，按服务器限流；回收默认只统计不执行，需显式开启
+
+受管身份组为当前套餐的身份组加上有效订阅中出现的身份组（套餐被删除后仍可回收）。
+未开启 members 特权 intent 时无法列出服务器成员，只对订阅用户批量解析（MemberResolver）并补发缺失的身份组，
+多余的身份组无法发现。
+"""
+import asyncio
+import functools
+import logging
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fulfillment import JOB_FULFILLING, JOB_PAID
+from members import MemberResolver
+from plan_catalog import PlanCatalog
+from role_worker import RoleWorkerPool
+from sharding import ShardScope
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Discord 列出服务器成员接口每页上限
+MEMBER_PAGE_SIZE = 1000
+
+
+def sorted_ids(ids: Iterable[int]) -> array:
+    """去重并升序排列"""
+    return array("Q", sorted(set(ids)))
+
+
+def difference(a: array, b: array) -> array:
+    """a - b，a、b 均为升序且无重复"""
+    result = array("Q")
+    j, n = 0, len(b)
+    for value in a:
+        while j < n and b[j] < value:
+            j += 1
+        if j == n or b[j] != value:
+            result.append(value)
+    return result
+
+
+def intersection(a: array, b: array) -> array:
+    """a ∩ b，a、b 均为升序且无重复"""
+    result = array("Q")
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+class RoleReconciler:
+    def __init__(
+        self,
+        storage: Storage,
+        bot,
+        resolver: MemberResolver,
+        role_workers: RoleWorkerPool,
+        catalog: PlanCatalog,
+        scope: Optional[ShardScope] = None,
+        full_scan: bool = True,
+        remove_extra: bool = False,
+        chunk_size: int = 1000,
+        interval: float = 24 * 60 * 60,
+        initial_delay: float = 300,
+    ):
+        self._storage = storage
+        self._bot = bot
+        self._resolver = resolver
+        self._role_workers = role_workers
+        self._catalog = catalog
+        self.scope = scope or ShardScope()
+        # 能否列出服务器成员（需要 members 特权 intent）
+        self.full_scan = full_scan
+        # 定时对账是否回收多余的身份组
+        self.remove_extra = remove_extra
+        self.chunk_size = chunk_size
+        self.interval = interval
+        # 启动后延迟首次对账，避开重启时的发放恢复高峰
+        self.initial_delay = initial_delay
+        self._running: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.added = 0
+        self.removed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def busy(self, guild_id: int) -> bool:
+        return guild_id in self._running
+
+    async def reconcile(self, guild, remove_extra: Optional[bool] = None, dry_run: bool = False) -> Dict[str, int]:
+        """对账一个服务器并返回摘要；同一服务器同时只会执行一次"""
+        if guild.id in self._running:
+            raise RuntimeError(f"服务器 {guild.id} 的身份组对账正在进行")
+        remove_extra = self.remove_extra if remove_extra is None else remove_extra
+        self._running.add(guild.id)
+        started = time.monotonic()
+        try:
+            summary = await self._reconcile(guild, remove_extra, dry_run)
+        finally:
+            self._running.discard(guild.id)
+        summary["seconds"] = round(time.monotonic() - started, 1)
+        logger.info("身份组对账完成", extra={"event": "roles.reconciled", "guild_id": guild.id, **summary})
+        return summary
+
+    async def _reconcile(self, guild, remove_extra: bool, dry_run: bool) -> Dict[str, int]:
+        snapshot = await self._catalog.current(guild.id)
+        rows = await self._storage.fetchall("SELECT DISTINCT role_id FROM subscriptions WHERE guild_id = ?", (guild.id,))
+        managed = {role_id for role_id in {plan.role_id for plan in snapshot} | {row[0] for row in rows}
+                   if guild.get_role(role_id)}
+
+        if self.full_scan:
+            # 先拉取成员再读订阅：拉取期间完成的发放会体现在订阅中，不会被误判为多余
+            members, holders = await self._scan_members(guild, managed)
+            subscribed = await self._load_subscriptions(guild.id)
+        else:
+            subscribed = await self._load_subscriptions(guild.id)
+            members, holders = await self._resolve_subscribers(guild, subscribed, managed)
+
+        protected = sorted_ids(await self._pending_users(guild.id)) if remove_extra else array("Q")
+        to_add: List[Tuple[int, int]] = []
+        to_remove: List[Tuple[int, int]] = []
+        for role_id in managed:
+            subs = subscribed.get(role_id, array("Q"))
+            held = holders.get(role_id, array("Q"))
+            to_add.extend((user_id, role_id) for user_id in difference(intersection(subs, members), held))
+            if self.full_scan:
+                to_remove.extend((user_id, role_id) for user_id in difference(difference(held, subs), protected))
+
+        summary = {
+            "members": len(members),
+            "roles": len(managed),
+            "subscriptions": sum(len(subscribed.get(role_id, ())) for role_id in managed),
+            "missing": len(to_add),
+            "extra": len(to_remove) if self.full_scan else -1,
+            "added": 0,
+            "removed": 0,
+            "failed": 0,
+        }
+        if dry_run:
+            return summary
+        summary["added"], failed = await self._apply(guild.id, to_add, self._resolver.add_role, "reconcile_add")
+        summary["failed"] += failed
+        if remove_extra and to_remove:
+            summary["removed"], failed = await self._apply(
+                guild.id, to_remove, self._remove_unsubscribed, "reconcile_remove")
+            summary["failed"] += failed
+        return summary
+
+    async def _scan_members(self, guild, role_ids: Set[int]) -> Tuple[array, Dict[int, array]]:
+        """分页拉取全部成员，返回 (成员 ID, 身份组 -> 持有者 ID)"""
+        wanted = {str(role_id): role_id for role_id in role_ids}
+        members = array("Q")
+        holders: Dict[int, array] = {role_id: array("Q") for role_id in role_ids}
+        after = None
+        while True:
+            page = await self._bot.http.get_members(guild.id, MEMBER_PAGE_SIZE, after)
+            for data in page:
+                user_id = int(data["user"]["id"])
+                members.append(user_id)
+                for role in data.get("roles", ()):
+                    role_id = wanted.get(role)
+                    if role_id is not None:
+                        holders[role_id].append(user_id)
+            if len(page) < MEMBER_PAGE_SIZE:
+                break
+            after = page[-1]["user"]["id"]
+        # 接口按 user_id 升序分页，这里仍显式排序以保证归并的前提
+        return sorted_ids(members), {role_id: sorted_ids(ids) for role_id, ids in holders.items()}
+
+    async def _resolve_subscribers(self, guild, subscribed: Dict[int, array],
+                                   role_ids: Set[int]) -> Tuple[array, Dict[int, array]]:
+        """无法列出成员时，只解析有订阅的用户"""
+        user_ids = sorted_ids(user_id for ids in subscribed.values() for user_id in ids)
+        members = array("Q")
+        holders: Dict[int, List[int]] = {role_id: [] for role_id in role_ids}
+        for start in range(0, len(user_ids), self.chunk_size):
+            resolved = await self._resolver.resolve_many(guild, user_ids[start:start + self.chunk_size])
+            for user_id, member in resolved.items():
+                members.append(user_id)
+                for role_id in role_ids:
+                    if member.get_role(role_id):
+                        holders[role_id].append(user_id)
+        return sorted_ids(members), {role_id: sorted_ids(ids) for role_id, ids in holders.items()}
+
+    async def _load_subscriptions(self, guild_id: int) -> Dict[int, array]:
+        """按 (user_id, role_id) 键集分页读取有效订阅，返回 身份组 -> 订阅用户 ID"""
+        now = int(time.time())
+        subscribed: Dict[int, array] = {}
+        last = (-1, -1)
+        while True:
+            rows = await self._storage.fetchall(
+                "SELECT user_id, role_id FROM subscriptions "
+                "WHERE guild_id = ? AND (user_id, role_id) > (?, ?) AND (expire_date = -1 OR expire_date > ?) "
+                "ORDER BY user_id, role_id LIMIT ?",
+                (guild_id, *last, now, self.chunk_size))
+            # (guild_id, user_id, role_id) 唯一，各身份组的用户 ID 按升序追加
+            for user_id, role_id in rows:
+                subscribed.setdefault(role_id, array("Q")).append(user_id)
+            if len(rows) < self.chunk_size:
+                return subscribed
+            last = rows[-1]
+
+    async def _pending_users(self, guild_id: int) -> List[int]:
+        """有进行中发放任务的用户：身份组可能已添加而订阅尚未写入，不能回收"""
+        rows = await self._storage.fetchall(
+            "SELECT o.user_id FROM fulfillment_jobs j JOIN orders o ON o.order_id = j.order_id "
+            "WHERE j.guild_id = ? AND j.state IN (?, ?)", (guild_id, JOB_PAID, JOB_FULFILLING))
+        return [row[0] for row in rows]
+
+    async def _remove_unsubscribed(self, guild_id: int, user_id: int, role_id: int, reason: Optional[str] = None) -> bool:
+        """移除前再确认没有有效订阅；订阅已写入时跳过并返回 False"""
+        row = await self._storage.fetchone(
+            "SELECT 1 FROM subscriptions WHERE guild_id = ? AND user_id = ? AND role_id = ? "
+            "AND (expire_date = -1 OR expire_date > ?)", (guild_id, user_id, role_id, int(time.time())))
+        if row:
+            return False
+        return await self._resolver.remove_role(guild_id, user_id, role_id, reason=reason)
+
+    async def _apply(self, guild_id: int, changes: List[Tuple[int, int]], operation, name: str) -> Tuple[int, int]:
+        """经工作池分批执行，返回 (成功数, 失败数)；成员已离开服务器或已有订阅而跳过的不计入两者"""
+        done = failed = 0
+        for start in range(0, len(changes), self.chunk_size):
+            chunk = changes[start:start + self.chunk_size]
+            results = await asyncio.gather(*(
+                self._role_workers.submit(
+                    guild_id, functools.partial(operation, guild_id, user_id, role_id, reason="身份组对账"), name)
+                for user_id, role_id in chunk), return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    failed += 1
+                elif result:
+                    done += 1
+        if name == "reconcile_add":
+            self.added += done
+        else:
+            self.removed += done
+        self.failed += failed
+        return done, failed
+
+    async def _run(self):
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            for guild_id in self._catalog.guild_ids():
+                guild = self._bot.get_guild(guild_id)
+                if guild is None or not self.scope.owns(guild_id) or self.busy(guild_id):
+                    continue
+                try:
+                    await self.reconcile(guild)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.exception(f"身份组对账失败 guild={guild_id}: {e}")
+            await asyncio.sleep(self.interval)
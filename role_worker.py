@@ -0,0 +1,179 @@
+"""身份组操作工作池
+
+所有身份组的添加/移除都经由固定数量的 worker 执行：
+- 按 Discord 路由桶（成员身份组接口以 guild_id 为主参数）做令牌桶限流
+- 遇到 429 按 retry_after 暂停该桶后重试，5xx/网络错误按指数退避重试
+- 统计队列深度、执行中数量及成功/失败/重试次数，停机后的大量补偿任务也能在可预期时间内完成
+"""
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from ratelimit import KeyedTokenBuckets
+
+RoleOperation = Callable[[], Awaitable[Any]]
+
+
+class _Job:
+    __slots__ = ("bucket", "operation", "name", "future", "attempts")
+
+    def __init__(self, bucket: Hashable, operation: RoleOperation, name: str, future: asyncio.Future):
+        self.bucket = bucket
+        self.operation = operation
+        self.name = name
+        self.future = future
+        self.attempts = 0
+
+
+def _retry_delay(exc: BaseException) -> Optional[float]:
+    """可重试的错误返回建议等待秒数（0 表示按退避计算），不可重试返回 None"""
+    status = getattr(exc, "status", None)
+    if status == 429:
+        retry_after = getattr(exc, "retry_after", None)
+        return float(retry_after) if retry_after else 0.0
+    if isinstance(status, int) and status >= 500:
+        return 0.0
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError, OSError)):
+        return 0.0
+    return None
+
+
+class RoleWorkerPool:
+    def __init__(
+        self,
+        workers: int = 4,
+        rate: float = 5.0,
+        burst: float = 10,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._buckets = KeyedTokenBuckets(rate, burst)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._inflight = 0
+        # 等待退避后重新入队的任务及其定时器
+        self._retrying: Dict[_Job, asyncio.TimerHandle] = {}
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        # 可选回调: (操作名, 耗时秒数, 是否成功)，供监控统计使用
+        self.on_result: Optional[Callable[[str, float, bool], None]] = None
+
+    @property
+    def running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    def start(self):
+        if self.running:
+            return
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """停止所有 worker；尚未完成的操作（排队中、等待重试、执行中）以 RuntimeError 结束，调用方不会一直等待"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        pending = []
+        for job, handle in self._retrying.items():
+            handle.cancel()
+            pending.append(job)
+        self._retrying.clear()
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+            self._queue.task_done()
+        for job in pending:
+            self._abort(job)
+
+    @staticmethod
+    def _abort(job: _Job):
+        if not job.future.done():
+            job.future.set_exception(RuntimeError(f"身份组工作池已停止，未执行的操作: {job.name}"))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "inflight": self._inflight,
+            "waiting_retry": len(self._retrying),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+        }
+
+    def submit_nowait(self, bucket: Hashable, operation: RoleOperation, name: str = "role") -> asyncio.Future:
+        """排队一个身份组操作，返回在操作最终成功或放弃时完成的 Future"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Job(bucket, operation, name, future))
+        return future
+
+    async def submit(self, bucket: Hashable, operation: RoleOperation, name: str = "role") -> Any:
+        return await self.submit_nowait(bucket, operation, name)
+
+    def _requeue_later(self, job: _Job, delay: float):
+        def requeue():
+            self._retrying.pop(job, None)
+            self._queue.put_nowait(job)
+
+        self._retrying[job] = asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                # 停止时正在执行或等待令牌的操作
+                self._abort(job)
+                raise
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _Job):
+        bucket = self._buckets.get(job.bucket)
+        await bucket.acquire()
+        job.attempts += 1
+        self._inflight += 1
+        started = time.perf_counter()
+        try:
+            result = await job.operation()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._report(job, started, False)
+            delay = _retry_delay(e)
+            if delay is not None and job.attempts <= self.max_retries:
+                if getattr(e, "status", None) == 429:
+                    self.rate_limited += 1
+                    bucket.penalize(delay)
+                if delay <= 0:
+                    delay = min(self.max_backoff, self.base_backoff * (2 ** (job.attempts - 1)))
+                    delay *= random.uniform(0.8, 1.2)
+                self.retried += 1
+                self._requeue_later(job, delay)
+                return
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        finally:
+            self._inflight -= 1
+        self._report(job, started, True)
+        self.completed += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _report(self, job: _Job, started: float, ok: bool):
+        if self.on_result:
+            self.on_result(job.name, time.perf_counter() - started, ok)
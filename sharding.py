@@ -0,0 +1,44 @@
+"""分片范围
+
+Discord 按 (guild_id >> 22) % shard_count 把服务器分配到分片。多个进程各自运行一部分分片时，
+发放与到期等后台任务只处理本进程分片内的服务器，数据库查询用同一公式过滤 guild_id 列，
+不需要维护服务器列表。未配置 shard_ids 时本进程负责全部服务器。
+"""
+from typing import Iterable, Optional, Sequence, Tuple
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+
+class ShardScope:
+    def __init__(self, shard_count: Optional[int] = None, shard_ids: Optional[Iterable[int]] = None):
+        self.shard_count = shard_count or 1
+        self.shard_ids: Optional[Tuple[int, ...]] = tuple(sorted(set(shard_ids))) if shard_ids is not None else None
+        if self.shard_ids is not None and set(self.shard_ids) >= set(range(self.shard_count)):
+            self.shard_ids = None
+
+    @property
+    def everything(self) -> bool:
+        return self.shard_ids is None
+
+    @property
+    def primary(self) -> bool:
+        """是否负责不区分服务器的全局任务（找不到订单的回调事件、订单归档、对账），由 0 号分片所在进程承担"""
+        return self.everything or 0 in self.shard_ids
+
+    @property
+    def name(self) -> str:
+        return "all" if self.everything else ",".join(map(str, self.shard_ids))
+
+    def owns(self, guild_id: Optional[int]) -> bool:
+        if self.everything:
+            return True
+        return guild_id is not None and shard_of(guild_id, self.shard_count) in self.shard_ids
+
+    def sql(self, column: str = "guild_id") -> Tuple[str, Sequence[int]]:
+        """返回 (条件, 参数)，用于拼接到 WHERE 子句中"""
+        if self.everything:
+            return "1 = 1", ()
+        placeholders = ",".join("?" * len(self.shard_ids))
+        return f"(({column} >> 22) % ?) IN ({placeholders})", (self.shard_count, *self.shard_ids)
@@ -0,0 +1,209 @@
+"""异步 SQLite 存储层
+
+所有数据库访问都放到专用线程中执行，事件循环只负责 await 结果：
+- 写操作由唯一的写线程串行执行（独占一个连接，不再共享全局 cursor）
+- 几毫秒内到达的写操作合并为一个事务提交（group commit），每个写入
+  在所属批次提交成功后才返回，调用方拿到结果即代表数据已落盘
+- 读操作由独立的读线程执行，WAL 模式下读写互不阻塞
+- 每个连接开启较大的语句缓存，参数化 SQL 只在首次执行时编译
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+# 每个连接缓存的预编译语句数量（sqlite3 默认 128）
+STATEMENT_CACHE_SIZE = 256
+
+
+def _connect(path: str, readonly: bool = False) -> sqlite3.Connection:
+    """打开一个已调优的连接"""
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        # 只对尚未建表的新数据库生效（必须早于 WAL 设置），已有数据库会忽略该设置
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # 每次提交都 fsync；group commit 让一次 fsync 覆盖整批写入
+        conn.execute("PRAGMA synchronous = FULL")
+    return conn
+
+
+class Storage:
+    """线程化的 SQLite 访问入口，对外只提供 async API"""
+
+    def __init__(self, path: str, readers: int = 2, batch_window: float = 0.002, max_batch: int = 256):
+        self.path = path
+        self.readers = max(1, readers)
+        # 首个写入到达后最多等待 batch_window 秒收集同批写入，单批最多 max_batch 条
+        self.batch_window = batch_window
+        self.max_batch = max(1, max_batch)
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self._read_local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._read_conns_lock = threading.Lock()
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # 每批提交后在写线程中回调 (提交耗时秒数, 批大小)，用于监控
+        self.on_commit: Optional[Callable[[float, int], None]] = None
+
+    def open(self, setup: Optional[Callable[[sqlite3.Connection], None]] = None):
+        """打开写连接并执行建表/迁移（同步调用，仅在启动阶段使用）"""
+        if self._writer:
+            return
+        self._write_conn = _connect(self.path)
+        if setup:
+            setup(self._write_conn)
+            self._write_conn.commit()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._reader = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+
+    async def drain(self):
+        """等待所有已提交的写入完成（关闭前调用）"""
+        if self._write_queue is not None and self._flusher and not self._flusher.done():
+            await self._write_queue.join()
+
+    def close(self):
+        """等待未完成的操作结束后关闭所有连接"""
+        # 事件循环此时通常已关闭，未完成的批次由 drain() 负责等待；
+        # 仍在队列中的写入不会再被执行，立即让等待方收到错误
+        self._fail_queued(RuntimeError("数据库已关闭"))
+        self._flusher = None
+        self._write_queue = None
+        if self._writer:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        if self._reader:
+            self._reader.shutdown(wait=True)
+            self._reader = None
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        if self._write_conn:
+            self._write_conn.close()
+            self._write_conn = None
+
+    def _fail_queued(self, error: BaseException):
+        queue = self._write_queue
+        if queue is None:
+            return
+        while not queue.empty():
+            _, fut = queue.get_nowait()
+            queue.task_done()
+            if fut.done():
+                continue
+            try:
+                fut.set_exception(error)
+            except RuntimeError:
+                # 所属事件循环已关闭，等待方不会再被调度
+                pass
+
+    # ---------- 线程内执行 ----------
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            conn = _connect(self.path, readonly=True)
+            self._read_local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _run_read(self, sql: str, params: Sequence[Any], one: bool):
+        cur = self._reader_conn().execute(sql, params)
+        try:
+            return cur.fetchone() if one else cur.fetchall()
+        finally:
+            cur.close()
+
+    def _run_batch(self, batch: List[Callable[[sqlite3.Connection], Any]]) -> List[Tuple[bool, Any]]:
+        """在一个事务中执行整批写入；每个写入各自包在 SAVEPOINT 中，失败只回滚它自己"""
+        conn = self._write_conn
+        if conn is None:
+            raise RuntimeError("数据库已关闭")
+        results: List[Tuple[bool, Any]] = []
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn in batch:
+                conn.execute("SAVEPOINT batch_item")
+                try:
+                    results.append((True, fn(conn)))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_item")
+                    results.append((False, e))
+                conn.execute("RELEASE batch_item")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if self.on_commit:
+            self.on_commit(time.perf_counter() - started, len(batch))
+        return results
+
+    async def _flush_loop(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await queue.get()]
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(items) < self.max_batch and not queue.empty():
+                items.append(queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._writer, self._run_batch, [fn for fn, _ in items])
+            except Exception as e:
+                # 提交本身失败，整批写入都未生效
+                results = [(False, e)] * len(items)
+            for (_, fut), (ok, value) in zip(items, results):
+                if not fut.done():
+                    if ok:
+                        fut.set_result(value)
+                    else:
+                        fut.set_exception(value)
+                queue.task_done()
+
+    async def _submit(self, executor: Optional[ThreadPoolExecutor], fn, *args):
+        if executor is None:
+            raise RuntimeError("数据库尚未打开")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, fn, *args)
+
+    # ---------- 对外 API ----------
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[Tuple]:
+        return await self._submit(self._reader, self._run_read, sql, params, True)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple]:
+        return await self._submit(self._reader, self._run_read, sql, params, False)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """执行单条写语句并提交，返回受影响行数"""
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        rows = list(seq_of_params)
+        if not rows:
+            return 0
+        return await self.transaction(lambda conn: conn.executemany(sql, rows).rowcount)
+
+    async def transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """在写线程中原子地执行 fn(conn)，所属批次提交后返回其结果；出错时只回滚 fn 自身的修改并抛出
+
+        fn 不能自行 commit/rollback，提交由批处理统一完成。
+        """
+        if self._writer is None:
+            raise RuntimeError("数据库尚未打开")
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._write_queue = asyncio.Queue()
+            self._flusher = loop.create_task(self._flush_loop(self._write_queue))
+        fut = loop.create_future()
+        self._write_queue.put_nowait((fn, fut))
+        return await fut